@@ -0,0 +1,320 @@
+"""End-to-end benchmark of the md-paper pipeline against local upstreams.
+
+Synthetic vaults are generated, the fake CrossRef / arXiv / bioRxiv /
+sci-hub server of ``benchmarks.upstreams`` answers every request, and each
+target runs in a fresh process so its peak RSS is its own:
+
+    main                 md_paper.main() on the whole vault (-i vault -o pdfs)
+    per_note             get_vault_update_contents() one note at a time
+    rename               rename_pdfs_in_directory() on a folder of pdfs
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.bench_pipeline --notes 10 100 1000 --latency 0.02 --error-rate 0.01
+
+Per paper latency is the time spent resolving a paper plus downloading its
+pdf; the time of a batched query is shared evenly among the papers in it.
+In rename mode it is the time from a pdf entering the pipeline until its
+CrossRef record is back.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from benchmarks.upstreams import SERVICES, fakeUpstreams, install, make_pdf
+
+TARGETS = ("main", "per_note", "rename")
+# share of DOIs, arxiv ids and biorxiv ids among the synthetic references
+ID_MIX = (("doi", 0.6), ("arxiv", 0.3), ("biorxiv", 0.1))
+
+
+def paper_id(kind, number):
+    if kind == "doi":
+        return "10.5555/bench.{}".format(number)
+    if kind == "arxiv":
+        return "21{:02d}.{:05d}".format(1 + number // 100000 % 12, number % 100000)
+    return "10.1101/2021.01.01.{:06d}".format(number)
+
+
+def make_vault(root, notes, refs_per_note, unique_ratio=0.5, pdf_ratio=0.25, seed=0):
+    """Write ``notes`` notes citing ``refs_per_note`` papers each.
+
+    The papers are drawn from a pool of ``notes * refs_per_note * unique_ratio``
+    papers, so popular papers are cited by several notes. ``pdf_ratio`` of
+    the DOI and arxiv references ask for the pdf (``- {{id}}``).
+
+    Returns:
+        A tuple (note paths, number of unique papers cited).
+    """
+    rand = random.Random(seed)
+    pool_size = max(1, int(notes * refs_per_note * unique_ratio))
+    kinds = [kind for kind, _ in ID_MIX]
+    weights = [weight for _, weight in ID_MIX]
+    pool = [paper_id(rand.choices(kinds, weights)[0], number) for number in range(pool_size)]
+    wants_pdf = {pid: not pid.startswith("10.1101/") and rand.random() < pdf_ratio for pid in pool}
+
+    paths = []
+    cited = set()
+    for i in range(notes):
+        folder = os.path.join(root, "topic{:03d}".format(i // 100))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        lines = ["# Note {}".format(i), "", "Some thoughts about the papers below.", ""]
+        for pid in rand.sample(pool, min(refs_per_note, pool_size)):
+            cited.add(pid)
+            lines.append("- {{{{{}}}}}".format(pid) if wants_pdf[pid] else "- {{{}}}".format(pid))
+        path = os.path.join(folder, "note{:05d}.md".format(i))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        paths.append(path)
+    return paths, len(cited)
+
+
+def make_pdf_folder(root, count, pdf_size, folders=1):
+    """Write ``count`` pdfs whose first page shows a DOI, as downloaded papers do,
+    spread over ``folders`` subfolders when there is more than one."""
+    for i in range(count):
+        folder = os.path.join(root, "folder{:03d}".format(i % folders)) if folders > 1 else root
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, "download{:05d}.pdf".format(i)), "wb") as f:
+            f.write(make_pdf("doi: {}".format(paper_id("doi", i)), size=pdf_size))
+
+
+class latencyRecorder(object):
+    """Accumulates the seconds spent on each paper across the pipeline stages."""
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add(self, keys, seconds):
+        keys = list(keys)
+        if not keys:
+            return
+        with self._lock:
+            for key in keys:
+                self.seconds[key] += seconds / len(keys)
+
+    def timed(self, func, keys_of):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(keys_of(*args, **kwargs), time.perf_counter() - start)
+        return wrapper
+
+
+def percentile(values, q):
+    """Nearest-rank percentile, ``q`` in [0, 100]."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(1, int(round(q / 100.0 * len(values) + 0.5)))
+    return values[min(rank, len(values)) - 1]
+
+
+def peak_rss_mb():
+    scale = 1024.0 if sys.platform != "darwin" else 1.0
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return self_rss / 2 ** 20, children_rss / 2 ** 20
+
+
+def instrument_vault(recorder):
+    from md_paper import downloads, utils
+
+    downloads.prefetch_paper_infos = recorder.timed(
+        downloads.prefetch_paper_infos, lambda paper_ids, *args, **kwargs: dict.fromkeys(paper_ids))
+    downloads.get_paper_info_from_paperid = recorder.timed(
+        downloads.get_paper_info_from_paperid, lambda pid, *args, **kwargs: [pid])
+    utils.fetch_pdf = recorder.timed(
+        utils.fetch_pdf, lambda pid, *args, **kwargs: [pid])
+
+
+def instrument_renamer(recorder):
+    from md_paper import renamer
+
+    run_rename_pipeline = renamer.run_rename_pipeline
+
+    def timed_pipeline(pdf_paths, *args, **kwargs):
+        entered = {}
+
+        def stamped():
+            for name, pdf_path in pdf_paths:
+                entered[pdf_path] = time.perf_counter()
+                yield name, pdf_path
+
+        for item in run_rename_pipeline(stamped(), *args, **kwargs):
+            recorder.add([item[1]], time.perf_counter() - entered[item[1]])
+            yield item
+
+    renamer.run_rename_pipeline = timed_pipeline
+
+
+def run_target(target, base_url, workdir, notes, options):
+    """Run one target in this (fresh) process and return its measurements."""
+    os.environ["XDG_CACHE_HOME"] = os.path.join(workdir, "cache")
+    if not options["verbose"]:
+        # module loggers and progress bars bind sys.stderr when created
+        sys.stderr = open(os.devnull, "w")
+        logging.disable(logging.CRITICAL)
+
+    from md_paper import arxiv, cache, md_paper, renamer, tokenizer, utils
+
+    install(base_url)
+    arxiv.ARXIV_DELAY = options["arxiv_delay"]
+    recorder = latencyRecorder()
+    pdfs_path = os.path.join(workdir, "pdfs")
+
+    if target == "rename":
+        pdf_dir = os.path.join(workdir, "downloads")
+        make_pdf_folder(pdf_dir, notes, options["pdf_size"], options["pdf_folders"])
+        papers = notes
+        instrument_renamer(recorder)
+    else:
+        vault = os.path.join(workdir, "vault")
+        note_paths, papers = make_vault(vault, notes, options["refs"], options["unique_ratio"],
+                                        options["pdf_ratio"], options["seed"])
+        instrument_vault(recorder)
+
+    runs = 2 if options["warm"] else 1
+    for _ in range(runs):
+        recorder.seconds.clear()
+        start = time.perf_counter()
+        if target == "main":
+            sys.argv = ["md-paper", "-i", vault, "-o", pdfs_path, "-w", str(options["workers"])]
+            md_paper.main()
+        elif target == "per_note":
+            metadata = cache.metadataCache()
+            for note_path in note_paths:
+                with open(note_path, "r", encoding="utf-8") as f:
+                    m = tokenizer.tokenize(f.read())
+                utils.get_vault_update_contents([(note_path, m)], pdfs_path, None, cache=metadata,
+                                                workers=options["workers"])
+            metadata.close()
+        else:
+            renamer.rename_pdfs_in_directory(pdf_dir, os.path.join(workdir, "renamed.md"),
+                                             processes=options["processes"],
+                                             recursive=options["pdf_folders"] > 1)
+        seconds = time.perf_counter() - start
+
+    latencies = list(recorder.seconds.values())
+    self_rss, children_rss = peak_rss_mb()
+    return {
+        "target": target,
+        "notes": notes,
+        "papers": papers,
+        "seconds": seconds,
+        "papers_per_second": papers / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_mb": self_rss,
+        "children_peak_rss_mb": children_rss,
+    }
+
+
+def set_args(argv=None):
+    parser = argparse.ArgumentParser(description="md-paper end-to-end benchmark")
+    parser.add_argument("--notes", type=int, nargs="+", default=[10, 100, 1000],
+                        help="Vault sizes to run, 10 to 10000 notes. Default: 10 100 1000")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=list(TARGETS))
+    parser.add_argument("--refs", type=int, default=8, help="References per note. Default: 8")
+    parser.add_argument("--unique-ratio", type=float, default=0.5,
+                        help="Unique papers per reference, the rest are cited by several notes. Default: 0.5")
+    parser.add_argument("--pdf-ratio", type=float, default=0.25,
+                        help="Share of references asking for the pdf. Default: 0.25")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Seconds every upstream response is delayed. Default: 0.02")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of upstream requests answered with HTTP 503. Default: 0")
+    parser.add_argument("--service-latency", type=str, action="append", default=[],
+                        help="Latency of one service, e.g. arxiv=0.3. Repeatable.")
+    parser.add_argument("--pdf-size", type=int, default=256 * 1024,
+                        help="Size of every served pdf in bytes. Default: 262144")
+    parser.add_argument("--mirrors", type=int, default=3, help="Sci-hub mirrors listed. Default: 3")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="md-paper --workers. Default: 8")
+    parser.add_argument("--processes", type=int, default=None, help="Renamer processes. Default: CPU count")
+    parser.add_argument("--pdf-folders", type=int, default=1,
+                        help="Subfolders the renamer's pdfs are spread over, renamed with --recursive. Default: 1")
+    parser.add_argument("--arxiv-delay", type=float, default=0.0,
+                        help="Spacing between arXiv calls, the real client waits 3s. Default: 0")
+    parser.add_argument("--warm", action="store_true",
+                        help="Run every target twice and report the second, cached run.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this file.")
+    parser.add_argument("--verbose", action="store_true", help="Keep md-paper logging and progress bars.")
+    return parser.parse_args(argv)
+
+
+def service_latency(args):
+    if not args.service_latency:
+        return args.latency
+    latency = dict.fromkeys(SERVICES, args.latency)
+    for spec in args.service_latency:
+        service, _, seconds = spec.partition("=")
+        if service not in SERVICES:
+            raise SystemExit("unknown service {}, expected one of {}".format(service, ", ".join(SERVICES)))
+        latency[service] = float(seconds)
+    return latency
+
+
+ROW = "{:<20} {:>6} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}"
+
+
+def print_header():
+    header = ROW.format("target", "notes", "papers", "seconds", "papers/s",
+                        "p50 ms", "p99 ms", "RSS MB", "requests")
+    print(header)
+    print("-" * len(header))
+
+
+def print_result(r):
+    print(ROW.format(r["target"], r["notes"], r["papers"], "{:.2f}".format(r["seconds"]),
+                     "{:.1f}".format(r["papers_per_second"]), "{:.1f}".format(r["p50_ms"]),
+                     "{:.1f}".format(r["p99_ms"]), "{:.1f}".format(r["peak_rss_mb"]), r["requests"]),
+          flush=True)
+
+
+def main(argv=None):
+    args = set_args(argv)
+    options = dict(refs=args.refs, unique_ratio=args.unique_ratio, pdf_ratio=args.pdf_ratio,
+                   pdf_size=args.pdf_size, workers=args.workers, processes=args.processes,
+                   pdf_folders=args.pdf_folders,
+                   arxiv_delay=args.arxiv_delay, warm=args.warm, seed=args.seed, verbose=args.verbose)
+    upstreams = fakeUpstreams(latency=service_latency(args), error_rate=args.error_rate,
+                              pdf_size=args.pdf_size, mirrors=args.mirrors, seed=args.seed).start()
+    results = []
+    print_header()
+    try:
+        for notes in args.notes:
+            for target in args.targets:
+                before = sum(upstreams.hits.values())
+                with tempfile.TemporaryDirectory(prefix="md-paper-bench-") as workdir:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                        result = executor.submit(run_target, target, upstreams.base_url,
+                                                 workdir, notes, options).result()
+                result["requests"] = sum(upstreams.hits.values()) - before
+                results.append(result)
+                print_result(result)
+    finally:
+        upstreams.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results,
+                       "requests": dict(upstreams.hits), "errors": dict(upstreams.errors)}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Startup time of the md-paper command line.
+
+Every command runs ``--repeat`` times in a fresh interpreter. The wall time
+is the median, and ``python -X importtime`` shows what the run imported and
+how long each module took. Run from the repository root:
+
+    python -m benchmarks.bench_startup --repeat 20 --top 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# (label, arguments after the interpreter)
+COMMANDS = (
+    ("import", ["-c", "import md_paper.md_paper"]),
+    ("-h", ["-m", "md_paper.md_paper", "-h"]),
+    ("gc -h", ["-m", "md_paper.md_paper", "gc", "-h"]),
+)
+# third party packages only some code paths need
+HEAVY_MODULES = ("requests", "pypdf", "feedparser", "bs4", "tqdm", "unidecode", "httpx")
+
+
+def parse_importtime(stderr):
+    """Parse ``-X importtime`` output.
+
+    Returns:
+        A dict mapping module names to (self, cumulative) microseconds.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def run_command(args, repeat):
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    walls = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=False)
+        walls.append(time.perf_counter() - start)
+    traced = subprocess.run([sys.executable, "-X", "importtime"] + args, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=False)
+    return walls, parse_importtime(traced.stderr)
+
+
+def set_args(argv=None):
+    parser = argparse.ArgumentParser(description="md-paper startup benchmark")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per command. Default: 10")
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports listed per command. Default: 10")
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this file.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = set_args(argv)
+    results = []
+    for label, command in COMMANDS:
+        walls, modules = run_command(command, args.repeat)
+        heavy = [name for name in HEAVY_MODULES if name in modules]
+        total_us = sum(self_us for self_us, _ in modules.values())
+        result = {
+            "command": label,
+            "median_ms": statistics.median(walls) * 1000,
+            "min_ms": min(walls) * 1000,
+            "import_ms": total_us / 1000.0,
+            "modules": len(modules),
+            "heavy_modules": heavy,
+            "slowest": sorted(((name, cumulative) for name, (_, cumulative) in modules.items()),
+                              key=lambda item: -item[1])[:args.top],
+        }
+        results.append(result)
+
+        print("{}: median {:.1f} ms, min {:.1f} ms, {} modules imported in {:.1f} ms".format(
+            label, result["median_ms"], result["min_ms"], result["modules"], result["import_ms"]))
+        print("  heavy modules: {}".format(", ".join(heavy) or "none"))
+        for name, cumulative in result["slowest"]:
+            print("  {:>9.1f} ms  {}".format(cumulative / 1000.0, name))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Reference scanning of one large note: md_paper.tokenizer against the
+regex path it replaced.
+
+The legacy path is what md-paper did before: ``re.findall`` with the greedy
+``- \\{.{3,}\\}`` pattern, splitting every match by hand for its id and pdf
+flag, classifying the id with up to four ``re.match`` calls and rewriting
+the note with a second regex pass. The tokenizer does it in one pass and
+skips fenced code blocks. Run from the repository root:
+
+    python -m benchmarks.bench_tokenizer --size-mb 1 --repeat 20
+"""
+import argparse
+import json
+import random
+import re
+import statistics
+import time
+
+from md_paper.tokenizer import NOT_CORRECT_MARK, rewrite, tokenize
+
+LEGACY_RULE = r"- \{.{3,}\}"
+LEGACY_PATTERN = re.compile(LEGACY_RULE)
+LEGACY_MARKED_PATTERN = re.compile("(?:" + LEGACY_RULE + ")(?P<mark>(?:" + re.escape(NOT_CORRECT_MARK) + ")*)")
+
+
+def legacy_classify(identifier):
+    if re.match(r'10\.(?!1101)[0-9]{4}/\.*', identifier):
+        return 'doi'
+    elif re.match(r'10\.1101/\.*', identifier):
+        return "medbiorxivId"
+    elif re.match(r'[0-9]{2}[0-1][0-9]\.[0-9]{3,}.*', identifier) or re.match(r'.*/[0-9]{2}[0-1][0-9]{4}', identifier):
+        return 'arxivId'
+    return "unrecognized"
+
+
+def legacy_scan(content):
+    refs = []
+    for literature in LEGACY_PATTERN.findall(content):
+        paper_id = literature.split('{')[-1].split('}')[0]
+        refs.append((literature, paper_id, legacy_classify(paper_id), literature.endswith("}}")))
+    return refs
+
+
+def legacy_rewrite(content, replace_dict):
+    def replace_(value):
+        match = value.group()[:value.start("mark") - value.start()]
+        if match in replace_dict:
+            return replace_dict[match]
+        return match + NOT_CORRECT_MARK
+    return LEGACY_MARKED_PATTERN.sub(replace_, content)
+
+
+def make_note(size, seed=0):
+    """A note of about ``size`` bytes: prose, references of every id type,
+    rendered entries and code blocks quoting the reference syntax."""
+    rng = random.Random(seed)
+    words = ("paper", "model", "results", "we", "show", "that", "the", "method", "improves", "on",
+             "baseline", "data", "for", "training", "see", "also", "section", "and")
+    ids = ("10.1038/s41586-{:03d}-{:04d}", "10.1101/2022.07.28.2227{:02d}{:02d}", "2208.{:02d}{:03d}",
+           "hep-th/99{:02d}{:03d}")
+    parts = []
+    total = 0
+    while total < size:
+        kind = rng.random()
+        if kind < 0.5:
+            chunk = " ".join(rng.choice(words) for _ in range(rng.randint(20, 80))) + ".\n\n"
+        elif kind < 0.8:
+            lines = []
+            for _ in range(rng.randint(1, 6)):
+                paper_id = rng.choice(ids).format(rng.randint(0, 99), rng.randint(0, 999))
+                pattern = "- {{{{{}}}}}" if rng.random() < 0.3 else "- {{{}}}"
+                lines.append(pattern.format(paper_id))
+            chunk = "\n".join(lines) + "\n\n"
+        elif kind < 0.95:
+            chunk = ("- **Synthetic paper {0}**. Author First et.al. **JOB**, **2015-1-1** "
+                     "([link](https://doi.org/10.5555/bench.{0})). (citations: {0})\n").format(rng.randint(0, 9999))
+        else:
+            chunk = "```markdown\n- {10.1000/example}\n- {{2101.00001}}\n```\n\n"
+        parts.append(chunk)
+        total += len(chunk)
+    return "".join(parts)
+
+
+def timed(func, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    return result, seconds
+
+
+def set_args(argv=None):
+    parser = argparse.ArgumentParser(description="md-paper reference tokenizer benchmark")
+    parser.add_argument("--size-mb", type=float, default=1.0, help="Size of the note in MB. Default: 1")
+    parser.add_argument("--repeat", type=int, default=20, help="Runs per path. Default: 20")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated note. Default: 0")
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this file.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = set_args(argv)
+    content = make_note(int(args.size_mb * 1024 * 1024), args.seed)
+
+    legacy_refs, scan_legacy = timed(lambda: legacy_scan(content), args.repeat)
+    refs, scan_new = timed(lambda: tokenize(content), args.repeat)
+    # render every other distinct reference, the rest gets marked
+    replace_dict = dict((ref.text, "- **Rendered {}**".format(ref.paper_id)) for ref in refs[::2])
+    _, rewrite_legacy = timed(lambda: legacy_rewrite(content, replace_dict), args.repeat)
+    _, rewrite_new = timed(lambda: rewrite(content, refs, replace_dict), args.repeat)
+
+    results = []
+    for path, found, scan, rewrite_seconds in (("legacy", len(legacy_refs), scan_legacy, rewrite_legacy),
+                                               ("tokenizer", len(refs), scan_new, rewrite_new)):
+        results.append({
+            "path": path,
+            "bytes": len(content),
+            "references": found,
+            "scan_ms": statistics.median(scan) * 1000,
+            "rewrite_ms": statistics.median(rewrite_seconds) * 1000,
+        })
+
+    print("{:<10} {:>10} {:>10} {:>10} {:>10}".format("path", "refs", "scan ms", "rewrite ms", "total ms"))
+    for result in results:
+        print("{:<10} {:>10} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            result["path"], result["references"], result["scan_ms"], result["rewrite_ms"],
+            result["scan_ms"] + result["rewrite_ms"]))
+    print("{:.2f} MB note, the legacy path also counts the references inside code blocks".format(
+        len(content) / 1024.0 / 1024.0))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
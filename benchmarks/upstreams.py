@@ -0,0 +1,288 @@
+"""Local stand-ins for the upstream services md-paper talks to.
+
+One threaded HTTP server answers for CrossRef (``works/{doi}`` and
+``works?filter=doi:``, with ETags), arXiv (``api/query``), bioRxiv/medRxiv
+(``details/{server}/{id}``), the sci-hub mirror list, the mirror pages and
+the pdfs themselves. Latency, error rate and pdf size are configurable, and
+``install()`` points the md_paper modules at the server.
+"""
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+SERVICES = ("crossref", "arxiv", "biorxiv", "scihub", "pdf")
+
+
+def make_pdf(text, info=None, size=0, content=None):
+    """Build a one page pdf showing ``text``, padded with a comment to about ``size`` bytes.
+
+    Args:
+        text (str): The page text, e.g. a DOI line the renamer finds.
+        info (str): An optional /Info dictionary, e.g. "<< /doi (10.5555/x) >>".
+        size (int): The minimum size of the pdf in bytes.
+        content (bytes): The page content stream, instead of one showing ``text``.
+
+    Returns:
+        The pdf bytes.
+    """
+    if content is None:
+        content = "BT /F1 12 Tf 72 720 Td ({}) Tj ET".format(text).encode("latin-1")
+    objs = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R"
+        b" /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length " + str(len(content)).encode() + b" >>\nstream\n" + content + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    if info:
+        objs.append(info.encode("latin-1"))
+
+    out = b"%PDF-1.4\n"
+    padding = size - 1024
+    if padding > 0:
+        line = b"%" + b"x" * 78 + b"\n"
+        out += line * (padding // len(line))
+    offsets = []
+    for i, obj in enumerate(objs):
+        offsets.append(len(out))
+        out += "{} 0 obj\n".format(i + 1).encode() + obj + b"\nendobj\n"
+    xref = len(out)
+    out += "xref\n0 {}\n0000000000 65535 f \n".format(len(objs) + 1).encode()
+    out += b"".join("{:010d} 00000 n \n".format(offset).encode() for offset in offsets)
+    trailer = "trailer\n<< /Size {} /Root 1 0 R".format(len(objs) + 1)
+    if info:
+        trailer += " /Info {} 0 R".format(len(objs))
+    trailer += " >>\nstartxref\n{}\n%%EOF\n".format(xref)
+    return out + trailer.encode()
+
+
+def crossref_work(doi, base_url):
+    """A CrossRef work record with every field crossrefInfo reads."""
+    number = doi.rsplit(".", 1)[-1]
+    return {
+        "DOI": doi,
+        "title": ["Synthetic paper {}".format(number)],
+        "published": {"date-parts": [[2000 + len(doi) % 25, 1, 1]]},
+        "author": [{"family": "Author", "given": "First"}, {"family": "Writer", "given": "Second"}],
+        "container-title": ["Journal of Benchmarks (JOB)"],
+        "short-container-title": [],
+        "type": "journal-article",
+        "URL": "https://doi.org/" + doi,
+        "link": [{"URL": "{}/pdf/{}.pdf".format(base_url, quote(doi))}],
+        "is-referenced-by-count": len(doi),
+    }
+
+
+def arxiv_entry(arxiv_id, base_url):
+    """An Atom entry, ids with an even last digit carry a DOI like published preprints."""
+    doi = ""
+    if arxiv_id[-1] in "02468":
+        doi = "<arxiv:doi>10.5555/arxiv.{}</arxiv:doi>".format(arxiv_id)
+    return (
+        "<entry>"
+        "<id>http://arxiv.org/abs/{id}v1</id>"
+        "<title>Synthetic preprint {id}</title>"
+        "<published>2021-01-01T00:00:00Z</published>"
+        "<author><name>First Author</name></author>"
+        "<author><name>Second Writer</name></author>"
+        "<link href=\"{base}/arxiv/abs/{id}\" rel=\"alternate\" type=\"text/html\"/>"
+        "{doi}"
+        "</entry>").format(id=arxiv_id, base=base_url, doi=doi)
+
+
+def arxiv_feed(entries):
+    return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+            "<feed xmlns=\"http://www.w3.org/2005/Atom\" xmlns:arxiv=\"http://arxiv.org/schemas/atom\">"
+            "<title>arXiv Query</title>{}</feed>").format("".join(entries))
+
+
+def biorxiv_item(bmrxivid, server):
+    """A bioRxiv details record, ids with an odd last digit were published in a journal."""
+    published = "NA"
+    if bmrxivid[-1] in "13579":
+        published = "10.5555/biorxiv." + bmrxivid.rsplit(".", 1)[-1]
+    return {
+        "doi": bmrxivid,
+        "title": "Synthetic {} preprint {}".format(server, bmrxivid),
+        "authors": "Author, F.; Writer, S.",
+        "date": "2021-01-01",
+        "server": server,
+        "published": published,
+    }
+
+
+def install(base_url):
+    """Point the md_paper modules at the fake upstreams listening on ``base_url``."""
+    from md_paper import arxiv, crossref, medbiorxiv, pdfs
+
+    crossref.CROSSREF_API = base_url + "/crossref/"
+    arxiv.ARXIV_API = base_url + "/arxiv/api/query"
+    medbiorxiv.BMXIV_API = base_url + "/biorxiv/details/"
+    pdfs.SCIHUB_LIST_URL = base_url + "/scihub-list/"
+
+
+class fakeUpstreams(object):
+    """Local HTTP server mimicking CrossRef, arXiv, bioRxiv and sci-hub.
+
+    Args:
+        latency (float or dict): Seconds every response is delayed, or a dict
+            mapping service names (see SERVICES) to delays.
+        error_rate (float or dict): Fraction of requests answered with HTTP 503,
+            or a dict mapping service names to fractions.
+        pdf_size (int): Size of every served pdf in bytes.
+        mirrors (int): The number of sci-hub mirrors listed.
+        seed (int): Seed of the error draws, runs with the same seed fail alike.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, pdf_size=256 * 1024, mirrors=3, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.pdf_size = pdf_size
+        self.mirrors = mirrors
+        self.hits = Counter()
+        self.errors = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def _setting(self, value, service):
+        if isinstance(value, dict):
+            return value.get(service, 0)
+        return value
+
+    def admit(self, service):
+        """Count a request, apply the latency and decide whether it fails."""
+        with self._lock:
+            self.hits[service] += 1
+            failed = self._random.random() < self._setting(self.error_rate, service)
+            if failed:
+                self.errors[service] += 1
+        delay = self._setting(self.latency, service)
+        if delay:
+            time.sleep(delay)
+        return not failed
+
+    def mirror_urls(self):
+        return ["{}/sci-hub.mirror{}".format(self.base_url, i) for i in range(self.mirrors)]
+
+    def start(self):
+        handler = type("handler", (upstreamHandler,), {"upstreams": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def install(self):
+        """Point the md_paper modules of this process at the server."""
+        install(self.base_url)
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class upstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    upstreams = None
+
+    def setup(self):
+        super(upstreamHandler, self).setup()
+        # headers and body are two writes, Nagle would hold the body back
+        # until the client's delayed ACK on every keep-alive response
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", etag=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _unavailable(self):
+        self._send(503, "Service Unavailable", "text/plain")
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        query = parse_qs(url.query)
+        base_url = self.upstreams.base_url
+
+        if path.startswith("/crossref/works"):
+            if not self.upstreams.admit("crossref"):
+                return self._unavailable()
+            if path == "/crossref/works":
+                dois = [value[len("doi:"):] for value in query.get("filter", [""])[0].split(",")
+                        if value.startswith("doi:")]
+                message = {"items": [crossref_work(doi, base_url) for doi in dois]}
+            else:
+                message = crossref_work(path[len("/crossref/works/"):], base_url)
+            body = json.dumps({"status": "ok", "message": message})
+            etag = '"{}"'.format(hashlib.sha1(body.encode("utf-8")).hexdigest())
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, b"", etag=etag)
+            return self._send(200, body, etag=etag)
+
+        if path == "/arxiv/api/query":
+            if not self.upstreams.admit("arxiv"):
+                return self._unavailable()
+            if "id_list" in query:
+                ids = query["id_list"][0].split(",")
+            else:
+                ids = [query.get("search_query", ["id:"])[0][len("id:"):]]
+            entries = [arxiv_entry(arxiv_id, base_url) for arxiv_id in ids if arxiv_id]
+            return self._send(200, arxiv_feed(entries), "application/atom+xml")
+
+        if path.startswith("/biorxiv/details/"):
+            if not self.upstreams.admit("biorxiv"):
+                return self._unavailable()
+            server, _, bmrxivid = path[len("/biorxiv/details/"):].partition("/")
+            # every synthetic preprint lives on bioRxiv, medRxiv knows none
+            collection = [biorxiv_item(bmrxivid, server)] if server == "biorxiv" else []
+            return self._send(200, json.dumps({"messages": [{"status": "ok"}], "collection": collection}))
+
+        if path == "/scihub-list/":
+            if not self.upstreams.admit("scihub"):
+                return self._unavailable()
+            links = "".join("<p><a href=\"{0}\">{0}</a></p>".format(mirror)
+                            for mirror in self.upstreams.mirror_urls())
+            return self._send(200, "<html><body><div class=\"entry-content\">{}</div></body></html>".format(links),
+                              "text/html")
+
+        if path.startswith("/sci-hub.mirror"):
+            if not self.upstreams.admit("scihub"):
+                return self._unavailable()
+            identifier = path.split("/", 2)[-1]
+            page = "<html><body><iframe src=\"{}/pdf/{}.pdf\"></iframe></body></html>".format(
+                base_url, quote(identifier))
+            return self._send(200, page, "text/html")
+
+        if path.startswith("/pdf/") or path.startswith("/arxiv/pdf/"):
+            if not self.upstreams.admit("pdf"):
+                return self._unavailable()
+            paper_id = path.split("/pdf/", 1)[-1][:-len(".pdf")]
+            pdf = make_pdf("doi: " + paper_id, size=self.upstreams.pdf_size)
+            return self._send(200, pdf, "application/pdf")
+
+        self._send(404, "Resource not found.", "text/plain")
@@ -1,4 +1,7 @@
 import logging
+import re
+import threading
+import time
 from urllib.request import ProxyHandler
 import feedparser
 try:
@@ -8,16 +11,58 @@ except ImportError:
 from unidecode import unidecode
 
 from .crossref import crossrefInfo
+from .clients import get_session
 
 
 logging.basicConfig()
 logger = logging.getLogger('arxiv')
 logger.setLevel(logging.DEBUG)
-HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:27.0) Gecko/20100101 Firefox/27.0'}
+
+ARXIV_API = "http://export.arxiv.org/api/query"
+# arXiv asks API clients to wait 3 seconds between two calls.
+ARXIV_DELAY = 3.0
+ARXIV_BATCH_SIZE = 50
+_VERSION = re.compile(r"v[0-9]+$")
+
+_spacing_lock = threading.Lock()
+_last_call = [0.0]
+
+
+def wait_turn(delay=None):
+    """Block until the arXiv rate limit spacing allows the next call."""
+    delay = ARXIV_DELAY if delay is None else delay
+    with _spacing_lock:
+        wait = _last_call[0] + delay - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        _last_call[0] = time.time()
+
+
+def normalize_arxivid(arxivId):
+    """Strip the url prefix and version of an arxiv id, e.g.
+    http://arxiv.org/abs/2208.05623v1 -> 2208.05623"""
+    arxivId = arxivId.strip()
+    for prefix in ("http://arxiv.org/abs/", "https://arxiv.org/abs/", "arxiv:", "arXiv:"):
+        if arxivId.startswith(prefix):
+            arxivId = arxivId[len(prefix):]
+    return _VERSION.sub("", arxivId).lower()
+
 
 class arxivInfo(object):
     def __init__(self):
-        self.base_url = "http://export.arxiv.org/api/query"
+        self.sess = get_session()
+        self.base_url = ARXIV_API
+    
+    def set_proxy(self, proxy=None):
+        """set proxy for session
+        
+        Args:
+            proxy (str): The proxy adress. e.g 127.0.0.1:7890
+        Returns:
+            None
+        """
+        if proxy:
+            self.sess = get_session(proxy)
     
     def set_proxy_handler(self, proxy):
         """set proxy handler
@@ -77,7 +122,7 @@ class arxivInfo(object):
         
         Args:
             doi (str): The arxiv Id
-            handler (handler object): use proxy
+            handler (handler object): use the proxy of this handler instead of the session one
             
         Returns:
             A dict containing the paper information. 
@@ -93,11 +138,13 @@ class arxivInfo(object):
         
         params = "?search_query=id:"+quote(unidecode(arxivId))
         
+        if handler:
+            self.set_proxy(proxy=handler.proxies["http"].split('//')[-1])
+        
         try:
-            if handler:
-                result = feedparser.parse(self.base_url + params, handlers=[handler])
-            else:
-                result = feedparser.parse(self.base_url  + params)
+            wait_turn()
+            r = self.sess.get(self.base_url + params)
+            result = feedparser.parse(r.content)
             items = result.entries
 
             item = items[0]
@@ -105,19 +152,87 @@ class arxivInfo(object):
                 doi = item["arxiv_doi"]
                 
                 crossref_info = crossrefInfo()
-                if handler:
-                    crossref_info.set_proxy(proxy=handler.proxies["http"].split('//')[-1])
+                crossref_info.sess = self.sess
                 return crossref_info.get_info_by_doi(doi)
             else:
                 return self.extract_json_info(item)
         except:
             logger.error("DOI: {} is error.".format(arxivId))
+
+
+    def get_info_by_arxivids(self, arxivIds, batch_size=ARXIV_BATCH_SIZE):
+        """Get the meta information of many arxiv ids with batched id_list queries.
+        
+        Args:
+            arxivIds (list): The arxiv Ids
+            batch_size (int): The number of ids per query
+            
+        Returns:
+            A dict mapping every given arxiv Id to its paper information
+            (the same dict get_info_by_arxivid returns). Ids that could not
+            be resolved are missing.
+        """
+        infos = {}
+        wanted = {}
+        for arxivId in arxivIds:
+            wanted.setdefault(normalize_arxivid(arxivId), []).append(arxivId)
+        keys = list(wanted)
+        dois = {}
+
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            id_list = ",".join(quote(unidecode(wanted[key][0])) for key in batch)
+            params = "?id_list={}&max_results={}".format(id_list, len(batch))
+            try:
+                wait_turn()
+                r = self.sess.get(self.base_url + params)
+                entries = feedparser.parse(r.content).entries
+            except Exception:
+                logger.error("arXiv batch query failed for {} ids".format(len(batch)))
+                continue
+
+            for item in entries:
+                key = normalize_arxivid(item.get("id", ""))
+                if key not in wanted or not item.get("title"):
+                    continue
+                if "arxiv_doi" in item:
+                    dois[key] = item["arxiv_doi"]
+                    continue
+                try:
+                    bib = self.extract_json_info(item)
+                except Exception:
+                    logger.error("DOI: {} is error.".format(wanted[key][0]))
+                    continue
+                for arxivId in wanted[key]:
+                    infos[arxivId] = bib
+
+        if dois:
+            crossref_info = crossrefInfo()
+            crossref_info.sess = self.sess
+            doi_bibs = crossref_info.get_info_by_dois(list(dois.values()))
+            for key, doi in dois.items():
+                if doi in doi_bibs:
+                    for arxivId in wanted[key]:
+                        infos[arxivId] = doi_bibs[doi]
+
+        # a malformed id makes arXiv reject its whole batch, fall back to
+        # single queries for whatever the batches did not answer
+        for key in keys:
+            if key in dois or wanted[key][0] in infos:
+                continue
+            bib = self.get_info_by_arxivid(wanted[key][0])
+            if bib:
+                for arxivId in wanted[key]:
+                    infos[arxivId] = bib
+
+        return infos
+
             
 if __name__ == "__main__":
     arxivId = "2208.05623"
     
     arxiv_info = arxivInfo()
-    arxiv_info.set_proxy_handler(proxy="127.0.0.1:7890")
+    arxiv_info.set_proxy(proxy="127.0.0.1:7890")
     
     bib_arxiv = arxiv_info.get_info_by_arxivid(arxivId)
     
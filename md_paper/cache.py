@@ -0,0 +1,368 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logging.basicConfig()
+logger = logging.getLogger('cache')
+logger.setLevel(logging.INFO)
+
+DAY = 24 * 60 * 60
+
+# Titles, authors and venues practically never change once published, the
+# citation count does.
+DEFAULT_TTLS = {
+    "default": 180 * DAY,
+    "cited_count": 7 * DAY,
+}
+DEFAULT_MAX_ENTRIES = 50000
+EVICT_EVERY = 200
+# puts kept in memory before they are written in one transaction
+COMMIT_EVERY = 64
+
+
+def default_cache_dir():
+    """Return the directory md-paper keeps its persistent state in."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "md-paper")
+
+
+def normalize_identifier(paper_id):
+    """Normalize a paper id so that the same paper always maps to one key.
+
+    Args:
+        paper_id (str): DOI, arxiv id or biorxiv/medrxiv id as written in the note.
+
+    Returns:
+        The normalized identifier.
+    """
+    key = paper_id.strip()
+    for prefix in ("https://doi.org/", "http://doi.org/", "https://dx.doi.org/",
+                   "http://dx.doi.org/", "doi:", "arxiv:"):
+        if key.lower().startswith(prefix):
+            key = key[len(prefix):]
+            break
+    return key.strip().lower()
+
+
+def parse_ttls(specs):
+    """Parse ``field=days`` pairs given on the command line.
+
+    Args:
+        specs (list): e.g. ["cited_count=1", "default=365"]
+
+    Returns:
+        A dict mapping field names to TTLs in seconds.
+    """
+    ttls = dict(DEFAULT_TTLS)
+    for spec in specs or []:
+        field, _, days = spec.partition("=")
+        if not field or not days:
+            raise ValueError("TTL must look like field=days, got {}".format(spec))
+        ttls[field.strip()] = float(days) * DAY
+    return ttls
+
+
+class metadataCache(object):
+    """Persistent paper metadata cache backed by SQLite.
+
+    Every field of a bib dict carries its own fetch time, an entry is served
+    only while all of its non-empty fields are within their TTL.
+
+    Puts and access times are kept in memory and written together every
+    COMMIT_EVERY puts, by flush and at close, so no write transaction stays
+    open between calls to lock other md-paper processes out.
+    """
+    def __init__(self, path=None, ttls=None, max_entries=DEFAULT_MAX_ENTRIES):
+        if path is None:
+            path = os.path.join(default_cache_dir(), "metadata.sqlite")
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        # key -> (bib, fetched, accessed_at) not written yet
+        self._pending = {}
+        # key -> accessed_at of the entries served since the last flush
+        self._accessed = {}
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            " key TEXT PRIMARY KEY,"
+            " bib TEXT NOT NULL,"
+            " fetched TEXT NOT NULL,"
+            " accessed_at REAL NOT NULL)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed_at)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS validators ("
+            " url TEXT PRIMARY KEY,"
+            " etag TEXT,"
+            " last_modified TEXT,"
+            " body TEXT NOT NULL,"
+            " stored_at REAL NOT NULL)")
+        self.conn.commit()
+
+    def _ttl(self, field):
+        return self.ttls.get(field, self.ttls["default"])
+
+    def _expired(self, bib, fetched, now):
+        return set(field for field, value in bib.items()
+                   if value is not None and now - fetched.get(field, 0) > self._ttl(field))
+
+    def get(self, paper_id):
+        """Get the cached bib dict of ``paper_id``.
+
+        Returns:
+            A dict OR None when the entry is missing or any of its fields
+            expired, see get_stale to refresh single fields.
+        """
+        bib, expired = self.get_stale(paper_id)
+        return None if expired else bib
+
+    def get_stale(self, paper_id):
+        """Get the cached bib dict of ``paper_id`` along with its expired fields.
+
+        An entry whose citation count expired (after 7 days) still has its
+        other fields (kept for 180 days), the caller can refresh the count
+        alone and store it with update_field. Only an entry without expired
+        fields counts as a hit.
+
+        Returns:
+            A tuple (bib, expired field names), bib is None when the entry is missing.
+        """
+        key = normalize_identifier(paper_id)
+        now = time.time()
+        with self._lock:
+            row = self._pending.get(key)
+            if row is None:
+                row = self.conn.execute(
+                    "SELECT bib, fetched FROM metadata WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, set()
+            bib, fetched = json.loads(row[0]), json.loads(row[1])
+            expired = self._expired(bib, fetched, now)
+            if expired:
+                self.misses += 1
+            else:
+                self._accessed[key] = now
+                self.hits += 1
+        return bib, expired
+
+    def put(self, paper_id, bib):
+        """Store the bib dict of ``paper_id``, all fields are marked as fetched now."""
+        if not bib:
+            return
+        key = normalize_identifier(paper_id)
+        now = time.time()
+        fetched = {field: now for field in bib}
+        with self._lock:
+            self._pending[key] = (json.dumps(bib), json.dumps(fetched), now)
+            self._accessed.pop(key, None)
+            self._puts += 1
+            if len(self._pending) >= COMMIT_EVERY:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending and not self._accessed:
+            return
+        if self._pending:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO metadata (key, bib, fetched, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                [(key,) + row for key, row in self._pending.items()])
+        if self._accessed:
+            self.conn.executemany(
+                "UPDATE metadata SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._accessed.items()])
+        if self._puts >= EVICT_EVERY:
+            self._evict()
+            self._puts = 0
+        self._pending = {}
+        self._accessed = {}
+        self.conn.commit()
+
+    def flush(self):
+        """Write the pending puts and access times, e.g. between the updates of a long running process."""
+        with self._lock:
+            self._flush()
+            self.conn.commit()
+
+    def update_field(self, paper_id, field, value):
+        """Set one field of a cached entry and mark it as fetched now, the
+        other fields keep their fetch time. Missing entries are left missing.
+
+        Not committed until the cache is closed.
+        """
+        key = normalize_identifier(paper_id)
+        now = time.time()
+        with self._lock:
+            self._flush()
+            row = self.conn.execute(
+                "SELECT bib, fetched FROM metadata WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return
+            bib, fetched = json.loads(row[0]), json.loads(row[1])
+            bib[field] = value
+            fetched[field] = now
+            self.conn.execute(
+                "UPDATE metadata SET bib = ?, fetched = ? WHERE key = ?",
+                (json.dumps(bib), json.dumps(fetched), key))
+
+    def get_validator(self, url):
+        """The ETag, Last-Modified and body stored for a conditional request to ``url``.
+
+        Returns:
+            A tuple (etag, last_modified, body) OR None.
+        """
+        with self._lock:
+            return self.conn.execute(
+                "SELECT etag, last_modified, body FROM validators WHERE url = ?", (url,)).fetchone()
+
+    def put_validator(self, url, etag, last_modified, body):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO validators (url, etag, last_modified, body, stored_at) "
+                "VALUES (?, ?, ?, ?, ?)", (url, etag, last_modified, body, time.time()))
+
+    def _evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self.conn.execute(
+                "DELETE FROM metadata WHERE key IN ("
+                " SELECT key FROM metadata ORDER BY accessed_at LIMIT ?)", (overflow,))
+            logger.debug("Evicted {} cache entries".format(overflow))
+
+    def clear(self):
+        with self._lock:
+            self._pending = {}
+            self._accessed = {}
+            self.conn.execute("DELETE FROM metadata")
+            self.conn.execute("DELETE FROM validators")
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._evict()
+            self.conn.commit()
+            self.conn.close()
+        if self.hits or self.misses:
+            logger.info("Metadata cache: {} hits, {} misses".format(self.hits, self.misses))
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class pdfDoiCache(object):
+    """DOIs extracted from pdfs, keyed by content hash.
+
+    The path, size and mtime of each pdf are remembered as well, so a pdf
+    seen before costs a single stat. Pdfs without a DOI are remembered too
+    so they are not parsed again. Writes are committed every COMMIT_EVERY
+    pdfs, by flush and at close.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(default_cache_dir(), "renamer.sqlite")
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+
+        self.path = path
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " sha256 TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dois ("
+            " sha256 TEXT PRIMARY KEY,"
+            " doi TEXT)")
+        self.conn.commit()
+
+    def lookup(self, path, st):
+        """Look a pdf up by path, size and mtime only.
+
+        Returns:
+            A tuple (found, doi), doi is None for pdfs known to have no DOI.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT dois.doi FROM files JOIN dois ON files.sha256 = dois.sha256 "
+                "WHERE files.path = ? AND files.size = ? AND files.mtime_ns = ?",
+                (os.path.abspath(path), st.st_size, st.st_mtime_ns)).fetchone()
+        if row is None:
+            return False, None
+        return True, row[0]
+
+    def lookup_hash(self, sha256):
+        """Returns a tuple (found, doi) for a pdf content hash."""
+        with self._lock:
+            row = self.conn.execute("SELECT doi FROM dois WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is None:
+            return False, None
+        return True, row[0]
+
+    def store(self, path, sha256, doi):
+        st = os.stat(path)
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                (os.path.abspath(path), st.st_size, st.st_mtime_ns, sha256))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dois (sha256, doi) VALUES (?, ?)", (sha256, doi))
+            self._wrote()
+
+    def _wrote(self):
+        self._writes += 1
+        if self._writes >= COMMIT_EVERY:
+            self.conn.commit()
+            self._writes = 0
+
+    def flush(self):
+        with self._lock:
+            self.conn.commit()
+            self._writes = 0
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM files")
+            self.conn.execute("DELETE FROM dois")
+            self.conn.commit()
+
+    def moved(self, old_path, new_path):
+        """Follow a renamed pdf, a rename keeps its size and mtime."""
+        with self._lock:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(new_path),))
+            self.conn.execute(
+                "UPDATE files SET path = ? WHERE path = ?",
+                (os.path.abspath(new_path), os.path.abspath(old_path)))
+            self._wrote()
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,117 @@
+import logging
+import os
+import re
+
+from .fileio import atomic_write, read_note
+from .metrics import phase
+from .refindex import DOI_PATTERN, RESOLVED, normalize_doi
+
+logging.basicConfig()
+logger = logging.getLogger('citations')
+logger.setLevel(logging.INFO)
+
+# the suffix render_literature and the renamer write after an entry
+CITATIONS_PATTERN = re.compile(r"\(citations: (\d+)\)")
+
+
+def rewrite_counts(content, lines, counts):
+    """Replace the citation counts of rendered entries, leaving every other character as it is.
+
+    Args:
+        content (str): The note content.
+        lines (iterable): Line numbers (from 0) of the rendered entries.
+        counts (dict): Maps lower case DOIs to their citation count.
+
+    Returns:
+        A tuple (new content, number of counts changed).
+    """
+    note_lines = content.splitlines(True)
+    changed = 0
+    for number in sorted(set(lines)):
+        if number >= len(note_lines):
+            continue
+        line = note_lines[number]
+        doi = DOI_PATTERN.search(line)
+        suffixes = list(CITATIONS_PATTERN.finditer(line))
+        if doi is None or not suffixes:
+            continue
+        suffix = suffixes[-1]
+        count = counts.get(normalize_doi(doi.group()))
+        if count is None or str(count) == suffix.group(1):
+            continue
+        note_lines[number] = line[:suffix.start(1)] + str(count) + line[suffix.end(1):]
+        changed += 1
+    return "".join(note_lines), changed
+
+
+def refresh_citations(note_paths, proxy=None, cache=None, index=None):
+    """Refresh the citation counts of the rendered entries of notes.
+
+    The reference index tells which notes have rendered entries and on which
+    lines, so notes without any are not read. The counts of all DOIs are
+    fetched together, with conditional requests when a cache keeps the
+    validators of earlier refreshes, and only the numbers are rewritten.
+
+    Args:
+        note_paths (list): The notes.
+        proxy (str): The proxy.
+        cache (metadataCache): Keeps ETags and gets the new counts.
+        index (referenceIndex): The reference index of the notes.
+
+    Returns:
+        The number of citation counts changed.
+    """
+    from .crossref import crossrefInfo
+
+    for note_path in note_paths:
+        index.refresh(note_path)
+    entries = {}
+    for identifier, path, line, _, state in index.lookup(states=[RESOLVED]):
+        if DOI_PATTERN.match(identifier):
+            entries.setdefault(path, set()).add(line)
+    wanted = set(os.path.abspath(note_path) for note_path in note_paths)
+    entries = dict((path, lines) for path, lines in entries.items() if path in wanted)
+    if not entries:
+        logger.info("No rendered entries found, nothing to refresh")
+        return 0
+
+    dois = set()
+    notes = []
+    for path, lines in sorted(entries.items()):
+        content, mtime_ns = read_note(path)
+        note_lines = content.splitlines()
+        for number in lines:
+            if number >= len(note_lines) or not CITATIONS_PATTERN.search(note_lines[number]):
+                continue
+            # the note may have changed since it was indexed
+            doi = DOI_PATTERN.search(note_lines[number])
+            if doi is not None:
+                dois.add(normalize_doi(doi.group()))
+        notes.append((path, content, mtime_ns, lines))
+
+    client = crossrefInfo()
+    client.set_proxy(proxy)
+    with phase("crossref"):
+        counts, not_modified = client.get_cited_counts(sorted(dois), validators=cache)
+    logger.info("Fetched citation counts of {} of {} DOIs ({} queries not modified)".format(
+        len(counts), len(dois), not_modified))
+
+    changed = 0
+    updated = 0
+    for path, content, mtime_ns, lines in notes:
+        new_content, note_changed = rewrite_counts(content, lines, counts)
+        if not note_changed:
+            continue
+        if not atomic_write(path, new_content, expected_mtime_ns=mtime_ns):
+            logger.warning("{} changed during the refresh, its counts were not updated".format(path))
+            continue
+        index.update(path, new_content)
+        changed += note_changed
+        updated += 1
+    index.commit()
+
+    if cache is not None:
+        for doi, count in counts.items():
+            cache.update_field(doi, "cited_count", count)
+    logger.info("Updated {} citation counts in {} notes".format(changed, updated))
+    return changed
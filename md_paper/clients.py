@@ -0,0 +1,270 @@
+import logging
+import threading
+import time
+import weakref
+from contextlib import ExitStack
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import error_class, record_request
+from .throttle import (MAX_RETRIES, MAX_RETRY_AFTER, RETRY_STATUSES, THROTTLE_STATUSES,
+                       backoff_delay, host_slot, parse_retry_after)
+
+logging.basicConfig()
+logger = logging.getLogger('clients')
+logger.setLevel(logging.INFO)
+HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:27.0) Gecko/20100101 Firefox/27.0'}
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10, 60)
+POOL_SIZE = 16
+
+
+def _record_response(url, start, r, stream):
+    """Count a response in the per host metrics, streamed bodies by their
+    Content-Length."""
+    if stream:
+        nbytes = int(r.headers.get("Content-Length") or 0)
+    else:
+        nbytes = len(r.content)
+    error = "HTTP {}".format(r.status_code) if r.status_code >= 400 else None
+    record_request(url, time.time() - start, nbytes, error)
+
+
+def _release_on_close(r, slot):
+    """Keep the host slot of a streamed response until it is closed, or collected unclosed."""
+    close = r.close
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            slot.close()
+
+    r.close = close_and_release
+    weakref.finalize(r, slot.close)
+
+
+def send_with_retries(url, send, stream=False, retries=MAX_RETRIES, retry_exceptions=()):
+    """Send a request within the host's slot, retrying transient failures.
+
+    Connection errors, timeouts and 429/5xx responses are retried up to
+    ``retries`` times after the server's Retry-After or a jittered
+    exponential backoff. Throttling responses shrink the host's window.
+
+    Args:
+        url (str): The request url, selects the host controller.
+        send (callable): Sends the request once and returns the response.
+        stream (bool): Whether the body is streamed, the slot of a streamed
+            response is held until the response is closed.
+        retries (int): The number of retries.
+        retry_exceptions (tuple): Exception classes worth a retry.
+
+    Returns:
+        The last response, raises the last exception when every attempt failed.
+    """
+    for attempt in range(retries + 1):
+        with ExitStack() as stack:
+            controller = stack.enter_context(host_slot(url))
+            start = time.time()
+            try:
+                r = send()
+            except retry_exceptions as exc:
+                record_request(url, time.time() - start, error=error_class(exc))
+                if attempt == retries:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.debug("{} for {}, retrying in {:.1f}s".format(error_class(exc), url, delay))
+                time.sleep(delay)
+                continue
+            except Exception as exc:
+                record_request(url, time.time() - start, error=error_class(exc))
+                raise
+            controller.observe(r.headers)
+            if stream:
+                # the body is read after this returns
+                _release_on_close(r, stack.pop_all())
+        _record_response(url, start, r, stream)
+
+        if r.status_code not in RETRY_STATUSES:
+            controller.on_success()
+            return r
+        retry_after = parse_retry_after(r.headers.get("Retry-After"))
+        if r.status_code in THROTTLE_STATUSES:
+            controller.on_throttle(retry_after)
+        if attempt == retries or (retry_after or 0) > MAX_RETRY_AFTER:
+            return r
+        r.close()
+        delay = backoff_delay(attempt, retry_after)
+        logger.debug("HTTP {} for {}, retrying in {:.1f}s".format(r.status_code, url, delay))
+        time.sleep(delay)
+
+
+def proxy_dict(proxy):
+    if not proxy:
+        return {}
+    return {"http": proxy, "https": proxy}
+
+
+class pooledSession(requests.Session):
+    """A requests session with keep-alive connection pools, a default timeout,
+    retries and the per host concurrency limits applied to every request."""
+    retry_exceptions = (requests.ConnectionError, requests.Timeout)
+
+    def __init__(self, proxy=None, timeout=DEFAULT_TIMEOUT, pool_size=POOL_SIZE, retries=MAX_RETRIES):
+        super(pooledSession, self).__init__()
+        self.headers.update(HEADERS)
+        self.proxies = proxy_dict(proxy)
+        self.timeout = timeout
+        self.retries = retries
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, retries=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        def send():
+            return super(pooledSession, self).request(method, url, **kwargs)
+        return send_with_retries(url, send, stream=kwargs.get("stream", False),
+                                 retries=self.retries if retries is None else retries,
+                                 retry_exceptions=self.retry_exceptions)
+
+
+class http2Response(object):
+    """Expose the parts of requests.Response md-paper uses on top of an httpx response."""
+    def __init__(self, response):
+        self.raw_response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+
+    @property
+    def content(self):
+        return self.raw_response.read()
+
+    def json(self):
+        return self.raw_response.json()
+
+    def iter_content(self, chunk_size=None):
+        return self.raw_response.iter_bytes(chunk_size)
+
+    def raise_for_status(self):
+        self.raw_response.raise_for_status()
+
+    def close(self):
+        self.raw_response.close()
+
+
+class http2Session(object):
+    """An HTTP/2 capable client built on httpx, used when --http2 is given."""
+    def __init__(self, proxy=None, timeout=DEFAULT_TIMEOUT, pool_size=POOL_SIZE, retries=MAX_RETRIES):
+        import httpx
+
+        self.proxies = proxy_dict(proxy)
+        self.headers = dict(HEADERS)
+        self.retries = retries
+        self.retry_exceptions = (httpx.TransportError,)
+        self.client = httpx.Client(
+            http2=True,
+            headers=HEADERS,
+            proxy="http://{}".format(proxy) if proxy and "//" not in proxy else proxy,
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            follow_redirects=True)
+
+    def get(self, url, params=None, headers=None, auth=None, stream=False, retries=None, **kwargs):
+        def send():
+            request = self.client.build_request("GET", url, params=params, headers=headers)
+            return http2Response(self.client.send(request, auth=auth, stream=stream))
+        return send_with_retries(url, send, stream=stream,
+                                 retries=self.retries if retries is None else retries,
+                                 retry_exceptions=self.retry_exceptions)
+
+    def head(self, url, retries=None, **kwargs):
+        def send():
+            return http2Response(self.client.head(url))
+        return send_with_retries(url, send,
+                                 retries=self.retries if retries is None else retries,
+                                 retry_exceptions=self.retry_exceptions)
+
+    def close(self):
+        self.client.close()
+
+
+class sessionPool(object):
+    """Process-wide sessions, one per proxy, shared by every source class."""
+    def __init__(self, timeout=DEFAULT_TIMEOUT, pool_size=POOL_SIZE, http2=False, retries=MAX_RETRIES):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.http2 = http2
+        self.retries = retries
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def configure(self, timeout=None, pool_size=None, http2=None, retries=None):
+        """Change the pool settings, sessions created before are closed."""
+        if timeout is not None:
+            self.timeout = timeout
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if http2 is not None:
+            self.http2 = http2
+        if retries is not None:
+            self.retries = retries
+        self.close()
+
+    def _new_session(self, proxy):
+        if self.http2:
+            try:
+                return http2Session(proxy, timeout=self.timeout, pool_size=self.pool_size,
+                                    retries=self.retries)
+            except ImportError:
+                logger.warning("HTTP/2 needs `pip install httpx[http2]`, falling back to HTTP/1.1")
+                self.http2 = False
+        return pooledSession(proxy, timeout=self.timeout, pool_size=self.pool_size, retries=self.retries)
+
+    def get_session(self, proxy=None):
+        key = proxy or ""
+        with self._lock:
+            sess = self._sessions.get(key)
+            if sess is None:
+                sess = self._new_session(proxy)
+                self._sessions[key] = sess
+            return sess
+
+    def close(self):
+        with self._lock:
+            for sess in self._sessions.values():
+                sess.close()
+            self._sessions = {}
+
+
+POOL = sessionPool()
+
+
+def get_session(proxy=None):
+    return POOL.get_session(proxy)
+
+
+def configure(timeout=None, pool_size=None, http2=None, retries=None):
+    POOL.configure(timeout=timeout, pool_size=pool_size, http2=http2, retries=retries)
+
+
+def warm_up(urls, proxy=None):
+    """Open pooled connections to the hosts of ``urls`` in the background, so
+    that the first real request skips DNS, TCP and TLS setup.
+
+    Only the root of each host is asked for, with a HEAD request, the APIs
+    themselves (and the arXiv API's request spacing) are left untouched.
+    """
+    def connect(url):
+        parts = urlsplit(url)
+        try:
+            get_session(proxy).head(urlunsplit((parts.scheme, parts.netloc, "/", "", "")), retries=0).close()
+        except Exception as exc:
+            logger.debug("Warming up {} failed: {}".format(url, exc))
+
+    for url in urls:
+        threading.Thread(target=connect, args=(url,), daemon=True).start()
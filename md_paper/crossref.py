@@ -1,17 +1,32 @@
+import json
 import logging
 import re
-import requests 
+from urllib.parse import urlencode
+
+from .clients import get_session
 
 logging.basicConfig()
 logger = logging.getLogger('crossref')
 logger.setLevel(logging.DEBUG)
-HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:27.0) Gecko/20100101 Firefox/27.0'}
+
+CROSSREF_API = "http://api.crossref.org/"
+# contact address sent with every query, routes md-paper to CrossRef's polite pool
+MAILTO = None
+# DOIs per works?filter= query, keeps the url well below common length limits
+CROSSREF_BATCH_SIZE = 20
+
+
+def set_mailto(mailto):
+    """Identify md-paper to CrossRef with a contact address (polite pool)."""
+    global MAILTO
+    MAILTO = mailto or None
+
 
 class crossrefInfo(object):
     def __init__(self):
-        self.sess = requests.Session()
-        self.sess.headers = HEADERS
-        self.base_url = "http://api.crossref.org/"
+        self.sess = get_session()
+        self.base_url = CROSSREF_API
+        self.mailto = MAILTO
 
     def set_proxy(self, proxy=None):
         """set proxy for session
@@ -22,9 +37,7 @@ class crossrefInfo(object):
             None
         """
         if proxy:
-            self.sess.proxies = {
-                "http": proxy,
-                "https": proxy, }
+            self.sess = get_session(proxy)
             
     
     def extract_json_info(self, bib):
@@ -113,13 +126,141 @@ class crossrefInfo(object):
         url = url.format(self.base_url, doi)
         
         try:
-            r = self.sess.get(url)
+            r = self.sess.get(url, params={"mailto": self.mailto} if self.mailto else None)
 
             bib = r.json()['message']
             return self.extract_json_info(bib)
             
         except:
             logger.error("DOI: {} is error.".format(doi))
+
+
+    def get_info_by_dois(self, dois, batch_size=CROSSREF_BATCH_SIZE):
+        """Get the meta information of many DOIs with batched works?filter=doi: queries.
+        
+        Args:
+            dois (list): The paper DOI numbers
+            batch_size (int): The number of DOIs per query
+            
+        Returns:
+            A dict mapping every given DOI to its paper information (the
+            same dict get_info_by_doi returns). DOIs CrossRef does not know
+            are missing.
+        """
+        infos = {}
+        wanted = {}
+        for doi in dois:
+            wanted.setdefault(doi.strip().lower(), []).append(doi)
+        # a comma would split the filter value, such DOIs go one by one
+        keys = [key for key in wanted if "," not in key]
+        failed = [key for key in wanted if "," in key]
+
+        url = "{}works".format(self.base_url)
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            params = {
+                "filter": ",".join("doi:" + key for key in batch),
+                "rows": len(batch),
+            }
+            if self.mailto:
+                params["mailto"] = self.mailto
+            try:
+                r = self.sess.get(url, params=params)
+                items = r.json()['message']['items']
+            except:
+                logger.error("CrossRef batch query failed for {} DOIs".format(len(batch)))
+                failed.extend(batch)
+                continue
+
+            found = set()
+            for item in items:
+                key = item.get("DOI", "").lower()
+                if key not in wanted:
+                    continue
+                try:
+                    bib = self.extract_json_info(item)
+                except:
+                    logger.error("DOI: {} is error.".format(key))
+                    continue
+                found.add(key)
+                for doi in wanted[key]:
+                    infos[doi] = bib
+            # works/{doi} also resolves the aliases and case variants the
+            # filter does not match, give the missing DOIs a single lookup
+            failed.extend(key for key in batch if key not in found)
+
+        for key in failed:
+            bib = self.get_info_by_doi(wanted[key][0])
+            if bib:
+                for doi in wanted[key]:
+                    infos[doi] = bib
+
+        return infos
+
+
+    def get_cited_counts(self, dois, batch_size=CROSSREF_BATCH_SIZE, validators=None):
+        """Get only the citation counts of many DOIs, in batched works?filter=doi: queries.
+        
+        Args:
+            dois (list): The paper DOI numbers
+            batch_size (int): The number of DOIs per query
+            validators (metadataCache): Keeps the ETag / Last-Modified of every
+                query, a query upstream answers with 304 Not Modified reuses
+                the counts stored with them.
+            
+        Returns:
+            A tuple (counts, not_modified), counts maps the lower case DOIs to
+            their is-referenced-by-count, not_modified is the number of
+            queries answered with 304.
+        """
+        counts = {}
+        not_modified = 0
+        keys = sorted(set(doi.strip().lower() for doi in dois if "," not in doi))
+
+        url = "{}works".format(self.base_url)
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            params = {
+                "filter": ",".join("doi:" + key for key in batch),
+                "rows": len(batch),
+                "select": "DOI,is-referenced-by-count",
+            }
+            if self.mailto:
+                params["mailto"] = self.mailto
+            request_url = url + "?" + urlencode(params)
+
+            headers = {}
+            stored = validators.get_validator(request_url) if validators is not None else None
+            if stored:
+                etag, last_modified, _ = stored
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+            try:
+                r = self.sess.get(url, params=params, headers=headers or None)
+                if r.status_code == 304 and stored:
+                    not_modified += 1
+                    counts.update(json.loads(stored[2]))
+                    continue
+                items = r.json()['message']['items']
+            except:
+                logger.error("CrossRef citation count query failed for {} DOIs".format(len(batch)))
+                continue
+
+            batch_counts = {}
+            for item in items:
+                key = item.get("DOI", "").lower()
+                if key in batch and item.get("is-referenced-by-count") is not None:
+                    batch_counts[key] = item["is-referenced-by-count"]
+            counts.update(batch_counts)
+
+            etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+            if validators is not None and (etag or last_modified):
+                validators.put_validator(request_url, etag, last_modified, json.dumps(batch_counts))
+
+        return counts, not_modified
+
             
 if __name__ == "__main__":
 
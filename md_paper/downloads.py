@@ -1,11 +1,13 @@
 import logging
-import re 
 import os 
 
-from .arxiv import arxivInfo
-from .crossref import crossrefInfo
+from .arxiv import arxivInfo, ARXIV_BATCH_SIZE
+from .crossref import crossrefInfo, CROSSREF_BATCH_SIZE
 from .medbiorxiv import BMxivInfo
+from .metrics import phase
 from .pdfs import pdfDownload
+from .snapshot import lookup as lookup_snapshot
+from .tokenizer import classify_id
 
 logging.basicConfig()
 logger = logging.getLogger('Downloads')
@@ -15,76 +17,171 @@ HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:27.0) Gecko/2010010
 
 
 
-def check_string(re_exp, str):
-    res = re.match(re_exp, str)
-    if res:
-        return True
-    else:
-        return False
-
 def classify(identifier):
     """
     Classify the type of paper_id:
     arxivId - arxivId
     doi - digital object identifier
     medbiorxivId - medrxiv or biorxiv id
-    title - title
+    unrecognized - anything else
     """
-    if check_string(r'10\.(?!1101)[0-9]{4}/\.*', identifier):
-        return 'doi'
-    elif check_string(r'10\.1101/\.*', identifier):
-        return "medbiorxivId"
-    elif check_string(r'[0-9]{2}[0-1][0-9]\.[0-9]{3,}.*', identifier) or check_string(r'.*/[0-9]{2}[0-1][0-9]{4}', identifier):
-        return 'arxivId'
-    else:
-        return "unrecognized"
+    return classify_id(identifier)
     
-def get_paper_info_from_paperid(paper_id, proxy=None):
-    id_type = classify(paper_id)
+def get_paper_info_from_paperid(paper_id, proxy=None, cache=None, id_type=None, cache_checked=False):
+    """Resolve one paper id, ``cache_checked`` when the caller already missed it in ``cache``."""
+    if cache is not None and not cache_checked:
+        bib_dict = cache.get(paper_id)
+        if bib_dict:
+            return bib_dict
+
+    if id_type is None:
+        with phase("classify"):
+            id_type = classify(paper_id)
+
+    bib_dict = lookup_snapshot(paper_id, id_type)
+    if bib_dict:
+        return bib_dict
     
     if id_type == "doi":
         downloader = crossrefInfo()
         if proxy:
             downloader.set_proxy(proxy=proxy)
-        bib_dict = downloader.get_info_by_doi(paper_id)
+        with phase("crossref"):
+            bib_dict = downloader.get_info_by_doi(paper_id)
         
     elif id_type == "arxivId":
         downloader = arxivInfo()
         if proxy:
-            downloader.set_proxy_handler(proxy=proxy)
-        bib_dict = downloader.get_info_by_arxivid(paper_id)
+            downloader.set_proxy(proxy=proxy)
+        with phase("arxiv"):
+            bib_dict = downloader.get_info_by_arxivid(paper_id)
         
     elif id_type == "medbiorxivId":
         downloader = BMxivInfo()
         if proxy:
             downloader.set_proxy(proxy=proxy)
-        bib_dict = downloader.get_info_by_bmrxivid(paper_id)
+        with phase("biorxiv"):
+            bib_dict = downloader.get_info_by_bmrxivid(paper_id)
     
+    if cache is not None and id_type != "unrecognized" and bib_dict:
+        cache.put(paper_id, bib_dict)
+
     try:
         return bib_dict 
     except:
         pass 
 
 
+def prefetch_paper_infos(paper_ids, proxy=None, cache=None, arxiv_batch_size=ARXIV_BATCH_SIZE,
+                         crossref_batch_size=CROSSREF_BATCH_SIZE, workers=1, id_types=None):
+    """Resolve the paper ids that can be queried in bulk.
+    
+    DOIs are grouped into works?filter=doi: queries, arxiv ids into id_list
+    queries, and the DOIs that arxiv and biorxiv/medrxiv records point to
+    are batched as well. Cached entries are served from the cache and
+    papers in the imported snapshot from there. Cached DOIs whose citation
+    count alone expired only have their counts fetched again.
+    
+    Args:
+        paper_ids (list): The paper ids
+        proxy (str): The proxy
+        cache (metadataCache): The metadata cache
+        arxiv_batch_size (int): The number of arxiv ids per query
+        crossref_batch_size (int): The number of DOIs per query
+        workers (int): The number of biorxiv/medrxiv records looked up at once
+        id_types (dict): The id type of paper ids tokenize classified already
+    
+    Returns:
+        A dict mapping paper ids to their paper information.
+    """
+    bibs = dict()
+    grouped = {"doi": [], "arxivId": [], "medbiorxivId": []}
+    # cached DOIs whose citation count alone expired
+    recount = dict()
+    for paper_id in dict.fromkeys(paper_ids):
+        id_type = (id_types or {}).get(paper_id)
+        if id_type is None:
+            with phase("classify"):
+                id_type = classify(paper_id)
+        if cache is not None:
+            bib_dict, expired = cache.get_stale(paper_id)
+            if bib_dict and not expired:
+                bibs[paper_id] = bib_dict
+                continue
+            if bib_dict and expired == {"cited_count"} and id_type == "doi":
+                recount[paper_id] = bib_dict
+                continue
+        bib_dict = lookup_snapshot(paper_id, id_type)
+        if bib_dict:
+            bibs[paper_id] = bib_dict
+            continue
+        if id_type in grouped:
+            grouped[id_type].append(paper_id)
+
+    if recount:
+        downloader = crossrefInfo()
+        if proxy:
+            downloader.set_proxy(proxy=proxy)
+        with phase("crossref"):
+            counts, _ = downloader.get_cited_counts(list(recount), batch_size=crossref_batch_size,
+                                                    validators=cache)
+        for paper_id, bib_dict in recount.items():
+            count = counts.get(paper_id.strip().lower())
+            if count is None:
+                # resolved again in full
+                grouped["doi"].append(paper_id)
+                continue
+            bib_dict["cited_count"] = count
+            cache.update_field(paper_id, "cited_count", count)
+            bibs[paper_id] = bib_dict
+
+    resolved = dict()
+    if len(grouped["doi"]) > 1:
+        downloader = crossrefInfo()
+        if proxy:
+            downloader.set_proxy(proxy=proxy)
+        with phase("crossref"):
+            resolved.update(downloader.get_info_by_dois(grouped["doi"], batch_size=crossref_batch_size))
+
+    if len(grouped["arxivId"]) > 1:
+        downloader = arxivInfo()
+        if proxy:
+            downloader.set_proxy(proxy=proxy)
+        with phase("arxiv"):
+            resolved.update(downloader.get_info_by_arxivids(grouped["arxivId"], batch_size=arxiv_batch_size))
+
+    if len(grouped["medbiorxivId"]) > 1:
+        downloader = BMxivInfo()
+        if proxy:
+            downloader.set_proxy(proxy=proxy)
+        with phase("biorxiv"):
+            resolved.update(downloader.get_info_by_bmrxivids(grouped["medbiorxivId"], workers=workers))
+
+    if cache is not None:
+        for paper_id, bib_dict in resolved.items():
+            cache.put(paper_id, bib_dict)
+    bibs.update(resolved)
+
+    return bibs
+
+
 def get_paper_pdf_from_paperid(paper_id, path, proxy=None, direct_url=None):
     pdf_downloader = pdfDownload()
     if proxy:
         pdf_downloader.set_proxy(proxy=proxy)
     
+    pdf_dir = os.path.dirname(path)
+    if pdf_dir and not os.path.exists(pdf_dir):
+        os.makedirs(pdf_dir)
+
     if direct_url:
-        content = pdf_downloader.get_pdf_from_direct_url(direct_url)
+        content = pdf_downloader.get_pdf_from_direct_url(direct_url, path=path)
         if not content:
-            content = pdf_downloader.get_pdf_from_sci_hub(paper_id)
+            content = pdf_downloader.get_pdf_from_sci_hub(paper_id, path=path)
     else:
-        content = pdf_downloader.get_pdf_from_sci_hub(paper_id)
-    
-    try:
-        if not os.path.exists(path.rsplit("/", 1)[0]):
-            os.makedirs(path.rsplit("/", 1)[0])
-        pdf_downloader._save(content['pdf'], path)
-    except:
-        pass 
+        content = pdf_downloader.get_pdf_from_sci_hub(paper_id, path=path)
     
+    return content
 
 
 
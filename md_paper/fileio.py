@@ -0,0 +1,63 @@
+import logging
+import os
+import shutil
+import tempfile
+
+from .metrics import phase
+
+logging.basicConfig()
+logger = logging.getLogger('fileio')
+logger.setLevel(logging.INFO)
+
+
+def read_note(path):
+    """Read a note once.
+
+    Returns:
+        A tuple (content, mtime_ns), the mtime lets atomic_write detect edits
+        made to the note in the meantime.
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        content = f.read()
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+    return content, mtime_ns
+
+
+def atomic_write(path, content, expected_mtime_ns=None):
+    """Replace the content of ``path`` without ever leaving it half written.
+
+    The content goes to a temporary file in the same folder which is then
+    renamed over ``path``, a symlinked note has its target replaced and
+    stays a link. When ``expected_mtime_ns`` is given and the file was
+    modified since it was read, nothing is written.
+
+    Returns:
+        True if the file was written, False if it changed in the meantime.
+    """
+    with phase("note_write") as write:
+        written = _atomic_write(path, content, expected_mtime_ns)
+        write.bytes = len(content) if written else 0
+    return written
+
+
+def _atomic_write(path, content, expected_mtime_ns):
+    path = os.path.realpath(path)
+    folder = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+            if expected_mtime_ns is not None and os.stat(path).st_mtime_ns != expected_mtime_ns:
+                logger.warning("{} was modified during the run, not overwriting it".format(path))
+                os.remove(tmp_path)
+                return False
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import logging
+import os
+
+logging.basicConfig()
+logger = logging.getLogger('manifest')
+logger.setLevel(logging.INFO)
+
+MANIFEST_NAME = ".md-paper-manifest.json"
+
+
+def content_hash(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+class noteManifest(object):
+    """mtime, size and content hash of every note processed, kept in the
+    output folder so that unchanged notes can be skipped on the next run."""
+    def __init__(self, output_path):
+        self.path = os.path.join(output_path, MANIFEST_NAME)
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                logger.warning("Ignoring unreadable manifest {}".format(self.path))
+
+    def _key(self, note_path):
+        return os.path.abspath(note_path)
+
+    def is_unchanged(self, note_path, st=None):
+        """Check a note against the manifest.
+
+        Notes whose mtime and size match are unchanged without being read,
+        notes that were only touched are confirmed by their content hash.
+        """
+        entry = self.entries.get(self._key(note_path))
+        if entry is None:
+            return False
+        st = st or os.stat(note_path)
+        if st.st_size != entry["size"]:
+            return False
+        if st.st_mtime_ns == entry["mtime_ns"]:
+            return True
+
+        with open(note_path, "rb") as f:
+            digest = content_hash(f.read())
+        if digest != entry["sha256"]:
+            return False
+        entry["mtime_ns"] = st.st_mtime_ns
+        self.dirty = True
+        return True
+
+    def record(self, note_path, content=None):
+        """Record the current state of a note, ``content`` saves reading it again."""
+        st = os.stat(note_path)
+        if content is None:
+            with open(note_path, "rb") as f:
+                content = f.read()
+        self.entries[self._key(note_path)] = {
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "sha256": content_hash(content),
+        }
+        self.dirty = True
+
+    def forget(self, note_path):
+        if self.entries.pop(self._key(note_path), None) is not None:
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
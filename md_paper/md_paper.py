@@ -1,95 +1,510 @@
 import logging 
 import argparse
+import json
 import os 
+import sys
 
-from .utils import patternRecognizer, note_modified, get_update_content
-from .renamer import rename_pdfs_in_directory
+from .tokenizer import tokenize
+from .utils import note_modified, get_vault_update_contents
+from .throttle import parse_host_limits, set_host_limits
+from .manifest import noteManifest
+from .store import pdfStore
+from .fileio import read_note
+from .metrics import METRICS, phase
+from .refindex import referenceIndex, rendered_aliases, INDEX_NAME, STATES, UNRESOLVED, FAILED
+from .watch import DEBOUNCE, POLL_INTERVAL, watch
+from .snapshot import SNAPSHOT_NAME, configure_snapshot, snapshotIndex
+from .cache import metadataCache, pdfDoiCache, parse_ttls, default_cache_dir
 
 logging.basicConfig()
 logger = logging.getLogger('md-paper')
 logger.setLevel(logging.INFO)
 
 
-def set_args():
-    parser = argparse.ArgumentParser(description='md-paper')
+def set_args(argv=None, watch=False):
+    parser = argparse.ArgumentParser(prog='md-paper watch' if watch else None, description='md-paper')
     parser.add_argument('-i', '--input', required=True, type=str, default=None,
                         help="The path to the note file or note file folder.")
     parser.add_argument('-o', '--output', type=str, default=None,
                         help='The folder path to save paper pdfs and iamges. NOTE: MUST BE FOLDER')
     parser.add_argument('-r', '--rename', type=str, default=None,
                         help='The folder path that contains pdfs to be renamed.')
+    parser.add_argument('--recursive', action='store_true',
+                        help='Also rename the pdfs in the subfolders of the -r folder.')
     parser.add_argument('-p', '--proxy', type=str, default=None, 
                         help='The proxy. e.g. 127.0.0.1:7890')
-    args = parser.parse_args()
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='The number of papers resolved concurrently. Default: 1 (serial)')
+    parser.add_argument('--arxiv-batch-size', type=int, default=50,
+                        help='The number of arxiv ids resolved per arXiv API query. Default: 50')
+    parser.add_argument('--host-limit', type=str, action='append', default=None,
+                        help='Maximum concurrent requests to a host, e.g. api.crossref.org=4. Repeatable.')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='The number of processes extracting DOIs from pdfs in -r mode. Default: CPU count')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='The read timeout of upstream requests in seconds. Default: 60')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Retries of an upstream request failing with a connection error, 429 or 5xx. Default: 3')
+    parser.add_argument('--mailto', type=str, default=os.environ.get('MD_PAPER_MAILTO'),
+                        help='Contact email sent to CrossRef to use its polite pool. Default: $MD_PAPER_MAILTO')
+    parser.add_argument('--http2', action='store_true',
+                        help='Use HTTP/2 for upstream requests, needs httpx[http2].')
+    parser.add_argument('--mirror-ttl', type=float, default=6,
+                        help='Hours the discovered sci-hub mirror list is reused. Default: 6')
+    parser.add_argument('--hedge-mirrors', type=int, default=3,
+                        help='The number of sci-hub mirrors queried in parallel. Default: 3')
+    parser.add_argument('--store', type=str, default=None,
+                        help='Keep pdfs once in this content-addressed folder and link them into the output folder.')
+    parser.add_argument('--link', type=str, choices=['hardlink', 'symlink'], default='hardlink',
+                        help='How pdfs in the output folder point into --store. Default: hardlink')
+    parser.add_argument('--full', action='store_true',
+                        help='Process every note, also the ones unchanged since the last run.')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='The folder to keep the metadata cache in. Default: ~/.cache/md-paper')
+    parser.add_argument('--cache-ttl', type=str, action='append', default=None,
+                        help='Cache TTL of a metadata field in days, e.g. cited_count=7 or default=180. Repeatable.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Bypass the metadata cache and always query the upstream APIs.')
+    parser.add_argument('--snapshot', type=str, default=None,
+                        help='Resolve papers from this index of md-paper import-snapshot before querying upstream. '
+                             'Default: snapshot.sqlite in the cache folder if it exists, "" for none')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='Remove all entries from the metadata and pdf DOI caches before running.')
+    parser.add_argument('--metrics-json', type=str, default=None,
+                        help='Write per phase and per host timings, bytes and errors of the run to this JSON file.')
+    parser.add_argument('--prometheus', type=str, default=None,
+                        help='Write the run metrics to this Prometheus textfile, e.g. for node_exporter.')
+    parser.add_argument('--refresh-citations', action='store_true',
+                        help='Only update the citation counts of the entries already in the notes.')
+    if watch:
+        parser.add_argument('--debounce', type=float, default=DEBOUNCE,
+                            help='Seconds a changed note must stay unchanged before it is updated. Default: 1')
+        parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                            help='Seconds between scans of the notes where inotify is unavailable. Default: 2')
+        parser.add_argument('--poll', action='store_true',
+                            help='Scan the notes for changes even if inotify is available.')
+    args = parser.parse_args(argv)
     
     return args 
 
-def check_args():
-    args = set_args()
-    input_path = args.input
-    output_path = args.output 
-    proxy = args.proxy
-    rename_dir = args.rename
+def check_args(argv=None, watch=False):
+    args = set_args(argv, watch=watch)
+    try:
+        args.cache_ttl = parse_ttls(args.cache_ttl)
+        args.host_limit = parse_host_limits(args.host_limit)
+    except ValueError as exc:
+        logger.error(exc)
+        raise SystemExit(2)
         
-    return input_path, output_path, proxy, rename_dir
+    return args
 
 
-def get_bib_and_pdf(note_file, output_path, proxy, paper_recognizer):
-    
-    pdfs_path = output_path
-    if not os.path.exists(pdfs_path):
-        os.makedirs(pdfs_path)
-    
-    with open(note_file, 'r') as f:
-        content = f.read()
-            
-    m = paper_recognizer.findall(content)
-    logger.info("Number of papers to download -  {}".format(len(m)))
+def open_cache(args):
+    """Open the metadata cache according to the command line options, or None."""
+    if args.no_cache and not args.clear_cache:
+        return None
+    cache_dir = args.cache_dir or default_cache_dir()
+    cache = metadataCache(os.path.join(cache_dir, "metadata.sqlite"), ttls=args.cache_ttl)
+    if args.clear_cache:
+        cache.clear()
+        logger.info("Metadata cache cleared: {}".format(cache.path))
+    if args.no_cache:
+        cache.close()
+        return None
+    return cache
 
-    if not m:
-        logger.info("No papers found to download, file {} not updated.".format(note_file))
-    else:
-        replace_dict = get_update_content(m, note_file, pdfs_path, proxy=proxy)
-            
-        return replace_dict
 
+def open_doi_cache(args):
+    """Open the renamer's pdf DOI cache according to the command line options, or None."""
+    if args.no_cache and not args.clear_cache:
+        return None
+    cache_dir = args.cache_dir or default_cache_dir()
+    doi_cache = pdfDoiCache(os.path.join(cache_dir, "renamer.sqlite"))
+    if args.clear_cache:
+        doi_cache.clear()
+    if args.no_cache:
+        doi_cache.close()
+        return None
+    return doi_cache
 
-def file_update(input_path, output_path, proxy, paper_recognizer):
-    
-    replace_dict =  get_bib_and_pdf(input_path, output_path,
-                                    proxy, paper_recognizer)
+
+def open_index(cache_dir=None):
+    return referenceIndex(os.path.join(cache_dir or default_cache_dir(), INDEX_NAME))
+
+
+def find_notes(input_path):
+    """The markdown notes in a folder and its subfolders."""
+    note_paths = []
+    for root, _, files in os.walk(input_path):
+        for file in files:
+            if file.lower().endswith('md') or file.lower().endswith('markdown'):
+                note_paths.append(os.path.join(root, file))
+    return note_paths
+
+
+def update_notes(note_paths, output_path, proxy, full=False, index=None,
+                 new_only=False, **kwargs):
+    """Update notes, skipping the ones the manifest shows unchanged unless ``full``.
     
-    if replace_dict:
-        note_modified(paper_recognizer, input_path, **replace_dict)
+    The references of all notes are planned together, so a paper cited by
+    several notes is resolved and downloaded only once. With a referenceIndex
+    every note is (re)indexed as it is processed. ``new_only`` leaves the
+    references an earlier run marked as not correct alone.
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    manifest = noteManifest(output_path)
+
+    skipped = 0
+    notes = []
+    for note_path in note_paths:
+        st = os.stat(note_path)
+        if not full and manifest.is_unchanged(note_path, st):
+            if index is not None:
+                index.refresh(note_path, st)
+            skipped += 1
+            continue
+        content, mtime_ns = read_note(note_path)
+        with phase("classify"):
+            refs = tokenize(content)
+        # references without the marks of an earlier run
+        m = [ref for ref in refs if ref.end == ref.marks_end] if new_only else refs
+        if not m:
+            # the references marked by an earlier run are retried by the next full update
+            if refs:
+                manifest.forget(note_path)
+            else:
+                manifest.record(note_path, content)
+            if index is not None:
+                index.update(note_path, content)
+            continue
+        logger.info("Number of papers to download -  {} in {}".format(len(m), note_path))
+        notes.append((note_path, content, mtime_ns, refs, m))
+
+    if notes:
+        replace_dicts = get_vault_update_contents([(note_path, m) for note_path, _, _, _, m in notes],
+                                                  output_path, proxy, **kwargs)
+    for note_path, content, mtime_ns, refs, m in notes:
+        replace_dict = replace_dicts[note_path]
+        if replace_dict:
+            logger.info("Updating file {}".format(note_path))
+            content = note_modified(note_path, content=content, mtime_ns=mtime_ns,
+                                    refs=refs, **replace_dict)
+        unresolved = any(ref.text not in replace_dict for ref in refs)
+        if content is None or unresolved:
+            # the next run processes the note again and retries what failed
+            manifest.forget(note_path)
+        else:
+            manifest.record(note_path, content)
+        if content is not None and index is not None:
+            index.update(note_path, content, aliases=rendered_aliases(refs, replace_dict))
+    manifest.save()
+    if index is not None:
+        index.commit()
+    if notes:
+        from .pdfs import MIRRORS
+
+        MIRRORS.save()
+
+    if skipped:
+        logger.info("Skipped {} unchanged notes, use --full to process them".format(skipped))
+
+
+def configure_run(args):
+    """Apply the upstream options of the command line to the shared clients."""
+    METRICS.reset()
+    # requests, pypdf and bs4 are imported only now, so that -h and
+    # subcommands start fast
+    from .clients import configure as configure_clients
+    from .crossref import set_mailto
+    from .pdfs import configure_mirrors
+
+    configure_clients(timeout=(10, args.timeout) if args.timeout else None, http2=args.http2,
+                      retries=max(0, args.retries))
+    set_mailto(args.mailto)
+    configure_mirrors(path=os.path.join(args.cache_dir or default_cache_dir(), "mirrors.json"),
+                      ttl=args.mirror_ttl * 60 * 60, hedge=args.hedge_mirrors)
+
+    snapshot_path = args.snapshot
+    if snapshot_path is None:
+        snapshot_path = os.path.join(args.cache_dir or default_cache_dir(), SNAPSHOT_NAME)
+        if not os.path.exists(snapshot_path):
+            snapshot_path = None
+    elif snapshot_path and not os.path.exists(snapshot_path):
+        logger.error("snapshot {} is not exists, create it with md-paper import-snapshot".format(snapshot_path))
+        raise SystemExit(2)
+    configure_snapshot(snapshot_path or None)
+
+
+def update_options(args, cache, index):
+    """The keyword arguments of update_notes given by the command line."""
+    store = pdfStore(args.store, link=args.link) if args.store else None
+    return dict(cache=cache, workers=args.workers, arxiv_batch_size=args.arxiv_batch_size,
+                store=store, index=index)
+
+
+def watch_main(argv):
+    """Keep updating the notes of a folder as they are saved.
+
+    The metadata cache, connection pools and sci-hub mirror ranking stay
+    warm between updates, and only the references added since the last
+    update are resolved.
+    """
+    args = check_args(argv, watch=True)
+    if not args.output:
+        logger.error("watch needs -o, the folder to save paper pdfs and images in")
+        raise SystemExit(2)
+    if args.rename or args.refresh_citations:
+        logger.error("-r and --refresh-citations are not supported in watch mode")
+        raise SystemExit(2)
+    if not os.path.isdir(args.input):
+        logger.error("input path {} is not a folder".format(args.input))
+        raise SystemExit(2)
+    configure_run(args)
+    from .clients import warm_up
+    from .crossref import CROSSREF_API
+    from .arxiv import ARXIV_API
+
+    set_host_limits(args.host_limit)
+    cache = open_cache(args)
+    index = open_index(args.cache_dir)
+    options = update_options(args, cache, index)
+    warm_up([CROSSREF_API, ARXIV_API], proxy=args.proxy)
+
+    # (mtime_ns, size) of each note after its last update, the events of
+    # md-paper's own writes find the note unchanged since
+    updated = {}
+
+    def process(note_paths):
+        existing = []
+        for note_path in note_paths:
+            try:
+                st = os.stat(note_path)
+            except FileNotFoundError:
+                index.forget(note_path)
+                updated.pop(note_path, None)
+                continue
+            if updated.get(note_path) != (st.st_mtime_ns, st.st_size):
+                existing.append(note_path)
+        index.commit()
+        if not existing:
+            return
+
+        # the metrics of each update are reported on their own
+        METRICS.reset()
+        update_notes(existing, args.output, args.proxy, full=args.full,
+                     new_only=True, **options)
+        index.commit()
+        if cache is not None:
+            cache.flush()
+        for note_path in existing:
+            try:
+                st = os.stat(note_path)
+            except FileNotFoundError:
+                continue
+            updated[note_path] = (st.st_mtime_ns, st.st_size)
+        METRICS.log_summary()
+        if args.metrics_json:
+            METRICS.write_json(args.metrics_json)
+        if args.prometheus:
+            METRICS.write_prometheus(args.prometheus)
+
+    try:
+        # catch up with the edits made while not watching
+        process(find_notes(args.input))
+        watch(args.input, process, debounce=args.debounce, interval=args.poll_interval,
+              polling=args.poll)
+    finally:
+        if cache is not None:
+            cache.close()
+        index.close()
+
+
+def set_gc_args(argv):
+    parser = argparse.ArgumentParser(prog='md-paper gc',
+                                     description='Remove pdfs no note folder links to from a --store folder.')
+    parser.add_argument('--store', required=True, type=str,
+                        help='The content-addressed pdf folder.')
+    return parser.parse_args(argv)
+
+
+def gc_main(argv):
+    args = set_gc_args(argv)
+    if not os.path.isdir(args.store):
+        logger.info("store {} is not exists".format(args.store))
+        return
+    removed = pdfStore(args.store).gc()
+    logger.info("Removed {} unreferenced pdfs from {}".format(removed, args.store))
+
+
+def set_query_args(argv):
+    parser = argparse.ArgumentParser(prog='md-paper query',
+                                     description='Look up paper ids in the reference index of the notes.')
+    parser.add_argument('identifiers', nargs='*',
+                        help='DOIs, arxiv ids or biorxiv/medrxiv ids to look up.')
+    parser.add_argument('-i', '--input', type=str, default=None,
+                        help='Index the changed notes of this note file or folder first.')
+    parser.add_argument('--note', type=str, default=None,
+                        help='Only list the references of this note.')
+    parser.add_argument('--unresolved', action='store_true',
+                        help='Only list references not resolved yet, including the failed ones.')
+    parser.add_argument('--failed', action='store_true',
+                        help='Only list references marked "Not Correct, Check it".')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print the number of indexed notes, papers and references.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON.')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='The folder the index is kept in. Default: ~/.cache/md-paper')
+    return parser.parse_args(argv)
+
+
+def query_main(argv):
+    args = set_query_args(argv)
+    index = open_index(args.cache_dir)
+    try:
+        if args.input:
+            if os.path.isfile(args.input):
+                note_paths = [args.input]
+            elif os.path.isdir(args.input):
+                note_paths = find_notes(args.input)
+                index.prune(args.input)
+            else:
+                logger.info("input path {} is not exists".format(args.input))
+                return
+            indexed = sum(index.refresh(note_path) for note_path in note_paths)
+            index.commit()
+            logger.info("Indexed {} changed notes of {}".format(indexed, len(note_paths)))
+
+        if args.stats:
+            stats = index.stats()
+            if args.json:
+                print(json.dumps(stats, indent=2))
+            else:
+                print("{} notes, {} papers".format(stats["notes"], stats["papers"]))
+                for state in STATES:
+                    print("  {}: {}".format(state, stats["references"][state]))
+            return
+
+        states = None
+        if args.failed:
+            states = [FAILED]
+        elif args.unresolved:
+            states = [UNRESOLVED, FAILED]
+        if not (args.identifiers or args.note or states):
+            logger.info("nothing to look up, give paper ids, --note, --unresolved, --failed or --stats")
+            return
+
+        rows = index.lookup(args.identifiers, path=args.note, states=states)
+        if args.json:
+            print(json.dumps([{"identifier": identifier, "path": path, "line": line + 1,
+                               "offset": offset, "state": state}
+                              for identifier, path, line, offset, state in rows], indent=2))
+        else:
+            for identifier, path, line, _, state in rows:
+                print("{}:{}: {} [{}]".format(path, line + 1, identifier, state))
+    finally:
+        index.close()
+
+
+def set_import_snapshot_args(argv):
+    parser = argparse.ArgumentParser(prog='md-paper import-snapshot',
+                                     description='Import CrossRef and arXiv bulk metadata dumps for offline use.')
+    parser.add_argument('--crossref', type=str, action='append', default=[],
+                        help='A CrossRef public data file: the tar, a folder of its .json.gz files or one file. Repeatable.')
+    parser.add_argument('--arxiv', type=str, action='append', default=[],
+                        help='The arXiv metadata snapshot, one json record per line (.json or .json.gz). Repeatable.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='The index to import into. Default: snapshot.sqlite in the cache folder')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='The cache folder. Default: ~/.cache/md-paper')
+    return parser.parse_args(argv)
+
+
+def import_snapshot_main(argv):
+    args = set_import_snapshot_args(argv)
+    if not args.crossref and not args.arxiv:
+        logger.error("nothing to import, give --crossref or --arxiv")
+        raise SystemExit(2)
+    for path in args.crossref + args.arxiv:
+        if not os.path.exists(path):
+            logger.error("input path {} is not exists".format(path))
+            raise SystemExit(2)
+
+    snapshot = snapshotIndex(args.output or os.path.join(args.cache_dir or default_cache_dir(), SNAPSHOT_NAME))
+    try:
+        for path in args.crossref:
+            logger.info("Imported {} CrossRef works from {}".format(snapshot.import_crossref(path), path))
+        for path in args.arxiv:
+            logger.info("Imported {} arXiv records from {}".format(snapshot.import_arxiv(path), path))
+        logger.info("{} now holds {}".format(snapshot.path, ", ".join(
+            "{} {} records".format(count, source) for source, count in sorted(snapshot.stats().items()))))
+    finally:
+        snapshot.close()
+
+
+COMMANDS = {
+    "gc": gc_main,
+    "query": query_main,
+    "watch": watch_main,
+    "import-snapshot": import_snapshot_main,
+}
 
 
 def main():
-    input_path, output_path, proxy, rename_dir = check_args()
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
+    args = check_args()
+    configure_run(args)
+
+    input_path, output_path, proxy, rename_dir = args.input, args.output, args.proxy, args.rename
+    cache = open_cache(args)
+    doi_cache = open_doi_cache(args)
+    index = open_index(args.cache_dir)
 
     if rename_dir:
-        rename_pdfs_in_directory(rename_dir, input_path, proxy)
+        from .renamer import rename_pdfs_in_directory
+
+        rename_pdfs_in_directory(rename_dir, input_path, proxy, processes=args.processes,
+                                 cache=cache, doi_cache=doi_cache, index=index, recursive=args.recursive)
     
     if output_path:
-        paper_recognizer = patternRecognizer(r'- \{.{3,}\}')
-        
+        set_host_limits(args.host_limit)
+        options = update_options(args, cache, index)
+
         if os.path.isfile(input_path):
-            logger.info("Updating file {}".format(input_path))
-            file_update(input_path, output_path, proxy, paper_recognizer)
+            update_notes([input_path], output_path, proxy, full=args.full, **options)
             
         elif os.path.isdir(input_path):
-            note_paths = []
-            for root, _, files in os.walk(input_path):
-                for file in files:
-                    if file.lower().endswith('md') or file.lower().endswith('markdown'):
-                        note_paths.append(os.path.join(root, file))
-            for note_path in note_paths:
-                logger.info("Updating file {}".format(note_path))
-                file_update(note_path, output_path, proxy, paper_recognizer)
+            note_paths = find_notes(input_path)
+            update_notes(note_paths, output_path, proxy, full=args.full, **options)
         else:
             logger.info("input path {} is not exists".format(input_path))
-            
-        
-    if not output_path and not rename_dir:
+
+    if args.refresh_citations:
+        from .citations import refresh_citations
+
+        if os.path.isfile(input_path):
+            refresh_citations([input_path], proxy, cache=cache, index=index)
+        elif os.path.isdir(input_path):
+            refresh_citations(find_notes(input_path), proxy, cache=cache, index=index)
+        else:
+            logger.info("input path {} is not exists".format(input_path))
+
+    if cache is not None:
+        cache.close()
+    if doi_cache is not None:
+        doi_cache.close()
+    index.close()
+
+    METRICS.log_summary()
+    if args.metrics_json:
+        METRICS.write_json(args.metrics_json)
+    if args.prometheus:
+        METRICS.write_prometheus(args.prometheus)
+
+    if not output_path and not rename_dir and not args.refresh_citations and not args.clear_cache:
         logger.info("missing -o or -r, program did not run, please use -h for more information")
 
 
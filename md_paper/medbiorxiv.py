@@ -1,19 +1,72 @@
 import logging
-import requests
+import re
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from .crossref import crossrefInfo
+from .clients import get_session
 
 logging.basicConfig()
 logger = logging.getLogger('biorxiv')
 logger.setLevel(logging.DEBUG)
-HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:27.0) Gecko/20100101 Firefox/27.0'}
+
+BMXIV_API = "https://api.biorxiv.org/details/"
+SERVERS = ("biorxiv", "medrxiv")
+# seconds the hinted server has before the other one is queried as well
+HEDGE_DELAY = 0.3
+DATED_ID = re.compile(r"^10\.1101/\d{4}\.\d{2}\.\d{2}\.(\d+)")
+
+
+def id_shape(bmrxivid):
+    """The part of an id that tells the servers apart, e.g. dated-8 for
+    10.1101/2022.07.28.22277637."""
+    match = DATED_ID.match(bmrxivid.strip().lower())
+    if match:
+        return "dated-{}".format(len(match.group(1)))
+    return "legacy"
+
+
+class serverHints(object):
+    """Which server answered for ids of each shape, learned while running.
+
+    medRxiv started in 2019 with dated ids ending in 8 digits, bioRxiv's
+    end in 6 and its older ids carry no date, that is the guess until the
+    servers have answered for a shape.
+    """
+    PRIOR = {"dated-8": "medrxiv"}
+
+    def __init__(self):
+        self.wins = {}
+        self._lock = threading.Lock()
+
+    def order(self, bmrxivid):
+        """The servers in the order they should be tried for ``bmrxivid``."""
+        shape = id_shape(bmrxivid)
+        with self._lock:
+            wins = self.wins.get(shape)
+            if wins:
+                first = wins.most_common(1)[0][0]
+            else:
+                first = self.PRIOR.get(shape, SERVERS[0])
+        return [first] + [server for server in SERVERS if server != first]
+
+    def record(self, bmrxivid, server):
+        with self._lock:
+            self.wins.setdefault(id_shape(bmrxivid), Counter())[server] += 1
+
+
+HINTS = serverHints()
+
 
 class BMxivInfo(object):
     def __init__(self):
-        self.sess = requests.Session()
-        self.sess.headers = HEADERS
-        self.base_url = "https://api.biorxiv.org/details/"
-        self.servers = ["biorxiv", "medrxiv"]
+        self.sess = get_session()
+        self.base_url = BMXIV_API
+        self.servers = list(SERVERS)
+        self.hedge_delay = HEDGE_DELAY
+        # resolves the DOIs of published preprints on the same session
+        self.crossref = crossrefInfo()
     
     
     def set_proxy(self, proxy=False):
@@ -25,9 +78,8 @@ class BMxivInfo(object):
             None
         """
         if proxy:
-            self.sess.proxies = {
-                "http": proxy,
-                "https": proxy, }
+            self.sess = get_session(proxy)
+            self.crossref.set_proxy(proxy)
             
     
     def extract_json_info(self, item):
@@ -67,6 +119,50 @@ class BMxivInfo(object):
         return bib_dict
 
 
+    def _query_server(self, server, bmrxivid):
+        """Returns the latest version record on ``server`` OR None."""
+        url = self.base_url + server + "/" + bmrxivid
+        try:
+            collection = self.sess.get(url).json().get('collection') or []
+        except Exception as exc:
+            logger.debug("{} lookup of {} failed: {}".format(server, bmrxivid, exc))
+            return None
+        return collection[-1] if collection else None
+
+    def get_collection_item(self, bmrxivid):
+        """Get the latest version record of a biorxiv_id or medrxiv_id.
+        
+        The server HINTS expect is queried first, the other one as soon as
+        the first fails or after ``hedge_delay`` seconds, and the first
+        record found wins.
+        
+        Returns:
+            The raw json record OR None
+        """
+        servers = [server for server in HINTS.order(bmrxivid) if server in self.servers]
+        executor = ThreadPoolExecutor(max_workers=len(servers))
+        pending = {executor.submit(self._query_server, servers[0], bmrxivid): servers[0]}
+        waiting = list(servers[1:])
+        try:
+            while pending:
+                timeout = self.hedge_delay if waiting else None
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done or not any(future.result() for future in done):
+                    # the hinted server is slow or does not know the id
+                    for server in waiting:
+                        pending[executor.submit(self._query_server, server, bmrxivid)] = server
+                    waiting = []
+                for future in done:
+                    server = pending.pop(future)
+                    item = future.result()
+                    if item:
+                        HINTS.record(bmrxivid, server)
+                        return item
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        logger.error("DOI: {} is error.".format(bmrxivid))
+
+
     def get_info_by_bmrxivid(self, bmrxivid):
         """Get the meta information by the given paper biorxiv_id or medrxiv_id. 
         
@@ -84,25 +180,55 @@ class BMxivInfo(object):
             OR
             None
         """
-        urls = [self.base_url + server + "/" + bmrxivid for server in self.servers]
-        for url in urls:
+        bib = self.get_collection_item(bmrxivid)
+        if bib is None:
+            return None
+
+        try:
+            if "published" in bib.keys() and bib['published'] != "NA":
+                doi = bib["published"]
+                return self.crossref.get_info_by_doi(doi)
+             
+            return self.extract_json_info(bib)
+        except:
+            logger.error("DOI: {} is error.".format(bmrxivid)) 
+
+
+    def get_info_by_bmrxivids(self, bmrxivids, workers=1):
+        """Get the meta information of many biorxiv_ids or medrxiv_ids.
+        
+        The records are looked up one by one (``workers`` at a time), the
+        DOIs of published versions are then resolved with one batched
+        CrossRef query.
+        
+        Returns:
+            A dict mapping every given id to its paper information. Ids that
+            could not be resolved are missing.
+        """
+        bmrxivids = list(dict.fromkeys(bmrxivids))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            items = list(executor.map(self.get_collection_item, bmrxivids))
+
+        infos = {}
+        published = {}
+        for bmrxivid, item in zip(bmrxivids, items):
+            if item is None:
+                continue
+            if "published" in item.keys() and item['published'] != "NA":
+                published[bmrxivid] = item["published"]
+                continue
             try:
-                r = self.sess.get(url)
-
-                bib = r.json()['collection'][-1]
-                
-                if "published" in bib.keys() and bib['published'] != "NA":
-                    doi = bib["published"]
-                    print(doi)
-                    crossref_info = crossrefInfo()
-                    if len(self.sess.proxies) > 0:
-                        crossref_info.set_proxy(self.sess.proxies['http'].split('//')[-1])
-                    return crossref_info.get_info_by_doi(doi)
-                 
-                return self.extract_json_info(bib)
-                
+                infos[bmrxivid] = self.extract_json_info(item)
             except:
-                logger.error("DOI: {} is error.".format(bmrxivid)) 
+                logger.error("DOI: {} is error.".format(bmrxivid))
+
+        if published:
+            doi_bibs = self.crossref.get_info_by_dois(list(published.values()))
+            for bmrxivid, doi in published.items():
+                if doi in doi_bibs:
+                    infos[bmrxivid] = doi_bibs[doi]
+
+        return infos
             
             
 if __name__ == "__main__":
@@ -0,0 +1,154 @@
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+logging.basicConfig()
+logger = logging.getLogger('metrics')
+logger.setLevel(logging.INFO)
+
+
+def error_class(exc):
+    """The name an exception is counted under, e.g. ConnectTimeout."""
+    return type(exc).__name__
+
+
+def _new_entry(count_name):
+    return {count_name: 0, "seconds": 0.0, "bytes": 0, "errors": {}}
+
+
+class phaseTimer(object):
+    """Handed out by runMetrics.phase, lets the timed code add bytes or mark
+    a failure it handled itself."""
+    def __init__(self):
+        self.bytes = 0
+        self.error = None
+
+
+class runMetrics(object):
+    """Counts, bytes, durations and error classes of one run, per phase
+    (crossref, pdf_transfer, note_write, ...) and per upstream host."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.phases = {}
+            self.hosts = {}
+
+    def _record(self, table, key, count_name, seconds, nbytes, error):
+        with self._lock:
+            entry = table.get(key)
+            if entry is None:
+                entry = table[key] = _new_entry(count_name)
+            entry[count_name] += 1
+            entry["seconds"] += seconds
+            entry["bytes"] += nbytes
+            if error:
+                entry["errors"][error] = entry["errors"].get(error, 0) + 1
+
+    def record_phase(self, name, seconds, nbytes=0, error=None):
+        self._record(self.phases, name, "count", seconds, nbytes, error)
+
+    def record_request(self, url, seconds, nbytes=0, error=None):
+        host = urlsplit(url).hostname or ""
+        self._record(self.hosts, host, "requests", seconds, nbytes, error)
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as one occurrence of phase ``name``.
+
+        An exception leaving the block is counted under its class name and
+        re-raised.
+        """
+        timer = phaseTimer()
+        start = time.time()
+        try:
+            yield timer
+        except BaseException as exc:
+            timer.error = error_class(exc)
+            raise
+        finally:
+            self.record_phase(name, time.time() - start, timer.bytes, timer.error)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "phases": copy.deepcopy(self.phases),
+                "hosts": copy.deepcopy(self.hosts),
+            }
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.summary(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, path):
+        """Write the run in the Prometheus text format, for node_exporter's
+        textfile collector."""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                label_str = ",".join('{}="{}"'.format(key, _escape(value)) for key, value in labels)
+                lines.append("{}{} {}".format(name, "{" + label_str + "}" if label_str else "", value))
+
+        metric("md_paper_run_duration_seconds", "gauge", "Duration of the last run.",
+               [((), summary["duration"])])
+        metric("md_paper_last_run_timestamp_seconds", "gauge", "Start time of the last run.",
+               [((), summary["started"])])
+        for table, label, count_name, prefix in ((summary["phases"], "phase", "count", "md_paper_phase"),
+                                                 (summary["hosts"], "host", "requests", "md_paper_http")):
+            keys = sorted(table)
+            metric(prefix + "_" + count_name + "_total", "counter", "Occurrences per {}.".format(label),
+                   [(((label, key),), table[key][count_name]) for key in keys])
+            metric(prefix + "_seconds_total", "counter", "Seconds spent per {}.".format(label),
+                   [(((label, key),), table[key]["seconds"]) for key in keys])
+            metric(prefix + "_bytes_total", "counter", "Bytes transferred per {}.".format(label),
+                   [(((label, key),), table[key]["bytes"]) for key in keys])
+            metric(prefix + "_errors_total", "counter", "Errors per {} and error class.".format(label),
+                   [(((label, key), ("error", error)), count)
+                    for key in keys for error, count in sorted(table[key]["errors"].items())])
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+    def log_summary(self):
+        summary = self.summary()
+        if not summary["phases"]:
+            return
+        logger.info("Time per phase: {}".format(", ".join(
+            "{}={:.2f}s ({})".format(name, entry["seconds"], entry["count"])
+            for name, entry in sorted(summary["phases"].items(), key=lambda item: -item[1]["seconds"]))))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomic(path, text):
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+METRICS = runMetrics()
+
+
+def phase(name):
+    return METRICS.phase(name)
+
+
+def record_request(url, seconds, nbytes=0, error=None):
+    METRICS.record_request(url, seconds, nbytes, error)
@@ -1,18 +1,192 @@
+import glob
+import hashlib
+import json
 import logging
-import requests 
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlunsplit, urlsplit
-from bs4 import BeautifulSoup
+
+from .cache import default_cache_dir
+from .clients import get_session
+from .metrics import error_class, phase
 
 logging.basicConfig()
 logger = logging.getLogger('PDFs')
 logger.setLevel(logging.DEBUG)
-HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:27.0) Gecko/20100101 Firefox/27.0'}
+
+CHUNK_SIZE = 64 * 1024
+# page listing the sci-hub mirrors currently up
+SCIHUB_LIST_URL = "https://lovescihub.wordpress.com/"
+PDF_MAGIC = b"%PDF"
+MIRROR_TTL = 6 * 60 * 60
+# number of sci-hub mirrors raced in parallel
+HEDGE_MIRRORS = 3
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-\d+/(?:\d+|\*)")
+# partial downloads not resumed for this long are removed
+PART_TTL = 7 * 24 * 60 * 60
+
+
+def part_path_of(path, url):
+    """The partial file a download of ``url`` to ``path`` is written to, one per url
+    so attempts from different urls do not overwrite each other's progress."""
+    return "{}.{}.part".format(path, hashlib.sha1(url.encode("utf-8")).hexdigest()[:12])
+
+
+def _remove_quietly(paths):
+    for stale_path in paths:
+        try:
+            os.remove(stale_path)
+        except OSError:
+            pass
+
+
+def expire_parts(path, ttl=PART_TTL):
+    """Remove the partial downloads to ``path`` (and their .json) last written more than ``ttl`` seconds ago."""
+    now = time.time()
+    for part_path in glob.glob(glob.escape(path) + ".*.part"):
+        try:
+            expired = now - os.path.getmtime(part_path) > ttl
+        except OSError:
+            continue
+        if expired:
+            logger.info("Removing the expired partial download {}".format(os.path.basename(part_path)))
+            _remove_quietly((part_path, part_path + ".json"))
+    # the .json of a partial file that is gone
+    for meta_path in glob.glob(glob.escape(path) + ".*.part.json"):
+        if not os.path.exists(meta_path[:-len(".json")]):
+            _remove_quietly((meta_path,))
+
+
+def _close_opened(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    result = future.result()
+    if result:
+        result[1][0].close()
+
+
+class mirrorRegistry(object):
+    """Sci-hub mirror list cached on disk with a TTL, and per mirror health
+    statistics used to rank them."""
+    def __init__(self, path=None, ttl=MIRROR_TTL, hedge=HEDGE_MIRRORS):
+        self.path = path or os.path.join(default_cache_dir(), "mirrors.json")
+        self.ttl = ttl
+        self.hedge = hedge
+        self.urls = []
+        self.discovered_at = 0
+        self.stats = {}
+        self._loaded = False
+        self._dirty = False
+        self._lock = threading.Lock()
+        # one thread discovers mirrors at a time, one writes the file at a time
+        self._discover_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def _load(self):
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.urls = data.get("urls", [])
+            self.discovered_at = data.get("discovered_at", 0)
+            self.stats = data.get("stats", {})
+        except (OSError, ValueError):
+            logger.debug("Ignoring unreadable mirror cache {}".format(self.path))
+
+    def save(self):
+        """Write the mirror list and statistics if they changed since the last save."""
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                data = {"urls": self.urls, "discovered_at": self.discovered_at, "stats": self.stats}
+                self._dirty = False
+            parent = os.path.dirname(self.path)
+            try:
+                if parent and not os.path.exists(parent):
+                    os.makedirs(parent)
+                fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".",
+                                                suffix=".tmp", dir=parent or ".")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        json.dump(data, f)
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+            except OSError as exc:
+                logger.debug("Failed to save mirror cache: {}".format(exc))
+
+    def record(self, url, ok, latency):
+        """Record the outcome of one request to a mirror."""
+        with self._lock:
+            stat = self.stats.setdefault(url, {"ok": 0, "failed": 0, "latency": latency})
+            stat["ok" if ok else "failed"] += 1
+            stat["latency"] = 0.7 * stat["latency"] + 0.3 * latency
+            self._dirty = True
+
+    def score(self, url):
+        """Laplace smoothed success rate per second of latency, unknown mirrors
+        rank in the middle."""
+        stat = self.stats.get(url)
+        if not stat:
+            return 0.5 / 2.0
+        success = (stat["ok"] + 1.0) / (stat["ok"] + stat["failed"] + 2.0)
+        return success / (stat["latency"] + 0.5)
+
+    def _is_fresh(self):
+        if not self._loaded:
+            self._load()
+        return self.urls and time.time() - self.discovered_at < self.ttl
+
+    def ranked(self, discover):
+        """Return the mirrors best first, ``discover()`` is called only when
+        the cached list expired, by one thread while the others wait for it."""
+        with self._lock:
+            fresh = self._is_fresh()
+        if not fresh:
+            with self._discover_lock:
+                with self._lock:
+                    fresh = self._is_fresh()
+                if not fresh:
+                    try:
+                        urls = discover()
+                    except Exception as exc:
+                        logger.error("Failed to discover sci-hub mirrors: {}".format(exc))
+                        urls = []
+                    with self._lock:
+                        if urls:
+                            self.urls, self.discovered_at = urls, time.time()
+                            self._dirty = True
+                    self.save()
+        with self._lock:
+            return sorted(self.urls, key=self.score, reverse=True)
+
+
+MIRRORS = mirrorRegistry()
+
+
+def configure_mirrors(path=None, ttl=None, hedge=None):
+    if path is not None:
+        MIRRORS.path = path
+        MIRRORS._loaded = False
+    if ttl is not None:
+        MIRRORS.ttl = ttl
+    if hedge is not None:
+        MIRRORS.hedge = max(1, hedge)
 
 
 class pdfDownload(object):
     def __init__(self):
-        self.sess = requests.Session()
-        self.sess.headers = HEADERS
+        self.sess = get_session()
         
     def set_proxy(self, proxy=None):
         """set proxy for session
@@ -23,9 +197,7 @@ class pdfDownload(object):
             None
         """
         if proxy:
-            self.sess.proxies = {
-                "http": proxy,
-                "https": proxy, }
+            self.sess = get_session(proxy)
     
     
     def _get_available_scihub_urls(self):
@@ -33,24 +205,32 @@ class pdfDownload(object):
         Finds available scihub urls via https://lovescihub.wordpress.com/ or 
         https://sci-hub.now.sh/
         '''
+        from bs4 import BeautifulSoup
+
         urls = []
-        res = self.sess.get('https://lovescihub.wordpress.com/')
-        s = BeautifulSoup(res.content, 'html.parser')
-        for a in s.find('div', class_="entry-content").find_all('a', href=True):
-            if 'sci-hub.' in a['href']:
-                urls.append(a['href'])
+        with phase("mirror_discovery"):
+            res = self.sess.get(SCIHUB_LIST_URL)
+            s = BeautifulSoup(res.content, 'html.parser')
+            for a in s.find('div', class_="entry-content").find_all('a', href=True):
+                if 'sci-hub.' in a['href']:
+                    urls.append(a['href'])
         return urls
     
         
-    def fetch(self, url, auth=None):
+    def fetch(self, url, auth=None, path=None):
         '''Fetch pdf
         
         Args:
             url (str):
+            auth (tuple): ("user", "passwd")
+            path (str): stream the pdf into this file instead of keeping it in memory
 
         Returns:
             A dict OR None
         '''
+        if path:
+            return self.download(url, path, auth=auth)
+
         try:
             r = self.sess.get(url, auth=auth)
         
@@ -65,43 +245,300 @@ class pdfDownload(object):
             logger.error("Failed to open url: {}".format(url))
     
     
-    def get_pdf_from_direct_url(self, url, auth=None):
-        return self.fetch(url, auth=auth) 
+    def _is_pdf_response(self, r):
+        content_type = r.headers.get("Content-Type", "")
+        return content_type.split(";")[0].strip() == "application/pdf"
+
+
+    def _open_pdf(self, url, auth=None, headers=None):
+        '''Open a streaming pdf response and read its first chunk.
+        
+        Returns:
+            A tuple (response, first_chunk, chunks) OR None when the url does
+            not serve a pdf.
+        '''
+        r = self.sess.get(url, auth=auth, stream=True, headers=headers or {})
+        resuming = bool(headers and "Range" in headers)
+        if r.status_code != 200 and not (resuming and r.status_code == 206):
+            logger.info("Failed to fetch pdf with url: {} (HTTP {})".format(url, r.status_code))
+            r.close()
+            return None
+
+        if not self._is_pdf_response(r):
+            logger.info("Failed to fetch pdf with url: {}".format(url))
+            r.close()
+            return None
+
+        chunks = r.iter_content(CHUNK_SIZE)
+        first = next(chunks, b"")
+        if r.status_code == 200 and not first.startswith(PDF_MAGIC):
+            logger.info("Not a pdf file at url: {}".format(url))
+            r.close()
+            return None
+        return r, first, chunks
+
+
+    def _write_pdf(self, url, path, opened):
+        '''Write an opened pdf response to ``path + ".part"`` and move it into place.
+        
+        Returns:
+            A dict OR None
+        '''
+        r, first, chunks = opened
+        part_path = part_path_of(path, url)
+        meta_path = part_path + ".json"
+        mode = "ab" if r.status_code == 206 else "wb"
+
+        expected = r.headers.get("Content-Length")
+        written = 0
+        with phase("pdf_transfer") as transfer:
+            try:
+                if mode == "ab":
+                    # raises when the partial file is gone since the Range request
+                    logger.info("Resuming {} at byte {}".format(os.path.basename(path), os.path.getsize(part_path)))
+                with open(meta_path, "w") as f:
+                    json.dump({"url": url, "etag": r.headers.get("ETag")}, f)
+
+                with open(part_path, mode) as f:
+                    f.write(first)
+                    written += len(first)
+                    for chunk in chunks:
+                        f.write(chunk)
+                        written += len(chunk)
+            except Exception as exc:
+                transfer.error = error_class(exc)
+                if self._resumable(part_path):
+                    logger.error("Download interrupted, kept partial file for url: {}".format(url))
+                else:
+                    logger.error("Download failed for url: {}".format(url))
+                    _remove_quietly((part_path, meta_path))
+                return None
+            finally:
+                transfer.bytes = written
+                r.close()
+
+            if expected is not None and written < int(expected):
+                transfer.error = "Incomplete"
+                logger.error("Download incomplete ({}/{} bytes) for url: {}".format(written, expected, url))
+                return None
+
+        os.replace(part_path, path)
+        # the progress of other urls is of no use any more
+        _remove_quietly([meta_path] + glob.glob(glob.escape(path) + ".*.part*"))
+        return {
+            'path': path,
+            'url': url
+            }
+
+
+    def _read_pdf(self, url, opened):
+        r, first, chunks = opened
+        with phase("pdf_transfer") as transfer:
+            try:
+                content = first + b"".join(chunks)
+            finally:
+                r.close()
+            transfer.bytes = len(content)
+        return {
+            'pdf': content,
+            'url': url
+            }
+
+
+    def _resumable(self, part_path):
+        """Whether ``part_path`` holds the start of a pdf a later download can resume."""
+        try:
+            with open(part_path, "rb") as f:
+                return f.read(len(PDF_MAGIC)) == PDF_MAGIC
+        except OSError:
+            return False
+
+
+    def _resume_headers(self, url, path):
+        part_path = part_path_of(path, url)
+        if not os.path.exists(part_path):
+            return {}
+        try:
+            with open(part_path + ".json", "r") as f:
+                meta = json.load(f)
+            with open(part_path, "rb") as f:
+                head = f.read(len(PDF_MAGIC))
+        except (OSError, ValueError):
+            return {}
+        if meta.get("url") != url or head != PDF_MAGIC:
+            return {}
+        headers = {"Range": "bytes={}-".format(os.path.getsize(part_path))}
+        if meta.get("etag"):
+            headers["If-Range"] = meta["etag"]
+        return headers
+
+
+    def _open_resumable(self, url, path, auth=None):
+        '''Open the pdf at url, resuming the partial file of an earlier download to path.
+        
+        A 206 response whose Content-Range does not start at the end of the
+        partial file is dropped and the download starts over. Partial files
+        not resumed for PART_TTL are removed first.
+        
+        Returns:
+            A tuple (response, first_chunk, chunks) OR None
+        '''
+        expire_parts(path)
+        headers = self._resume_headers(url, path)
+        opened = self._open_pdf(url, auth=auth, headers=headers)
+        if opened is None or opened[0].status_code != 206:
+            return opened
+        part_path = part_path_of(path, url)
+        match = CONTENT_RANGE_PATTERN.match(opened[0].headers.get("Content-Range", ""))
+        if match and os.path.exists(part_path) and int(match.group(1)) == os.path.getsize(part_path):
+            return opened
+        logger.info("Content-Range {!r} does not continue {}, downloading it again".format(
+            opened[0].headers.get("Content-Range"), os.path.basename(part_path)))
+        opened[0].close()
+        _remove_quietly((part_path, part_path + ".json"))
+        return self._open_pdf(url, auth=auth)
+
+
+    def download(self, url, path, auth=None):
+        '''Stream the pdf at url into path.
+        
+        The pdf is written to a ``.part`` file next to path and renamed into place only
+        once complete, an interrupted transfer is resumed with a Range request
+        the next time the same pdf is downloaded.
+        
+        Args:
+            url (str):
+            path (str): The final pdf path.
+            auth (tuple): ("user", "passwd")
+
+        Returns:
+            A dict OR None
+        '''
+        try:
+            opened = self._open_resumable(url, path, auth=auth)
+        except Exception:
+            logger.error("Failed to open url: {}".format(url))
+            return None
+        if opened is None:
+            return None
+        return self._write_pdf(url, path, opened)
+
+
+    def get_pdf_from_direct_url(self, url, auth=None, path=None):
+        return self.fetch(url, auth=auth, path=path) 
     
     
-    def get_pdf_from_sci_hub(self, identifier, auth=None):
+    def _find_pdf_url(self, base_url, content):
+        '''Find the pdf url embedded in a sci-hub page, or None'''
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(content, 'html.parser')
+        
+        pdf_div_names = ['iframe', 'embed']
+        for pdf_div_name in pdf_div_names:
+            pdf_div = soup.find(pdf_div_name)
+            if pdf_div != None:
+                break 
+        if pdf_div is None or not pdf_div.get('src'):
+            return None
+
+        url_parts = urlsplit(pdf_div.get('src'))
+        if url_parts[1]:
+            if url_parts[0]:
+                pdf_url = urlunsplit((url_parts[0], url_parts[1], url_parts[2], '', ''))
+            else:
+                pdf_url = urlunsplit(('https', url_parts[1], url_parts[2], '', ''))
+        else:
+            pdf_url = urlunsplit(('https', urlsplit(base_url)[1], url_parts[2], '', ''))
+        return pdf_url
+
+
+    def _try_mirror(self, base_url, identifier, auth, cancelled, path=None):
+        '''Look identifier up on one mirror and open its pdf.
+        
+        Returns:
+            A tuple (pdf_url, opened) OR None
+        '''
+        start = time.time()
+        opened = None
+        try:
+            # the race itself hedges against a failing mirror, no retries
+            r = self.sess.get(base_url + '/' + identifier, auth=auth, retries=0)
+            pdf_url = self._find_pdf_url(base_url, r.content)
+            if pdf_url and not cancelled.is_set():
+                if path:
+                    opened = self._open_resumable(pdf_url, path, auth=auth)
+                else:
+                    opened = self._open_pdf(pdf_url, auth=auth)
+        except Exception:
+            logger.debug("Mirror {} failed for {}".format(base_url, identifier))
+        if not cancelled.is_set():
+            MIRRORS.record(base_url, opened is not None, time.time() - start)
+
+        if opened is None:
+            return None
+        if cancelled.is_set():
+            opened[0].close()
+            return None
+        return pdf_url, opened
+
+
+    def _race_mirrors(self, base_urls, identifier, auth=None, path=None):
+        '''Query several mirrors at once, the first one serving a pdf wins.
+        
+        Returns:
+            A tuple (pdf_url, opened) OR None
+        '''
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(base_urls))
+        futures = [executor.submit(self._try_mirror, base_url, identifier, auth, cancelled, path)
+                   for base_url in base_urls]
+        winner, winner_future = None, None
+        try:
+            for future in as_completed(futures):
+                winner = future.result()
+                if winner:
+                    winner_future = future
+                    break
+        finally:
+            cancelled.set()
+            for future in futures:
+                if future is not winner_future:
+                    future.add_done_callback(_close_opened)
+            executor.shutdown(wait=False, cancel_futures=True)
+        return winner
+
+
+    def get_pdf_from_sci_hub(self, identifier, auth=None, path=None):
         '''Fetch pdf from sci-hub based on doi or url
         
+        The best ranked mirrors are queried in parallel, ``MIRRORS.hedge`` at
+        a time, and the first one serving a pdf is used. The mirror
+        statistics are saved by MIRRORS.save() once the run is done.
+        
         Args: 
             identifier (str): DOI or url
             auth (tuple): ("user", "passwd")
+            path (str): stream the pdf into this file instead of keeping it in memory
         
         Returns:
             A dict OR None
         '''
-        for base_url in self._get_available_scihub_urls():
-            r = self.sess.get(base_url + '/' + identifier, auth=auth)
-            soup = BeautifulSoup(r.content, 'html.parser')
-            
-            pdf_div_names = ['iframe', 'embed']
-            for pdf_div_name in pdf_div_names:
-                pdf_div = soup.find(pdf_div_name)
-                if pdf_div != None:
-                    break 
-            try:
-                url_parts = urlsplit(pdf_div.get('src'))
-                if url_parts[1]:
-                    if url_parts[0]:
-                        pdf_url = urlunsplit((url_parts[0], url_parts[1], url_parts[2], '', ''))
-                    else:
-                        pdf_url = urlunsplit(('https', url_parts[1], url_parts[2], '', ''))
-                else:
-                    pdf_url = urlunsplit(('https', urlsplit(base_url)[1], url_parts[2], '', ''))
-                    
-                return self.fetch(pdf_url, auth)
-            except:
-                pass
-    
+        base_urls = MIRRORS.ranked(self._get_available_scihub_urls)
+        for i in range(0, len(base_urls), MIRRORS.hedge):
+            with phase("scihub_lookup"):
+                winner = self._race_mirrors(base_urls[i:i + MIRRORS.hedge], identifier, auth=auth,
+                                            path=path)
+            if not winner:
+                continue
+            pdf_url, opened = winner
+            if path:
+                result = self._write_pdf(pdf_url, path, opened)
+            else:
+                result = self._read_pdf(pdf_url, opened)
+            if result:
+                return result
+
         logger.info("Failed to fetch pdf with all sci-hub urls")
 
     def _save(self, content, path):
@@ -115,7 +552,6 @@ if __name__ == "__main__":
     pdf_download = pdfDownload()
     pdf_download.set_proxy("127.0.0.1:7890")
     
-    pdf_dict = pdf_download.get_pdf_from_sci_hub(doi)
+    pdf_dict = pdf_download.get_pdf_from_sci_hub(doi, path="/home/admin/tmp.pdf")
     if pdf_dict:
-        print(pdf_dict['url'])
-        pdf_download.download(pdf_dict['pdf'] ,"/home/admin/tmp.pdf")
\ No newline at end of file
+        print(pdf_dict['url'])
\ No newline at end of file
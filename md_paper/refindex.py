@@ -0,0 +1,286 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from .cache import default_cache_dir, normalize_identifier
+from .tokenizer import code_blocks, tokenize
+
+logging.basicConfig()
+logger = logging.getLogger('refindex')
+logger.setLevel(logging.INFO)
+
+INDEX_NAME = "references.sqlite"
+DOI_PATTERN = re.compile(r"10\.\d{4,9}/[-._;()/:A-Z0-9]+", re.IGNORECASE)
+ARXIV_URL_PATTERN = re.compile(r"arxiv\.org/(?:abs|pdf)/([0-9]{4}\.[0-9]{4,5}|[a-z-]+/[0-9]{7})", re.IGNORECASE)
+
+# state of an indexed line
+UNRESOLVED = "unresolved"
+FAILED = "failed"
+RESOLVED = "resolved"
+MENTION = "mention"
+STATES = (UNRESOLVED, FAILED, RESOLVED, MENTION)
+
+
+def normalize_doi(raw):
+    return raw.rstrip(").,;").lower()
+
+
+def reference_identifier(paper_id):
+    """The key a paper id as written in a note is indexed under."""
+    identifier = normalize_identifier(paper_id)
+    if DOI_PATTERN.match(identifier):
+        identifier = normalize_doi(identifier)
+    return identifier
+
+
+def rendered_aliases(refs, replace_dict):
+    """Pair the identifiers of rendered lines with the paper ids they replaced.
+
+    A resolved ``- {2208.05623}`` is indexed under the DOI of its rendered
+    line, the pairs let the index find it under 2208.05623 as well.
+
+    Args:
+        refs (list): The paperReference of a note.
+        replace_dict (dict): Maps reference texts to their rendered lines.
+
+    Returns:
+        A list of (identifier of the rendered line, paper id as written).
+    """
+    aliases = []
+    for ref in refs:
+        rendered = replace_dict.get(ref.text)
+        if not rendered:
+            continue
+        alias = reference_identifier(ref.paper_id)
+        for identifier, _, _, state in parse_references(rendered):
+            if state == RESOLVED and identifier != alias:
+                aliases.append((identifier, alias))
+    return aliases
+
+
+def parse_references(content):
+    """Find the paper identifiers of a note, line by line.
+
+    The references tokenize finds are unresolved (failed when md-paper
+    marked them), rendered ``- **Title**...([link](...))`` lines are
+    resolved under their DOI and arXiv id, any other line carrying a DOI
+    is a mention. Fenced code blocks are skipped like tokenize skips them.
+
+    Returns:
+        A list of (identifier, line number from 0, character offset, state).
+    """
+    references = tokenize(content)
+    blocks = code_blocks(content)
+    refs = []
+    offset = 0
+    position = 0
+    block = 0
+    for number, line in enumerate(content.splitlines(True)):
+        end = offset + len(line)
+        identifiers = set()
+        while position < len(references) and references[position].start < end:
+            reference = references[position]
+            position += 1
+            identifier = reference_identifier(reference.paper_id)
+            if identifier not in identifiers:
+                identifiers.add(identifier)
+                state = FAILED if reference.marks_end > reference.end else UNRESOLVED
+                refs.append((identifier, number, offset, state))
+        while block < len(blocks) and blocks[block][1] <= offset:
+            block += 1
+        in_block = block < len(blocks) and blocks[block][0] <= offset
+        if not identifiers and not in_block:
+            rendered = line.lstrip().startswith("- **") and "[link](" in line
+            doi = DOI_PATTERN.search(line)
+            if doi:
+                refs.append((normalize_doi(doi.group()), number, offset, RESOLVED if rendered else MENTION))
+            arxiv = ARXIV_URL_PATTERN.search(line) if rendered else None
+            if arxiv:
+                refs.append((arxiv.group(1).lower(), number, offset, RESOLVED))
+        offset = end
+    return refs
+
+
+class referenceIndex(object):
+    """Persistent index of the paper identifiers cited by the notes of a vault.
+
+    Each note is stored with its mtime and size, so a note is parsed again
+    only after it changed.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(default_cache_dir(), INDEX_NAME)
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS notes ("
+            " path TEXT PRIMARY KEY,"
+            " mtime_ns INTEGER NOT NULL,"
+            " size INTEGER NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS refs ("
+            " identifier TEXT NOT NULL,"
+            " path TEXT NOT NULL,"
+            " line INTEGER NOT NULL,"
+            " offset INTEGER NOT NULL,"
+            " state TEXT NOT NULL,"
+            " PRIMARY KEY (path, line, identifier))")
+        # the paper ids resolved references were written as, see rendered_aliases
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS aliases ("
+            " path TEXT NOT NULL,"
+            " identifier TEXT NOT NULL,"
+            " alias TEXT NOT NULL,"
+            " PRIMARY KEY (path, identifier, alias))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS refs_identifier ON refs (identifier)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS refs_state ON refs (state)")
+        self.conn.commit()
+
+    def _key(self, path):
+        return os.path.abspath(path)
+
+    def is_current(self, path, st):
+        """True if ``path`` was indexed with the mtime and size of ``st``."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT mtime_ns, size FROM notes WHERE path = ?", (self._key(path),)).fetchone()
+        return row is not None and row[0] == st.st_mtime_ns and row[1] == st.st_size
+
+    def update(self, path, content, st=None, aliases=None):
+        """Index the current content of a note.
+
+        Args:
+            aliases (list): (identifier, alias) pairs from rendered_aliases,
+                kept for the note so its rendered lines are also indexed
+                under the paper ids they were written as.
+        """
+        st = st or os.stat(path)
+        key = self._key(path)
+        refs = parse_references(content)
+        with self._lock:
+            if aliases:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO aliases (path, identifier, alias) VALUES (?, ?, ?)",
+                    [(key, identifier, alias) for identifier, alias in aliases])
+            known = {}
+            for identifier, alias in self.conn.execute(
+                    "SELECT identifier, alias FROM aliases WHERE path = ?", (key,)):
+                known.setdefault(identifier, []).append(alias)
+            if known:
+                rows = set((identifier, line) for identifier, line, _, _ in refs)
+                for identifier, line, offset, state in list(refs):
+                    if state != RESOLVED:
+                        continue
+                    for alias in known.get(identifier, ()):
+                        if (alias, line) not in rows:
+                            rows.add((alias, line))
+                            refs.append((alias, line, offset, RESOLVED))
+            self.conn.execute("DELETE FROM refs WHERE path = ?", (key,))
+            self.conn.executemany(
+                "INSERT INTO refs (identifier, path, line, offset, state) VALUES (?, ?, ?, ?, ?)",
+                [(identifier, key, line, offset, state) for identifier, line, offset, state in refs])
+            self.conn.execute(
+                "INSERT OR REPLACE INTO notes (path, mtime_ns, size) VALUES (?, ?, ?)",
+                (key, st.st_mtime_ns, st.st_size))
+        return refs
+
+    def refresh(self, path, st=None):
+        """Index a note unless it is indexed already.
+
+        Returns:
+            True if the note was (re)indexed.
+        """
+        st = st or os.stat(path)
+        if self.is_current(path, st):
+            return False
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            content = f.read()
+        self.update(path, content, st)
+        return True
+
+    def forget(self, path):
+        key = self._key(path)
+        with self._lock:
+            self.conn.execute("DELETE FROM refs WHERE path = ?", (key,))
+            self.conn.execute("DELETE FROM aliases WHERE path = ?", (key,))
+            self.conn.execute("DELETE FROM notes WHERE path = ?", (key,))
+
+    def prune(self, root):
+        """Forget the notes under ``root`` that no longer exist.
+
+        Returns:
+            The number of notes forgotten.
+        """
+        prefix = os.path.join(self._key(root), "")
+        with self._lock:
+            paths = [row[0] for row in self.conn.execute(
+                "SELECT path FROM notes WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))]
+        gone = [path for path in paths if not os.path.exists(path)]
+        for path in gone:
+            self.forget(path)
+        return len(gone)
+
+    def identifier_lines(self, path, content, st):
+        """Map the identifiers of a note to their line numbers (from 0),
+        from the index when it is current, else by parsing ``content``."""
+        if self.is_current(path, st):
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT identifier, line FROM refs WHERE path = ? ORDER BY line",
+                    (self._key(path),)).fetchall()
+        else:
+            rows = [(identifier, line) for identifier, line, _, _ in self.update(path, content, st)]
+        # the last line citing a paper wins, like the scan it replaces
+        return {identifier: line for identifier, line in rows}
+
+    def lookup(self, identifiers=None, path=None, states=None):
+        """Find indexed references.
+
+        Args:
+            identifiers (list): Only these paper ids.
+            path (str): Only the references of this note.
+            states (list): Only references in these states.
+
+        Returns:
+            A list of (identifier, path, line number from 0, offset, state).
+        """
+        clauses, params = [], []
+        if identifiers:
+            keys = [reference_identifier(identifier) for identifier in identifiers]
+            clauses.append("identifier IN ({})".format(",".join("?" * len(keys))))
+            params.extend(keys)
+        if path:
+            clauses.append("path = ?")
+            params.append(self._key(path))
+        if states:
+            clauses.append("state IN ({})".format(",".join("?" * len(states))))
+            params.extend(states)
+        query = "SELECT identifier, path, line, offset, state FROM refs"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        with self._lock:
+            return self.conn.execute(query + " ORDER BY path, line", params).fetchall()
+
+    def stats(self):
+        """Returns a dict with the number of notes, papers and references per state."""
+        with self._lock:
+            notes = self.conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+            papers = self.conn.execute("SELECT COUNT(DISTINCT identifier) FROM refs").fetchone()[0]
+            states = dict(self.conn.execute("SELECT state, COUNT(*) FROM refs GROUP BY state").fetchall())
+        return {"notes": notes, "papers": papers, "references": {state: states.get(state, 0) for state in STATES}}
+
+    def commit(self):
+        with self._lock:
+            self.conn.commit()
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
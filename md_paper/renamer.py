@@ -1,17 +1,52 @@
 import logging
+import multiprocessing
 import os
+import queue
 import re
-from typing import List, Optional
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from pypdf import PdfReader
 
-from .crossref import crossrefInfo
+from .cache import file_sha256, metadataCache, pdfDoiCache
+from .crossref import crossrefInfo, CROSSREF_BATCH_SIZE
+from .fileio import atomic_write, read_note
+from .metrics import METRICS, error_class, phase
+from .refindex import referenceIndex
 
 logger = logging.getLogger("Renamer")
 logger.setLevel(logging.INFO)
 
 DOI_PATTERN = re.compile(r"10\.\d{4,9}/[-._;()/:A-Z0-9]+", re.IGNORECASE)
 INVALID_FILENAME_CHARS = re.compile(r"[<>:\"/\\|?*\n\r\x00-\x1F\x7F']")
+STREAM_PATTERN = re.compile(rb"stream\r?\n(.*?)\r?\nendstream", re.DOTALL)
+# a literal (string) of a content stream, the text of Tj operators and /URI values
+LITERAL = rb"\((?:\\.|[^\\()])*\)"
+LITERAL_PATTERN = re.compile(rb"\(((?:\\.|[^\\()])*)\)", re.DOTALL)
+LITERAL_ESCAPE = re.compile(rb"\\([\\()])")
+# a BT ... ET text object, and within it a TJ array or a single literal
+TEXT_OBJECT_PATTERN = re.compile(rb"\bBT\b(.*?)\bET\b", re.DOTALL)
+TEXT_PIECE_PATTERN = re.compile(rb"\[(?P<array>(?:" + LITERAL + rb"|[^\]()])*)\]\s*TJ|(?P<literal>" + LITERAL + rb")",
+                                re.DOTALL)
+# a TJ kerning at least this wide is a word space, as pypdf takes it
+TJ_SPACE = 250
+KERNING_PATTERN = re.compile(rb"[-+]?(?:\d+\.?\d*|\.\d+)")
+RAW_SCAN_STREAMS = 8
+RAW_SCAN_BYTES = 512 * 1024
+# which tier of extract_doi_with_tier found the DOI in extract_doi_from_pdf,
+# for this process; a rename run counts its own
+DOI_TIER_COUNTS: Counter = Counter()
+# PDFs in flight between two pipeline stages
+PIPELINE_QUEUE_SIZE = 64
+# renamed pdfs written to the note at once
+NOTE_BATCH_SIZE = 500
+_DONE = object()
+# per process connections of _extract_job to the DOI cache
+_WORKER_DOI_CACHES: Dict[str, pdfDoiCache] = {}
 
 
 def normalize_doi(raw: Optional[str]) -> Optional[str]:
@@ -20,32 +55,165 @@ def normalize_doi(raw: Optional[str]) -> Optional[str]:
     return raw.rstrip(").,;").lower()
 
 
-def extract_doi_from_pdf(pdf_path: str, max_pages: int = 5) -> Optional[str]:
-    """Read up to ``max_pages`` pages from ``pdf_path`` and return the first DOI."""
+def _search_doi(text: Optional[str]) -> Optional[str]:
+    if not text:
+        return None
+    match = DOI_PATTERN.search(text)
+    if not match:
+        return None
+    return normalize_doi(match.group(0))
+
+
+def _doi_from_info(reader: PdfReader) -> Optional[str]:
+    info = reader.metadata or {}
+    # publishers use /doi, /WPS-ARTICLEDOI, /Subject or /Keywords for it
+    for key in sorted(info.keys(), key=lambda k: "doi" not in k.lower()):
+        value = info.get(key)
+        if isinstance(value, str):
+            doi = _search_doi(value)
+            if doi:
+                return doi
+    return None
+
+
+def _doi_from_xmp(reader: PdfReader) -> Optional[str]:
+    metadata = reader.trailer["/Root"].get("/Metadata")
+    if metadata is None:
+        return None
+    data = metadata.get_object().get_data()
+    return _search_doi(data.decode("utf-8", "ignore"))
+
+
+def _doi_from_annotations(reader: PdfReader) -> Optional[str]:
+    if not reader.pages:
+        return None
+    for annot in reader.pages[0].get("/Annots") or []:
+        action = annot.get_object().get("/A")
+        if action is None:
+            continue
+        uri = action.get_object().get("/URI")
+        if isinstance(uri, bytes):
+            uri = uri.decode("latin-1")
+        if uri and "doi" in str(uri).lower():
+            doi = _search_doi(str(uri))
+            if doi:
+                return doi
+    return None
+
+
+def _literal_text(literal: bytes) -> str:
+    return LITERAL_ESCAPE.sub(rb"\1", literal[1:-1]).decode("latin-1")
+
+
+def _text_object_text(block: bytes) -> str:
+    """The text a BT ... ET object shows, one line per text operator.
+
+    The literals of a TJ array are joined, as text is often split between
+    them for kerning, e.g. [(doi: 10.1038/s41)-20(467-022-29269-6)] TJ.
+    """
+    lines = []
+    for piece in TEXT_PIECE_PATTERN.finditer(block):
+        if piece.group("literal") is not None:
+            lines.append(_literal_text(piece.group("literal")))
+            continue
+        parts = []
+        array = piece.group("array")
+        position = 0
+        for literal in LITERAL_PATTERN.finditer(array):
+            for kerning in KERNING_PATTERN.findall(array[position:literal.start()]):
+                if -float(kerning) >= TJ_SPACE:
+                    parts.append(" ")
+            parts.append(_literal_text(literal.group()))
+            position = literal.end()
+        lines.append("".join(parts))
+    return "\n".join(lines)
+
+
+def _stream_texts(data: bytes) -> Iterator[str]:
+    """The text objects of a content stream, then its other literals (e.g. /URI values)."""
+    position = 0
+    rest = []
+    for block in TEXT_OBJECT_PATTERN.finditer(data):
+        rest.append(data[position:block.start()])
+        position = block.end()
+        yield _text_object_text(block.group(1))
+    rest.append(data[position:])
+    for literal in LITERAL_PATTERN.finditer(b" ".join(rest)):
+        yield _literal_text(literal.group())
+
+
+def _doi_from_raw_streams(pdf_path: str, max_streams: int = RAW_SCAN_STREAMS,
+                          max_bytes: int = RAW_SCAN_BYTES) -> Optional[str]:
+    """Scan the text of the first stream objects of the file without parsing the PDF."""
+    with open(pdf_path, "rb") as handle:
+        head = handle.read(max_bytes)
+    for index, match in enumerate(STREAM_PATTERN.finditer(head)):
+        if index >= max_streams:
+            break
+        data = match.group(1)
+        try:
+            data = zlib.decompress(data)
+        except zlib.error:
+            pass
+        # only the text of string literals, a DOI matched in the operators
+        # around them would run on into the operators, e.g. "...-6)tj"
+        for text in _stream_texts(data):
+            doi = _search_doi(text)
+            if doi:
+                return doi
+    return None
+
+
+def extract_doi_with_tier(pdf_path: str, max_pages: int = 5) -> Tuple[Optional[str], Optional[str]]:
+    """Find the DOI of ``pdf_path``, trying the cheapest sources first.
+
+    The document info dictionary, the XMP metadata, the link annotations of
+    the first page and the first raw stream objects are checked before text
+    is extracted from up to ``max_pages`` pages, one page at a time.
+
+    Returns:
+        (doi, tier) where tier names the source that found the DOI, or
+        (None, None).
+    """
     try:
         reader = PdfReader(pdf_path)
     except Exception as exc:
         logger.warning("Failed to read PDF %s: %s", pdf_path, exc)
-        return None
+        return None, None
+
+    tiers = [
+        ("info", lambda: _doi_from_info(reader)),
+        ("xmp", lambda: _doi_from_xmp(reader)),
+        ("annotation", lambda: _doi_from_annotations(reader)),
+        ("raw", lambda: _doi_from_raw_streams(pdf_path)),
+    ]
+    for tier, find in tiers:
+        try:
+            doi = find()
+        except Exception as exc:
+            logger.debug("DOI lookup in %s of %s failed: %s", tier, pdf_path, exc)
+            continue
+        if doi:
+            return doi, tier
 
-    text_chunks: List[str] = []
     for page_index, page in enumerate(reader.pages[:max_pages]):
         try:
             text = page.extract_text() or ""
         except Exception as exc:
             logger.debug("Failed to extract text from page %s: %s", page_index, exc)
-            text = ""
-        text_chunks.append(text)
+            continue
+        doi = _search_doi(text)
+        if doi:
+            return doi, "text"
 
-    if not text_chunks:
-        return None
+    return None, None
 
-    content = "\n".join(text_chunks)
-    match = DOI_PATTERN.search(content)
-    if not match:
-        return None
 
-    return normalize_doi(match.group(0))
+def extract_doi_from_pdf(pdf_path: str, max_pages: int = 5) -> Optional[str]:
+    """Return the first DOI found in ``pdf_path``, see extract_doi_with_tier."""
+    doi, tier = extract_doi_with_tier(pdf_path, max_pages=max_pages)
+    DOI_TIER_COUNTS[tier or "none"] += 1
+    return doi
 
 
 def sanitize_title_for_filename(title: str) -> str:
@@ -54,17 +222,286 @@ def sanitize_title_for_filename(title: str) -> str:
     return sanitized or "paper"
 
 
-def ensure_unique_path(path: str) -> str:
-    base, ext = os.path.splitext(path)
-    counter = 1
-    candidate = path
-    while os.path.exists(candidate):
-        candidate = f"{base}_{counter}{ext}"
-        counter += 1
-    return candidate
+def is_named_after(name: str, filename: str) -> bool:
+    """True if ``name`` is ``filename`` or one of the ``base_N.ext`` names takenNames gives instead."""
+    if name == filename:
+        return True
+    base, ext = os.path.splitext(filename)
+    suffix = name[len(base) + 1:len(name) - len(ext)]
+    return name.startswith(base + "_") and name.endswith(ext) and suffix.isdigit()
+
+
+class takenNames(object):
+    """The file names of the folders pdfs are renamed in.
+
+    Each folder is listed once, the first time a pdf is renamed in it, and
+    kept up to date as files are renamed, so finding a free name does not
+    touch the disk.
+    """
+    def __init__(self) -> None:
+        self.folders: Dict[str, set] = {}
+
+    def _names(self, folder: str) -> set:
+        names = self.folders.get(folder)
+        if names is None:
+            names = self.folders[folder] = set(os.listdir(folder))
+        return names
+
+    def claim(self, path: str) -> str:
+        """Reserve ``path``, or ``base_1.ext``, ``base_2.ext``... if it is taken."""
+        folder, filename = os.path.split(path)
+        names = self._names(folder)
+        base, ext = os.path.splitext(filename)
+        counter = 1
+        candidate = filename
+        while candidate in names:
+            candidate = f"{base}_{counter}{ext}"
+            counter += 1
+        names.add(candidate)
+        return os.path.join(folder, candidate)
+
+    def release(self, path: str) -> None:
+        folder, filename = os.path.split(path)
+        self._names(folder).discard(filename)
+
+
+def iter_pdfs(pdf_dir: str, recursive: bool = False,
+              skip: Optional[set] = None) -> Iterator[Tuple[str, str]]:
+    """The pdfs of ``pdf_dir`` in name order, or with ``recursive`` streamed
+    as ``os.scandir`` lists the folder tree.
+
+    Args:
+        pdf_dir: The folder.
+        recursive: Descend into subfolders, hidden ones excepted.
+        skip: Paths not to yield, the renamer adds the names it renames
+            files to while the folders are still being listed.
+
+    Yields:
+        (name, path)
+    """
+    if not recursive:
+        # a single folder is listed up front, so its entries go to the note in name order
+        pdfs = []
+        with os.scandir(pdf_dir) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(".pdf") and entry.is_file():
+                    pdfs.append((entry.name, entry.path))
+        yield from sorted(pdfs)
+        return
+
+    folders = [pdf_dir]
+    while folders:
+        folder = folders.pop()
+        subfolders = []
+        try:
+            entries = os.scandir(folder)
+        except OSError as exc:
+            logger.warning("Failed to list %s: %s", folder, exc)
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith("."):
+                        subfolders.append(entry.path)
+                elif entry.name.lower().endswith(".pdf") and entry.is_file():
+                    if skip is None or entry.path not in skip:
+                        yield entry.name, entry.path
+        folders.extend(reversed(subfolders))
+
+
+def resolve_dois(client: crossrefInfo, dois: List[str],
+                 cache: Optional[metadataCache] = None) -> Dict[str, dict]:
+    """Resolve DOIs with CrossRef, batched when there is more than one."""
+    bibs = {}
+    unique = []
+    for doi in dict.fromkeys(dois):
+        bib = cache.get(doi) if cache is not None else None
+        if bib:
+            bibs[doi] = bib
+        else:
+            unique.append(doi)
 
+    with phase("crossref"):
+        if len(unique) > 1:
+            resolved = client.get_info_by_dois(unique)
+        else:
+            resolved = {}
+            for doi in unique:
+                bib = client.get_info_by_doi(doi)
+                if bib:
+                    resolved[doi] = bib
+
+    if cache is not None:
+        for doi, bib in resolved.items():
+            cache.put(doi, bib)
+    bibs.update(resolved)
+    return bibs
+
+
+def _timed_extract(pdf_path: str) -> Tuple[Optional[str], Optional[str], float]:
+    start = time.time()
+    doi, tier = extract_doi_with_tier(pdf_path)
+    return doi, tier, time.time() - start
+
+
+def _extract_job(pdf_path: str, doi_cache_path: Optional[str] = None) -> Tuple[Optional[str], Optional[str], Optional[str], float]:
+    """Process pool job: hash the pdf, and extract its DOI unless the hash is known.
+
+    Returns:
+        (doi, tier, sha256, seconds spent parsing the pdf)
+    """
+    if not doi_cache_path:
+        doi, tier, seconds = _timed_extract(pdf_path)
+        return doi, tier, None, seconds
+
+    sha256 = file_sha256(pdf_path)
+    doi_cache = _WORKER_DOI_CACHES.get(doi_cache_path)
+    if doi_cache is None:
+        doi_cache = _WORKER_DOI_CACHES[doi_cache_path] = pdfDoiCache(doi_cache_path)
+    found, doi = doi_cache.lookup_hash(sha256)
+    if found:
+        return doi, "cache", sha256, 0.0
+    doi, tier, seconds = _timed_extract(pdf_path)
+    return doi, tier, sha256, seconds
+
+
+def _done(result: tuple) -> Future:
+    future: Future = Future()
+    future.set_result(result)
+    return future
+
+
+def _extract_stage(pdf_paths: Iterable[Tuple[str, str]], executor: Executor, out_queue: queue.Queue,
+                   doi_cache: Optional[pdfDoiCache] = None) -> None:
+    """Submit DOI extraction jobs, blocking while ``out_queue`` is full.
+
+    Pdfs the DOI cache knows by path, size and mtime skip the process pool.
+    """
+    doi_cache_path = doi_cache.path if doi_cache is not None else None
+    try:
+        for name, pdf_path in pdf_paths:
+            if doi_cache is not None:
+                found, doi = doi_cache.lookup(pdf_path, os.stat(pdf_path))
+                if found:
+                    out_queue.put((name, pdf_path, _done((doi, "cache", None, 0.0))))
+                    continue
+            out_queue.put((name, pdf_path, executor.submit(_extract_job, pdf_path, doi_cache_path)))
+    finally:
+        out_queue.put(_DONE)
+
+
+def _resolve_stage(client: crossrefInfo, in_queue: queue.Queue, out_queue: queue.Queue,
+                   batch_size: int, cache: Optional[metadataCache] = None,
+                   doi_cache: Optional[pdfDoiCache] = None,
+                   tier_counts: Optional[Counter] = None) -> None:
+    """Collect extracted DOIs into CrossRef batches and pass the results on.
+
+    A batch is sent when it is full or when no extraction result is waiting,
+    so the network never idles behind a slow PDF.
+    """
+    batch: List[Tuple[str, str, str]] = []
+
+    def flush() -> None:
+        bibs = resolve_dois(client, [doi for _, _, doi in batch], cache=cache)
+        for name, pdf_path, doi in batch:
+            out_queue.put((name, pdf_path, doi, bibs.get(doi)))
+        del batch[:]
 
-def rename_pdfs_in_directory(pdf_dir: str, note_file: str, proxy: Optional[str] = None) -> None:
+    try:
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                break
+            name, pdf_path, future = item
+            try:
+                doi, tier, sha256, seconds = future.result()
+            except Exception as exc:
+                logger.warning("Failed to extract DOI from %s: %s", pdf_path, exc)
+                doi, tier, sha256, seconds = None, None, None, 0.0
+                METRICS.record_phase("pdf_parse", 0.0, error=error_class(exc))
+            else:
+                if tier != "cache":
+                    METRICS.record_phase("pdf_parse", seconds)
+            if tier_counts is not None:
+                tier_counts[tier or "none"] += 1
+            if doi_cache is not None and sha256:
+                doi_cache.store(pdf_path, sha256, doi)
+            if not doi:
+                logger.warning("No DOI detected in %s", pdf_path)
+            else:
+                batch.append((name, pdf_path, doi))
+            if batch and (len(batch) >= batch_size or in_queue.empty()):
+                flush()
+        if batch:
+            flush()
+    finally:
+        out_queue.put(_DONE)
+
+
+def _worker_context():
+    """Start extraction workers without forking, this process has threads and
+    SQLite connections open a forked worker would inherit mid-use."""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def run_rename_pipeline(pdf_paths: Iterable[Tuple[str, str]], client: crossrefInfo,
+                        processes: Optional[int] = None,
+                        queue_size: int = PIPELINE_QUEUE_SIZE,
+                        cache: Optional[metadataCache] = None,
+                        doi_cache: Optional[pdfDoiCache] = None,
+                        tier_counts: Optional[Counter] = None) -> Iterator[Tuple[str, str, str, Optional[dict]]]:
+    """Extract DOIs on a process pool and resolve them with CrossRef concurrently.
+
+    The extraction, resolution and (caller side) rename stages are linked by
+    bounded queues, so CPU bound pypdf parsing overlaps with CrossRef
+    round-trips while memory stays bounded. ``tier_counts`` counts which
+    tier found each DOI.
+
+    Yields:
+        (name, pdf_path, doi, bib) in the order of ``pdf_paths``, ``bib`` is
+        None when CrossRef returned nothing.
+    """
+    processes = processes or os.cpu_count() or 1
+    extracted: queue.Queue = queue.Queue(maxsize=queue_size)
+    resolved: queue.Queue = queue.Queue(maxsize=queue_size)
+
+    if processes > 1:
+        executor: Executor = ProcessPoolExecutor(max_workers=processes, mp_context=_worker_context())
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    with executor:
+        stages = [
+            threading.Thread(target=_extract_stage, args=(pdf_paths, executor, extracted, doi_cache),
+                             daemon=True),
+            threading.Thread(target=_resolve_stage,
+                             args=(client, extracted, resolved, CROSSREF_BATCH_SIZE, cache, doi_cache,
+                                   tier_counts),
+                             daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+        while True:
+            item = resolved.get()
+            if item is _DONE:
+                break
+            yield item
+        for stage in stages:
+            stage.join()
+
+
+def rename_pdfs_in_directory(pdf_dir: str, note_file: str, proxy: Optional[str] = None,
+                             processes: Optional[int] = None, cache: Optional[metadataCache] = None,
+                             doi_cache: Optional[pdfDoiCache] = None,
+                             index: Optional[referenceIndex] = None, recursive: bool = False) -> None:
+    """Rename the pdfs of ``pdf_dir`` after their titles and write their entries to ``note_file``.
+
+    The folder is streamed through the extract, resolve and rename stages,
+    with ``recursive`` its subfolders as well, each pdf staying in its
+    folder. Entries are written to the note every NOTE_BATCH_SIZE pdfs.
+    """
     if not os.path.isdir(pdf_dir):
         logger.error("PDF directory does not exist: %s", pdf_dir)
         return
@@ -93,66 +530,94 @@ def rename_pdfs_in_directory(pdf_dir: str, note_file: str, proxy: Optional[str]
     if proxy:
         client.set_proxy(proxy)
 
-    renamed_entries = []
+    # names pdfs are renamed to, iter_pdfs may still be listing their folder
+    renamed_to: set = set()
+    taken = takenNames()
+    pdf_paths = iter_pdfs(pdf_dir, recursive=recursive, skip=renamed_to)
 
-    for name in sorted(os.listdir(pdf_dir)):
-        if not name.lower().endswith(".pdf"):
-            continue
-        pdf_path = os.path.join(pdf_dir, name)
-        if not os.path.isfile(pdf_path):
-            continue
+    pending_entries = []
+    entry_count = 0
+    tier_counts: Counter = Counter()
 
-        doi = extract_doi_from_pdf(pdf_path)
-        if not doi:
-            logger.warning("No DOI detected in %s", pdf_path)
-            continue
-
-        bib = client.get_info_by_doi(doi)
+    for name, pdf_path, doi, bib in run_rename_pipeline(pdf_paths, client, processes=processes,
+                                                        cache=cache, doi_cache=doi_cache,
+                                                        tier_counts=tier_counts):
         if not bib:
             logger.warning("CrossRef returned no info for %s", doi)
             continue
 
-        bib["doi"] = normalize_doi(doi)
+        bib = dict(bib, doi=normalize_doi(doi))
 
         new_filename = sanitize_title_for_filename(bib["title"]) + ".pdf"
-        new_path = ensure_unique_path(os.path.join(pdf_dir, new_filename))
-
-        if new_filename == name:
+        if is_named_after(name, new_filename):
             logger.info("File %s already matches naming convention, skipping", name)
-            renamed_entries.append((bib, pdf_path))
-            continue
+            pending_entries.append((bib, pdf_path))
+        else:
+            new_path = taken.claim(os.path.join(os.path.dirname(pdf_path), new_filename))
+            renamed_to.add(new_path)
+            try:
+                os.rename(pdf_path, new_path)
+            except Exception as exc:
+                logger.error("Failed to rename %s -> %s: %s", pdf_path, new_path, exc)
+                taken.release(new_path)
+                continue
+            taken.release(pdf_path)
+            if doi_cache is not None:
+                doi_cache.moved(pdf_path, new_path)
+
+            pending_entries.append((bib, new_path))
+            logger.info("Renamed %s -> %s", os.path.basename(pdf_path), os.path.basename(new_path))
+
+        if len(pending_entries) >= NOTE_BATCH_SIZE:
+            # later batches continue the entries of the first one
+            append_metadata_to_note(note_file, pending_entries, index=index, separate=not entry_count)
+            entry_count += len(pending_entries)
+            pending_entries = []
+
+    if tier_counts:
+        logger.info("DOI found by tier: %s", ", ".join(
+            "{}={}".format(tier, count) for tier, count in tier_counts.most_common()))
+
+    if doi_cache is not None:
+        doi_cache.flush()
+    if pending_entries:
+        append_metadata_to_note(note_file, pending_entries, index=index, separate=not entry_count)
+        entry_count += len(pending_entries)
+    if not entry_count:
+        logger.info("No PDFs renamed, Markdown unchanged")
 
-        try:
-            os.rename(pdf_path, new_path)
-        except Exception as exc:
-            logger.error("Failed to rename %s -> %s: %s", pdf_path, new_path, exc)
-            continue
 
-        renamed_entries.append((bib, new_path))
-        logger.info("Renamed %s -> %s", os.path.basename(pdf_path), os.path.basename(new_path))
+def _doi_lines(note_lines: List[str]) -> Dict[str, int]:
+    doi_index_map = {}
+    for idx, line in enumerate(note_lines):
+        match = DOI_PATTERN.search(line)
+        if match:
+            doi_in_note = normalize_doi(match.group(0))
+            if doi_in_note:
+                doi_index_map[doi_in_note] = idx
+    return doi_index_map
 
-    if renamed_entries:
-        append_metadata_to_note(note_file, renamed_entries)
-    else:
-        logger.info("No PDFs renamed, Markdown unchanged")
 
+def append_metadata_to_note(note_file: str, entries: List[tuple],
+                            index: Optional[referenceIndex] = None, separate: bool = True) -> None:
+    """Replace the entries of ``note_file`` with the DOIs of ``entries``, append the others.
 
-def append_metadata_to_note(note_file: str, entries: List[tuple]) -> None:
+    With ``separate`` a blank line is put between the note and the appended entries.
+    """
     note_dir = os.path.dirname(os.path.abspath(note_file)) or "."
     try:
-        with open(note_file, "r") as handle:
-            note_lines = handle.read().splitlines()
+        content, mtime_ns = read_note(note_file)
+        note_lines = content.splitlines()
+        st = os.stat(note_file)
     except Exception as exc:
         logger.error("Failed to read Markdown file %s: %s", note_file, exc)
         return
 
-    doi_index_map = {}
-    for idx, line in enumerate(note_lines):
-        match = DOI_PATTERN.search(line)
-        if match:
-            doi_in_note = normalize_doi(match.group(0))
-            if doi_in_note:
-                doi_index_map[doi_in_note] = idx
+    if index is not None and st.st_mtime_ns == mtime_ns:
+        # the index knows the lines of a note it saw before, no need to scan it
+        doi_index_map = index.identifier_lines(note_file, content, st)
+    else:
+        doi_index_map = _doi_lines(note_lines)
 
     appended_lines: List[str] = []
     replacements = 0
@@ -186,12 +651,16 @@ def append_metadata_to_note(note_file: str, entries: List[tuple]) -> None:
         return
 
     if appended_lines:
-        if note_lines and note_lines[-1].strip():
+        if separate and note_lines and note_lines[-1].strip():
             note_lines.append("")
         note_lines.extend(appended_lines)
 
-    with open(note_file, "w") as handle:
-        handle.write("\n".join(note_lines) + "\n")
+    new_content = "\n".join(note_lines) + "\n"
+    if not atomic_write(note_file, new_content, expected_mtime_ns=mtime_ns):
+        logger.error("Markdown %s changed while PDFs were renamed, re-run to add the entries", note_file)
+        return
+    if index is not None:
+        index.update(note_file, new_content)
 
     logger.info(
         "Markdown updated: replaced %s entries, appended %s entries",
@@ -0,0 +1,250 @@
+import gzip
+import json
+import logging
+import os
+import re
+import sqlite3
+import tarfile
+import threading
+import zlib
+
+from .cache import default_cache_dir, normalize_identifier
+
+logging.basicConfig()
+logger = logging.getLogger('snapshot')
+logger.setLevel(logging.INFO)
+
+SNAPSHOT_NAME = "snapshot.sqlite"
+# rows inserted per transaction while importing
+IMPORT_BATCH = 10000
+_VERSION = re.compile(r"v[0-9]+$")
+
+
+def snapshot_key(paper_id, id_type):
+    key = normalize_identifier(paper_id)
+    if id_type == "arxivId":
+        key = _VERSION.sub("", key)
+    return key
+
+
+def _pack(bib):
+    return zlib.compress(json.dumps(bib, separators=(",", ":")).encode("utf-8"))
+
+
+def _unpack(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+def _open_member(name, fileobj):
+    if name.endswith(".gz"):
+        return gzip.GzipFile(fileobj=fileobj)
+    return fileobj
+
+
+def _read_works(name, f):
+    """The works of one file of a CrossRef dump, a {"items": [...]} json
+    file or one work per line."""
+    if name.endswith(".jsonl") or name.endswith(".jsonl.gz"):
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        for item in json.load(f).get("items") or []:
+            yield item
+
+
+def iter_crossref_works(path):
+    """Stream the works of a CrossRef public data file.
+
+    Args:
+        path (str): The dump as distributed (a tar of .json.gz files), a
+            folder of .json(.gz) / .jsonl(.gz) files or one such file.
+    """
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                if ".json" in name:
+                    with open(os.path.join(root, name), "rb") as f:
+                        yield from _read_works(name, _open_member(name, f))
+    elif tarfile.is_tarfile(path):
+        # stream mode reads the members in order, without an index of the archive
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                if member.isfile() and ".json" in member.name:
+                    f = archive.extractfile(member)
+                    yield from _read_works(member.name, _open_member(member.name, f))
+    else:
+        with open(path, "rb") as f:
+            yield from _read_works(path, _open_member(path, f))
+
+
+def iter_arxiv_records(path):
+    """Stream the records of the arXiv metadata snapshot, one json object per line."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def arxiv_record_bib(record):
+    """The dict arxivInfo.extract_json_info builds, from a snapshot record."""
+    versions = record.get("versions") or []
+    version = versions[-1]["version"] if versions else "v1"
+    paper_url = "http://arxiv.org/abs/{}{}".format(record["id"], version)
+
+    # created looks like "Mon, 2 Apr 2007 19:18:42 GMT"
+    created = versions[0].get("created", "").split() if versions else []
+    if len(created) > 3:
+        year = created[3]
+    else:
+        year = (record.get("update_date") or " ")[:4]
+
+    parsed = record.get("authors_parsed") or []
+    if parsed:
+        authors = " and ".join(" ".join(part for part in (names[1:2] + names[0:1] + names[2:3]) if part)
+                               for names in parsed)
+    else:
+        authors = " ".join((record.get("authors") or "").split()).replace(", ", " and ")
+
+    return {
+        "title": " ".join(record["title"].split()),
+        "author": authors,
+        "journal": "arxiv",
+        "year": year,
+        "url": paper_url,
+        "pdf_link": paper_url.replace("abs", "pdf") + ".pdf",
+        "cited_count": None,
+    }
+
+
+class snapshotIndex(object):
+    """Paper metadata imported from CrossRef and arXiv bulk dumps, kept in
+    SQLite keyed by normalized id so it can answer without the network.
+
+    Every row holds the bib dict the online lookup would return, compressed.
+    arXiv records with a DOI point to it, like the arXiv API does.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(default_cache_dir(), SNAPSHOT_NAME)
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS works ("
+            " key TEXT PRIMARY KEY,"
+            " source TEXT NOT NULL,"
+            " doi TEXT,"
+            " bib BLOB NOT NULL) WITHOUT ROWID")
+        self.conn.commit()
+
+    def _import(self, source, rows):
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= IMPORT_BATCH:
+                count += self._insert(source, batch)
+                batch = []
+                logger.info("Imported {} {} records".format(count, source))
+        count += self._insert(source, batch)
+        return count
+
+    def _insert(self, source, batch):
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO works (key, source, doi, bib) VALUES (?, ?, ?, ?)",
+                [(key, source, doi, _pack(bib)) for key, doi, bib in batch])
+            self.conn.commit()
+        return len(batch)
+
+    def import_crossref(self, path):
+        """Import a CrossRef public data file.
+
+        Returns:
+            The number of works imported, works the online lookup could not
+            render either (e.g. without a link) are skipped.
+        """
+        from .crossref import crossrefInfo
+
+        crossref_info = crossrefInfo()
+
+        def rows():
+            for work in iter_crossref_works(path):
+                try:
+                    bib = crossref_info.extract_json_info(work)
+                except Exception:
+                    continue
+                yield work["DOI"].lower(), None, bib
+
+        return self._import("crossref", rows())
+
+    def import_arxiv(self, path):
+        """Import the arXiv metadata snapshot.
+
+        Returns:
+            The number of records imported.
+        """
+        def rows():
+            for record in iter_arxiv_records(path):
+                try:
+                    bib = arxiv_record_bib(record)
+                except (KeyError, IndexError, TypeError):
+                    continue
+                doi = (record.get("doi") or "").split()
+                yield snapshot_key(record["id"], "arxivId"), doi[0].lower() if doi else None, bib
+
+        return self._import("arxiv", rows())
+
+    def _get(self, key):
+        with self._lock:
+            return self.conn.execute("SELECT doi, bib FROM works WHERE key = ?", (key,)).fetchone()
+
+    def lookup(self, paper_id, id_type):
+        """The bib dict of a paper OR None if the snapshot does not know it.
+
+        An arXiv paper with a DOI is answered with the CrossRef work of the
+        DOI when that was imported as well.
+        """
+        if id_type not in ("doi", "arxivId"):
+            return None
+        row = self._get(snapshot_key(paper_id, id_type))
+        if row is None:
+            return None
+        doi, bib = row
+        if doi:
+            work = self._get(doi)
+            if work is not None:
+                return _unpack(work[1])
+        return _unpack(bib)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.conn.execute("SELECT source, COUNT(*) FROM works GROUP BY source").fetchall())
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+SNAPSHOT = None
+
+
+def configure_snapshot(path=None):
+    """Consult the snapshot index at ``path`` before the network, None stops doing so."""
+    global SNAPSHOT
+    if SNAPSHOT is not None:
+        SNAPSHOT.close()
+    SNAPSHOT = snapshotIndex(path) if path else None
+
+
+def lookup(paper_id, id_type):
+    if SNAPSHOT is None:
+        return None
+    return SNAPSHOT.lookup(paper_id, id_type)
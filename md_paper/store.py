@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from .cache import file_sha256, normalize_identifier
+
+logging.basicConfig()
+logger = logging.getLogger('store')
+logger.setLevel(logging.INFO)
+
+INDEX_NAME = "index.json"
+
+
+class pdfStore(object):
+    """Content-addressed pdf store.
+
+    Every pdf is kept once under ``blobs/<sha256[:2]>/<sha256>.pdf``; the
+    title named pdfs next to the notes are hard links (or symbolic links
+    when hard links are not possible) to those blobs. ``index.json`` maps
+    paper ids to blobs and blobs to the links pointing at them.
+    """
+    def __init__(self, root, link="hardlink"):
+        self.root = os.path.abspath(root)
+        self.link_mode = link
+        self.index_path = os.path.join(self.root, INDEX_NAME)
+        self.papers = {}
+        self.links = {}
+        self._lock = threading.Lock()
+        for folder in ("blobs", "incoming"):
+            path = os.path.join(self.root, folder)
+            if not os.path.exists(path):
+                os.makedirs(path)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                data = json.load(f)
+            self.papers = data.get("papers", {})
+            self.links = data.get("links", {})
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, "blobs", sha256[:2], sha256 + ".pdf")
+
+    def incoming_path(self, paper_id):
+        """Download location of a paper, stable across runs so an interrupted
+        download is resumed."""
+        name = hashlib.sha1(normalize_identifier(paper_id).encode("utf-8")).hexdigest()
+        return os.path.join(self.root, "incoming", name + ".pdf")
+
+    def lookup(self, paper_id):
+        """Returns the sha256 of a paper stored before, or None."""
+        sha256 = self.papers.get(normalize_identifier(paper_id))
+        if sha256 and os.path.exists(self.blob_path(sha256)):
+            return sha256
+        return None
+
+    def ingest(self, path, paper_id=None):
+        """Move a downloaded pdf into the store.
+
+        A pdf whose content is stored already is dropped instead.
+
+        Returns:
+            The sha256 of the pdf.
+        """
+        sha256 = file_sha256(path)
+        blob = self.blob_path(sha256)
+        with self._lock:
+            if os.path.exists(blob):
+                os.remove(path)
+                logger.info("Duplicate pdf {} already stored".format(sha256[:12]))
+            else:
+                if not os.path.exists(os.path.dirname(blob)):
+                    os.makedirs(os.path.dirname(blob))
+                os.replace(path, blob)
+            if paper_id:
+                self.papers[normalize_identifier(paper_id)] = sha256
+        return sha256
+
+    def link(self, sha256, target):
+        """Make ``target`` point at a stored blob."""
+        blob = self.blob_path(sha256)
+        target = os.path.abspath(target)
+        if os.path.lexists(target):
+            if os.path.samefile(target, blob):
+                self._record_link(sha256, target)
+                return
+            raise OSError("{} exists and is not the stored pdf".format(target))
+
+        if self.link_mode == "hardlink":
+            try:
+                os.link(blob, target)
+            except OSError:
+                os.symlink(blob, target)
+        else:
+            os.symlink(blob, target)
+        self._record_link(sha256, target)
+
+    def _record_link(self, sha256, target):
+        with self._lock:
+            targets = self.links.setdefault(sha256, [])
+            if target not in targets:
+                targets.append(target)
+
+    def link_paper(self, paper_id, target):
+        """Link ``target`` to the stored pdf of ``paper_id``.
+
+        Returns:
+            True if the paper was stored before and linked.
+        """
+        sha256 = self.lookup(paper_id)
+        if sha256 is None:
+            return False
+        self.link(sha256, target)
+        return True
+
+    def _is_live(self, sha256, target):
+        try:
+            return os.path.samefile(target, self.blob_path(sha256))
+        except OSError:
+            return False
+
+    def gc(self):
+        """Remove blobs no link points at anymore.
+
+        Returns:
+            The number of blobs removed.
+        """
+        removed = 0
+        with self._lock:
+            blobs_root = os.path.join(self.root, "blobs")
+            for folder in sorted(os.listdir(blobs_root)):
+                for name in sorted(os.listdir(os.path.join(blobs_root, folder))):
+                    sha256 = name[:-len(".pdf")]
+                    live = [target for target in self.links.get(sha256, []) if self._is_live(sha256, target)]
+                    if live:
+                        self.links[sha256] = live
+                        continue
+                    os.remove(os.path.join(blobs_root, folder, name))
+                    self.links.pop(sha256, None)
+                    removed += 1
+            stored = set(self.links)
+            self.papers = {paper_id: sha256 for paper_id, sha256 in self.papers.items() if sha256 in stored}
+        self.save()
+        return removed
+
+    def save(self):
+        with self._lock:
+            data = {"papers": self.papers, "links": self.links}
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.index_path)
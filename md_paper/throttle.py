@@ -0,0 +1,207 @@
+import logging
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+logging.basicConfig()
+logger = logging.getLogger('throttle')
+logger.setLevel(logging.INFO)
+
+# Maximum number of requests in flight per upstream host. arXiv asks clients
+# not to hammer the export API, CrossRef and bioRxiv tolerate a few parallel
+# connections.
+HOST_LIMITS = {
+    "api.crossref.org": 4,
+    "export.arxiv.org": 1,
+    "api.biorxiv.org": 2,
+}
+DEFAULT_LIMIT = 4
+
+# statuses worth another attempt, the throttling ones also shrink the window
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+# a Retry-After longer than this is not waited for, the request fails instead
+MAX_RETRY_AFTER = 300.0
+# the window is halved at most once per this many seconds, so a burst of
+# throttled responses to requests sent together counts as one signal
+DECREASE_EVERY = 1.0
+_INTERVAL = re.compile(r"^\s*([0-9.]+)\s*(ms|s|m|h)?\s*$")
+
+
+def parse_host_limits(specs):
+    """Parse ``host=N`` pairs given on the command line.
+
+    Args:
+        specs (list): e.g. ["api.crossref.org=8"]
+
+    Returns:
+        A dict mapping host names to concurrency limits.
+    """
+    limits = dict(HOST_LIMITS)
+    for spec in specs or []:
+        host, _, limit = spec.partition("=")
+        if not host or not limit:
+            raise ValueError("Host limit must look like host=N, got {}".format(spec))
+        limits[host.strip()] = max(1, int(limit))
+    return limits
+
+
+def parse_retry_after(value):
+    """Seconds to wait according to a Retry-After header, or None.
+
+    Args:
+        value (str): delta-seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def parse_interval(value):
+    """Seconds of an X-Rate-Limit-Interval header such as "1s", or None."""
+    match = _INTERVAL.match(value or "")
+    if not match:
+        return None
+    scale = {"ms": 0.001, "s": 1.0, None: 1.0, "m": 60.0, "h": 3600.0}[match.group(2)]
+    return float(match.group(1)) * scale
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number ``attempt`` (0 based): the server's
+    Retry-After when given, else full jitter exponential backoff."""
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class hostController(object):
+    """Adaptive request window of one upstream host.
+
+    The number of requests in flight follows AIMD: the window grows by
+    1/window per successful request, up to the configured host limit, and
+    is halved when the host throttles (429/503). A Retry-After pauses the
+    host, and X-Rate-Limit-Limit / X-Rate-Limit-Interval headers (sent by
+    CrossRef) space request starts so the advertised rate is never
+    exceeded.
+    """
+    def __init__(self, limit):
+        self.max_limit = max(1, limit)
+        self.window = float(self.max_limit)
+        self.in_flight = 0
+        self.spacing = 0.0
+        self.next_start = 0.0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = max(self.paused_until, self.next_start) - now
+                if wait <= 0 and self.in_flight < int(self.window):
+                    break
+                self._cond.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+            if self.spacing:
+                self.next_start = max(now, self.next_start) + self.spacing
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def observe(self, headers):
+        """Adopt the rate limit a response advertises."""
+        limit = headers.get("X-Rate-Limit-Limit")
+        interval = parse_interval(headers.get("X-Rate-Limit-Interval"))
+        if not limit or not interval:
+            return
+        try:
+            spacing = interval / max(1, int(limit))
+        except ValueError:
+            return
+        with self._cond:
+            self.spacing = spacing
+
+    def on_success(self):
+        with self._cond:
+            if self.window < self.max_limit:
+                self.window = min(self.max_limit, self.window + 1.0 / self.window)
+                self._cond.notify_all()
+
+    def on_throttle(self, retry_after=None):
+        with self._cond:
+            now = time.time()
+            if now - self.last_decrease >= DECREASE_EVERY:
+                self.window = max(1.0, self.window / 2)
+                self.last_decrease = now
+                logger.debug("Throttled, window is now {:.1f}".format(self.window))
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+
+class hostLimiter(object):
+    """Bound the number of concurrent requests per upstream host, the bound
+    adapts to how the host responds."""
+    def __init__(self, limits=None, default=DEFAULT_LIMIT):
+        self.limits = dict(HOST_LIMITS)
+        self.limits.update(limits or {})
+        self.default = default
+        self._controllers = {}
+        self._lock = threading.Lock()
+
+    def set_limits(self, limits):
+        with self._lock:
+            self.limits.update(limits)
+            self._controllers = {}
+
+    def controller(self, url):
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            controller = self._controllers.get(host)
+            if controller is None:
+                controller = hostController(self.limits.get(host, self.default))
+                self._controllers[host] = controller
+            return controller
+
+    @contextmanager
+    def slot(self, url):
+        """Hold one of the request slots of the host of ``url``.
+
+        Yields:
+            The hostController, to report how the request went.
+        """
+        controller = self.controller(url)
+        controller.acquire()
+        try:
+            yield controller
+        finally:
+            controller.release()
+
+
+LIMITER = hostLimiter()
+
+
+def host_slot(url):
+    return LIMITER.slot(url)
+
+
+def set_host_limits(limits):
+    LIMITER.set_limits(limits)
@@ -0,0 +1,122 @@
+import re
+from collections import namedtuple
+
+NOT_CORRECT_MARK = " **Not Correct, Check it**"
+
+# - {id} asks for the metadata, - {{id}} for the pdf as well, the marks are
+# left by earlier runs on references they could not resolve
+REFERENCE_PATTERN = re.compile(
+    r"- \{(?P<pdf>\{)?(?P<id>[^{}\n]{3,})\}(?(pdf)\})"
+    r"(?P<marks>(?:" + re.escape(NOT_CORRECT_MARK) + r")*)")
+# fence lines, scanned for separately: a pattern with a literal prefix lets
+# re skip ahead quickly, an alternation of both would not
+FENCE_PATTERN = re.compile(r"\n[ \t]*(?P<chars>`{3,}|~{3,})(?P<info>[^\n]*)")
+FIRST_FENCE_PATTERN = re.compile(r"[ \t]*(?P<chars>`{3,}|~{3,})(?P<info>[^\n]*)")
+
+# tried in order, like the checks downloads.classify used to make one by one
+ID_TYPE_PATTERN = re.compile(
+    r"(?P<doi>10\.(?!1101)[0-9]{4}/)"
+    r"|(?P<medbiorxivId>10\.1101/)"
+    r"|(?P<arxivId>[0-9]{2}[0-1][0-9]\.[0-9]{3,}|.*/[0-9]{2}[0-1][0-9]{4})")
+
+
+paperReference = namedtuple("paperReference", [
+    "text",       # the reference as written, e.g. "- {{2208.05623}}"
+    "paper_id",   # e.g. "2208.05623"
+    "id_type",    # doi, arxivId, medbiorxivId or unrecognized
+    "want_pdf",   # True for - {{id}}
+    "start",      # span of text in the note
+    "end",
+    "marks_end",  # end of the not correct marks after text, == end without marks
+])
+
+
+def classify_id(identifier):
+    """
+    Classify the type of paper_id:
+    arxivId - arxivId
+    doi - digital object identifier
+    medbiorxivId - medrxiv or biorxiv id
+    unrecognized - anything else
+    """
+    match = ID_TYPE_PATTERN.match(identifier)
+    if match is None:
+        return "unrecognized"
+    return match.lastgroup
+
+
+def code_blocks(content):
+    """The spans of the fenced code blocks of a note, an unclosed one runs to the end."""
+    if "```" not in content and "~~~" not in content:
+        return []
+    fences = list(FENCE_PATTERN.finditer(content))
+    first = FIRST_FENCE_PATTERN.match(content)
+    if first:
+        fences.insert(0, first)
+
+    blocks = []
+    opener = None
+    for fence in fences:
+        chars, info = fence.group("chars"), fence.group("info")
+        if opener is None:
+            # a ``` opener's info string cannot contain backticks
+            if chars[0] != "`" or "`" not in info:
+                opener = fence
+        elif (chars[0] == opener.group("chars")[0] and len(chars) >= len(opener.group("chars"))
+              and not info.strip()):
+            blocks.append((opener.start("chars"), fence.end()))
+            opener = None
+    if opener is not None:
+        blocks.append((opener.start("chars"), len(content)))
+    return blocks
+
+
+def tokenize(content):
+    """Find the references of a note, skipping fenced code blocks.
+
+    Returns:
+        A list of paperReference in the order they appear.
+    """
+    refs = []
+    blocks = code_blocks(content)
+    block = 0
+    # tuple.__new__ skips the argument handling of paperReference(), this
+    # runs for every reference of the note
+    new_reference = tuple.__new__
+    for token in REFERENCE_PATTERN.finditer(content):
+        start, marks_end = token.span()
+        if blocks:
+            while block < len(blocks) and blocks[block][1] <= start:
+                block += 1
+            if block < len(blocks) and blocks[block][0] <= start:
+                continue
+        pdf, paper_id, marks = token.groups()
+        end = marks_end - len(marks)
+        refs.append(new_reference(paperReference, (content[start:end], paper_id, classify_id(paper_id),
+                                                   pdf is not None, start, end, marks_end)))
+    return refs
+
+
+def rewrite(content, refs, replace_dict):
+    """Replace references by their rendered lines, copying the rest of the note.
+
+    References missing from ``replace_dict`` get one not correct mark, the
+    marks of earlier runs are dropped.
+
+    Args:
+        content (str): The note.
+        refs (list): The paperReference of ``content``, from tokenize.
+        replace_dict (dict): Maps reference texts to their rendered lines.
+
+    Returns:
+        The new content.
+    """
+    parts = []
+    position = 0
+    for ref in refs:
+        parts.append(content[position:ref.start])
+        rendered = replace_dict.get(ref.text)
+        parts.append(rendered if rendered is not None else ref.text + NOT_CORRECT_MARK)
+        position = ref.marks_end
+    parts.append(content[position:])
+    return "".join(parts)
@@ -1,99 +1,206 @@
 import os 
 import logging
 import re 
-from tqdm import tqdm 
-from .downloads import get_paper_info_from_paperid, get_paper_pdf_from_paperid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .fileio import read_note, atomic_write
+from .metrics import phase
+from .tokenizer import rewrite, tokenize
 
 logging.basicConfig()
 logger = logging.getLogger('utils')
 logger.setLevel(logging.INFO)
 
 
-class patternRecognizer(object):
-    def __init__(self, regular_rule):
-        self.pattern = re.compile(regular_rule)
-
-    def match(self, string):
-        return self.pattern.match(string)
+def note_modified(md_file, content=None, mtime_ns=None, refs=None, **replace_dict):
+    """Apply replace_dict to a note and write it back atomically.
     
-    def findall(self, string):
-        return self.pattern.findall(string)
-
-    def multiple_replace(self, content, **replace_dict):
-        def replace_(value):
-            match = value.group()
-            if match in replace_dict.keys():
-                return replace_dict[match]
-            else:
-                return match+" **Not Correct, Check it**"
-        
-        replace_content = self.pattern.sub(replace_, content)
-        
-        return replace_content
+    Args:
+        md_file (str): The note file.
+        content (str): The note content if already read, saves reading it again.
+        mtime_ns (int): The mtime the note had when ``content`` was read, the
+            note is not overwritten if it changed since.
+        refs (list): The references tokenize found in ``content``, saves
+            scanning it again.
     
-
-def note_modified(pattern_recog, md_file, **replace_dict):
-    with open(md_file, 'r') as f:
-        content = f.read()
+    Returns:
+        The new content OR None when the note was modified during the run.
+    """
+    if content is None:
+        content, mtime_ns = read_note(md_file)
+        refs = None
+    if refs is None:
+        with phase("classify"):
+            refs = tokenize(content)
     
-    replaced_content = pattern_recog.multiple_replace(content, **replace_dict)
+    replaced_content = rewrite(content, refs, replace_dict)
+
+    if not atomic_write(md_file, replaced_content, expected_mtime_ns=mtime_ns):
+        return None
+    return replaced_content
 
-    with open(md_file, 'w') as f:
-        f.write(''.join(replaced_content))
 
-def classify_identifier(identifier):
-    """Not need to download PDF file 
+def pdf_path_of(bib, pdfs_path):
+    pdf_name = '_'.join(bib['title'].split(' ')) + '.pdf'
+    # rep specific symbol with '_'
+    pdf_name = re.sub(r"[<>:\"/\\|?*\n\r\x00-\x1F\x7F']", '_', pdf_name)
+    return os.path.join(pdfs_path, pdf_name)
+
+
+def fetch_pdf(literature_id, bib, pdf_path, proxy, path_locks=None, store=None):
+    """Download the pdf of a paper unless it already exists.
+    
+    With a pdfStore, a paper stored before is linked instead of downloaded,
+    and a new download is moved into the store and linked to ``pdf_path``.
     """
-    if identifier.endswith("}}"):
-        return True 
-    else: 
-        return False 
+    from .downloads import get_paper_pdf_from_paperid
+
+    if path_locks is None:
+        path_locks = pathLocks()
+    with path_locks.lock(pdf_path):
+        if os.path.exists(pdf_path):
+            return
+        if store is not None and store.link_paper(literature_id, pdf_path):
+            return
+
+        download_path = store.incoming_path(literature_id) if store is not None else pdf_path
+        get_paper_pdf_from_paperid(literature_id, download_path, direct_url=bib['pdf_link'], proxy=proxy)
+        if not os.path.exists(download_path):
+            get_paper_pdf_from_paperid(literature_id, download_path, proxy=proxy)
+
+        if store is not None and os.path.exists(download_path):
+            sha256 = store.ingest(download_path, paper_id=literature_id)
+            store.link(sha256, pdf_path)
+
+
+def render_literature(bib, pdf_path, note_file):
+    """Render the Markdown line of a resolved reference."""
+    # venue short name (conference abbreviation or journal name)
+    venue_short = bib.get('venue_short', bib.get('journal', ''))
+
+    cited_count = bib.get('cited_count', None)
+    if cited_count is None:
+        cited_str = ''
+    else:
+        cited_str = ' (citations: {})'.format(cited_count)
+
+    if os.path.exists(pdf_path):
+        replaced_literature = "- **{}**. {} et.al. **{}**, **{}** ([pdf]({}))([link]({})).{}".format(
+                            bib['title'], bib["author"].split(" and ")[0], venue_short or bib['journal'], 
+                            bib['year'],
+                            os.path.relpath(pdf_path, note_file).split('/',1)[-1], 
+                            bib['url'], cited_str)
+    else:
+        replaced_literature = "- **{}**. {} et.al. **{}**, **{}** ([link]({})).{}".format(
+                            bib['title'], bib["author"].split(" and ")[0], venue_short or bib['journal'], 
+                            bib['year'],
+                            bib['url'], cited_str
+                            )
+    return replaced_literature
+
 
+class pathLocks(object):
+    """One lock per pdf path, so that two references to the same paper never
+    download into the same file at once."""
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
 
-def get_update_content(m, note_file, pdfs_path, proxy):
+    def lock(self, path):
+        with self._lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+
+def _run(func, items, workers):
+    """Apply func to every item, on a thread pool when workers > 1, and
+    return the results in the order of items."""
+    from tqdm import tqdm
+
+    if workers <= 1:
+        return [func(item) for item in tqdm(items)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(tqdm(executor.map(func, items), total=len(items)))
+
+
+def get_vault_update_contents(notes, pdfs_path, proxy, cache=None, workers=1,
+                              arxiv_batch_size=None, store=None):
+    """Resolve the references of many notes, every distinct paper only once.
+    
+    All references are collected first, each unique paper id is resolved
+    once and its pdf downloaded once, the results are then rendered into
+    the replace_dict of every note citing it.
     
-    replace_dict = dict()
-    for literature in tqdm(m):
-        pdf = classify_identifier(literature)
-        
-        literature_id = literature.split('{')[-1].split('}')[0]
-        bib = get_paper_info_from_paperid(literature_id, proxy=proxy)
-        
-        try:
-            pdf_name = '_'.join(bib['title'].split(' ')) + '.pdf'
-            # rep specific symbol with '_'
-            pdf_name = re.sub(r"[<>:\"/\\|?*\n\r\x00-\x1F\x7F']", '_', pdf_name)
-            pdf_path = os.path.join(pdfs_path, pdf_name)
-            
-            if pdf:
-                if not os.path.exists(pdf_path):
-                    get_paper_pdf_from_paperid(literature_id, pdf_path, direct_url=bib['pdf_link'], proxy=proxy)
-                    if not os.path.exists(pdf_path):
-                        get_paper_pdf_from_paperid(literature_id, pdf_path, proxy=proxy)
-
-            # venue short name (conference abbreviation or journal name)
-            venue_short = bib.get('venue_short', bib.get('journal', ''))
-
-            cited_count = bib.get('cited_count', None)
-            if cited_count is None:
-                cited_str = ''
-            else:
-                cited_str = ' (citations: {})'.format(cited_count)
-
-            if os.path.exists(pdf_path):
-                replaced_literature = "- **{}**. {} et.al. **{}**, **{}** ([pdf]({}))([link]({})).{}".format(
-                                    bib['title'], bib["author"].split(" and ")[0], venue_short or bib['journal'], 
-                                    bib['year'],
-                                    os.path.relpath(pdf_path, note_file).split('/',1)[-1], 
-                                    bib['url'], cited_str)
-            else:
-                replaced_literature = "- **{}**. {} et.al. **{}**, **{}** ([link]({})).{}".format(
-                                    bib['title'], bib["author"].split(" and ")[0], venue_short or bib['journal'], 
-                                    bib['year'],
-                                    bib['url'], cited_str
-                                    )
-            replace_dict[literature] = replaced_literature
-        except:
-            logger.info("Failed to download paper, skipped {}".format(literature_id))
-        
-    return replace_dict 
\ No newline at end of file
+    Args:
+        notes (list): (note_file, paperReference list from tokenize) pairs
+        pdfs_path (str): The folder to save pdfs in.
+        proxy (str): The proxy.
+        cache (metadataCache): The metadata cache.
+        workers (int): The number of papers resolved concurrently.
+        arxiv_batch_size (int): The number of arxiv ids per arXiv query,
+            default ARXIV_BATCH_SIZE.
+        store (pdfStore): Keep pdfs in this content-addressed store.
+    
+    Returns:
+        A dict mapping note files to their replace_dict.
+    """
+    # the upstream clients load requests, feedparser and bs4, only import
+    # them once there is something to resolve
+    from .arxiv import ARXIV_BATCH_SIZE
+    from .downloads import get_paper_info_from_paperid, prefetch_paper_infos
+
+    if arxiv_batch_size is None:
+        arxiv_batch_size = ARXIV_BATCH_SIZE
+    occurrences = 0
+    want_pdf = dict()
+    id_types = dict()
+    for _, m in notes:
+        for literature in m:
+            occurrences += 1
+            literature_id = literature.paper_id
+            want_pdf[literature_id] = want_pdf.get(literature_id, False) or literature.want_pdf
+            id_types[literature_id] = literature.id_type
+    literature_ids = list(want_pdf)
+    if len(notes) > 1:
+        logger.info("Found {} unique papers in {} references across {} notes".format(
+            len(literature_ids), occurrences, len(notes)))
+
+    bibs = prefetch_paper_infos(literature_ids, proxy=proxy, cache=cache, id_types=id_types,
+                                arxiv_batch_size=arxiv_batch_size, workers=workers)
+    missing = [literature_id for literature_id in literature_ids if literature_id not in bibs]
+    if missing:
+        results = _run(lambda literature_id: get_paper_info_from_paperid(literature_id, proxy=proxy, cache=cache,
+                                                                         id_type=id_types[literature_id],
+                                                                         cache_checked=True),
+                       missing, workers)
+        bibs.update((literature_id, bib) for literature_id, bib in zip(missing, results) if bib)
+
+    downloads = [literature_id for literature_id in literature_ids
+                 if want_pdf[literature_id] and literature_id in bibs]
+    if downloads:
+        path_locks = pathLocks()
+
+        def download(literature_id):
+            bib = bibs[literature_id]
+            try:
+                fetch_pdf(literature_id, bib, pdf_path_of(bib, pdfs_path), proxy,
+                          path_locks=path_locks, store=store)
+            except:
+                logger.info("Failed to download pdf of {}".format(literature_id))
+
+        _run(download, downloads, workers)
+        if store is not None:
+            store.save()
+
+    replace_dicts = dict()
+    for note_file, m in notes:
+        replace_dict = dict()
+        for literature in m:
+            literature_id = literature.paper_id
+            try:
+                bib = bibs[literature_id]
+                replace_dict[literature.text] = render_literature(bib, pdf_path_of(bib, pdfs_path), note_file)
+            except:
+                logger.info("Failed to download paper, skipped {}".format(literature_id))
+        replace_dicts[note_file] = replace_dict
+
+    return replace_dicts
@@ -0,0 +1,221 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+logging.basicConfig()
+logger = logging.getLogger('watch')
+logger.setLevel(logging.INFO)
+
+# seconds a note must stay quiet before it is processed
+DEBOUNCE = 1.0
+# seconds between two scans of pollingWatcher
+POLL_INTERVAL = 2.0
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+def is_note(name):
+    """True for markdown notes, editors' and atomic_write's temporary files are not."""
+    lower = name.lower()
+    return not name.startswith(".") and (lower.endswith(".md") or lower.endswith(".markdown"))
+
+
+def _walk_notes(root):
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            if is_note(name):
+                yield os.path.join(folder, name)
+
+
+class inotifyWatcher(object):
+    """Report changed notes under ``root`` with Linux inotify, called through ctypes.
+
+    Raises:
+        OSError: inotify is not available.
+    """
+    def __init__(self, root):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify needs Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.root = root
+        self.folders = {}
+        self._add_tree(root)
+
+    def _add_watch(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logger.warning("Too many watched folders, raise fs.inotify.max_user_watches")
+            raise OSError(err, os.strerror(err), folder)
+        self.folders[wd] = folder
+
+    def _add_tree(self, root):
+        """Watch ``root`` and its subfolders.
+
+        Returns:
+            The notes already in them, a new folder may be filled before it is watched.
+        """
+        notes = []
+        for folder, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            try:
+                self._add_watch(folder)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+            notes.extend(os.path.join(folder, name) for name in files if is_note(name))
+        return notes
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def poll(self, timeout):
+        """Wait up to ``timeout`` seconds for changes.
+
+        Returns:
+            The set of notes created, written, moved or deleted.
+        """
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        for wd, mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, rescanning {}".format(self.root))
+                changed.update(_walk_notes(self.root))
+                continue
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith("."):
+                    changed.update(self._add_tree(path))
+            elif is_note(name):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class pollingWatcher(object):
+    """Report changed notes under ``root`` by comparing mtime and size every ``interval`` seconds."""
+    def __init__(self, root, interval=POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for path in _walk_notes(self.root):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            snapshot[path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._scan()
+        changed = set(path for path, state in snapshot.items() if self.snapshot.get(path) != state)
+        changed.update(set(self.snapshot) - set(snapshot))
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(root, interval=POLL_INTERVAL, polling=False):
+    """inotify where available, polling otherwise."""
+    if not polling:
+        try:
+            return inotifyWatcher(root)
+        except (OSError, AttributeError) as exc:
+            logger.info("inotify unavailable ({}), polling every {}s".format(exc, interval))
+    return pollingWatcher(root, interval)
+
+
+def watch(root, process, debounce=DEBOUNCE, interval=POLL_INTERVAL, polling=False):
+    """Call ``process`` with the notes under ``root`` that changed, until interrupted.
+
+    A note is handed over once no event arrived for it for ``debounce``
+    seconds, so an editor saving in several writes triggers one update.
+
+    Args:
+        root (str): The vault folder.
+        process (callable): Called with a sorted list of changed note paths,
+            deleted notes included.
+        debounce (float): Quiet seconds before a change is processed.
+        interval (float): Seconds between scans when polling.
+        polling (bool): Poll even if inotify is available.
+    """
+    watcher = open_watcher(root, interval=interval, polling=polling)
+    logger.info("Watching {} for changed notes, press Ctrl+C to stop".format(root))
+    pending = {}
+    try:
+        while True:
+            now = time.time()
+            timeout = min(pending.values()) + debounce - now if pending else 60.0
+            for path in watcher.poll(max(0.0, timeout)):
+                pending[path] = time.time()
+
+            now = time.time()
+            ready = sorted(path for path, last in pending.items() if now - last >= debounce)
+            if ready:
+                for path in ready:
+                    del pending[path]
+                try:
+                    process(ready)
+                except Exception:
+                    logger.exception("Failed to update {}".format(", ".join(ready)))
+    except KeyboardInterrupt:
+        logger.info("Stopped watching {}".format(root))
+    finally:
+        watcher.close()
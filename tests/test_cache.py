@@ -0,0 +1,86 @@
+import pytest
+
+from md_paper import cache as cache_module
+from md_paper.cache import DAY, metadataCache
+
+BIB = {"title": "A paper", "journal": "Nature", "cited_count": 3}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000000000.0]
+    monkeypatch.setattr(cache_module.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "metadata.sqlite")
+
+
+def test_fresh_entry_is_a_hit(cache_path, clock):
+    cache = metadataCache(cache_path)
+    cache.put("DOI:10.1038/ABC", BIB)
+    # pending puts are served before they are written
+    assert cache.get("10.1038/abc") == BIB
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert cache.get("10.1038/other") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_citation_count_alone(cache_path, clock):
+    cache = metadataCache(cache_path)
+    cache.put("10.1038/abc", BIB)
+    clock[0] += 8 * DAY
+    assert cache.get("10.1038/abc") is None
+    assert cache.get_stale("10.1038/abc") == (BIB, {"cited_count"})
+
+    cache.update_field("10.1038/abc", "cited_count", 5)
+    assert cache.get("10.1038/abc") == dict(BIB, cited_count=5)
+    clock[0] += 180 * DAY
+    assert cache.get_stale("10.1038/abc")[1] == {"title", "journal", "cited_count"}
+
+
+def test_empty_fields_do_not_expire(cache_path, clock):
+    cache = metadataCache(cache_path)
+    cache.put("10.1038/abc", dict(BIB, cited_count=None))
+    clock[0] += 8 * DAY
+    assert cache.get("10.1038/abc") == dict(BIB, cited_count=None)
+
+
+def test_custom_ttls(cache_path, clock):
+    cache = metadataCache(cache_path, ttls={"cited_count": DAY})
+    cache.put("10.1038/abc", BIB)
+    clock[0] += 2 * DAY
+    assert cache.get_stale("10.1038/abc")[1] == {"cited_count"}
+
+
+def test_flush_makes_puts_visible_to_other_processes(cache_path, clock):
+    cache = metadataCache(cache_path)
+    other = metadataCache(cache_path)
+    cache.put("10.1038/abc", BIB)
+    assert other.get("10.1038/abc") is None
+    cache.flush()
+    assert other.get("10.1038/abc") == BIB
+    other.close()
+    cache.close()
+
+
+def test_puts_are_written_every_commit_every(cache_path, clock, monkeypatch):
+    monkeypatch.setattr(cache_module, "COMMIT_EVERY", 4)
+    cache = metadataCache(cache_path)
+    other = metadataCache(cache_path)
+    for i in range(3):
+        cache.put("10.1038/{}".format(i), BIB)
+    assert other.get("10.1038/0") is None
+    cache.put("10.1038/3", BIB)
+    assert other.get("10.1038/0") == BIB
+    other.close()
+    cache.close()
+
+
+def test_close_flushes(cache_path, clock):
+    cache = metadataCache(cache_path)
+    cache.put("10.1038/abc", BIB)
+    cache.close()
+    assert metadataCache(cache_path).get("10.1038/abc") == BIB
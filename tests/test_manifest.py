@@ -0,0 +1,74 @@
+import os
+
+from md_paper.manifest import noteManifest
+
+
+def write_note(tmp_path, content, name="note.md"):
+    path = tmp_path / name
+    path.write_text(content, encoding="utf-8")
+    return str(path)
+
+
+def test_unknown_note_is_changed(tmp_path):
+    manifest = noteManifest(str(tmp_path))
+    assert not manifest.is_unchanged(write_note(tmp_path, "- {2208.05623}\n"))
+
+
+def test_recorded_note_is_unchanged(tmp_path):
+    note_path = write_note(tmp_path, "- {2208.05623}\n")
+    manifest = noteManifest(str(tmp_path))
+    manifest.record(note_path)
+    assert manifest.is_unchanged(note_path)
+    assert manifest.is_unchanged(note_path, os.stat(note_path))
+
+
+def test_edited_note_is_changed(tmp_path):
+    note_path = write_note(tmp_path, "- {2208.05623}\n")
+    manifest = noteManifest(str(tmp_path))
+    manifest.record(note_path)
+    write_note(tmp_path, "- {2208.05624}\n")
+    st = os.stat(note_path)
+    os.utime(note_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    # same size, the content hash tells them apart
+    assert not manifest.is_unchanged(note_path)
+    write_note(tmp_path, "- {2208.05623}\n- {2208.05624}\n")
+    assert not manifest.is_unchanged(note_path)
+
+
+def test_touched_note_is_unchanged(tmp_path):
+    note_path = write_note(tmp_path, "- {2208.05623}\n")
+    manifest = noteManifest(str(tmp_path))
+    manifest.record(note_path)
+    manifest.save()
+    st = os.stat(note_path)
+    os.utime(note_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert manifest.is_unchanged(note_path)
+    # the new mtime is adopted, the next check does not read the note
+    assert manifest.dirty
+    assert manifest.entries[os.path.abspath(note_path)]["mtime_ns"] == os.stat(note_path).st_mtime_ns
+
+
+def test_manifest_survives_save(tmp_path):
+    note_path = write_note(tmp_path, "- {2208.05623}\n")
+    manifest = noteManifest(str(tmp_path))
+    manifest.record(note_path, "- {2208.05623}\n")
+    manifest.save()
+    assert noteManifest(str(tmp_path)).is_unchanged(note_path)
+
+
+def test_forgotten_note_is_changed(tmp_path):
+    note_path = write_note(tmp_path, "- {2208.05623}\n")
+    manifest = noteManifest(str(tmp_path))
+    manifest.record(note_path)
+    manifest.forget(note_path)
+    assert not manifest.is_unchanged(note_path)
+
+
+def test_unreadable_manifest_is_ignored(tmp_path):
+    note_path = write_note(tmp_path, "- {2208.05623}\n")
+    manifest = noteManifest(str(tmp_path))
+    manifest.record(note_path)
+    manifest.save()
+    with open(manifest.path, "w") as f:
+        f.write("{not json")
+    assert not noteManifest(str(tmp_path)).is_unchanged(note_path)
@@ -0,0 +1,121 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from md_paper.pdfs import expire_parts, part_path_of, pdfDownload
+
+BODY = b"%PDF-1.4\n" + bytes(range(256)) * 400
+
+
+class rangeHandler(BaseHTTPRequestHandler):
+    """Serves BODY, honouring Range except on /ignores-range.pdf which answers
+    every Range request with a 206 from the first byte."""
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.ranges.append(self.headers.get("Range"))
+        start = 0
+        if self.headers.get("Range"):
+            if self.path != "/ignores-range.pdf":
+                start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(BODY) - 1, len(BODY)))
+        else:
+            self.send_response(200)
+        body = BODY[start:]
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"body"')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope="module")
+def running_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), rangeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def server(running_server):
+    running_server.ranges = []
+    return running_server
+
+
+def url_of(server, name):
+    return "http://127.0.0.1:{}/{}".format(server.server_address[1], name)
+
+
+def leave_part(path, url, size):
+    part_path = part_path_of(path, url)
+    with open(part_path, "wb") as f:
+        f.write(BODY[:size])
+    with open(part_path + ".json", "w") as f:
+        json.dump({"url": url, "etag": '"body"'}, f)
+    return part_path
+
+
+def test_download_resumes_partial_file(server, tmp_path):
+    url = url_of(server, "paper.pdf")
+    path = str(tmp_path / "paper.pdf")
+    leave_part(path, url, 1000)
+    assert pdfDownload().download(url, path) == {"path": path, "url": url}
+    assert server.ranges == ["bytes=1000-"]
+    with open(path, "rb") as f:
+        assert f.read() == BODY
+    assert os.listdir(str(tmp_path)) == ["paper.pdf"]
+
+
+def test_mismatched_content_range_starts_over(server, tmp_path):
+    url = url_of(server, "ignores-range.pdf")
+    path = str(tmp_path / "paper.pdf")
+    part_path = leave_part(path, url, 1000)
+    opened = pdfDownload()._open_resumable(url, path)
+    try:
+        assert opened[0].status_code == 200
+        assert opened[1].startswith(b"%PDF")
+    finally:
+        opened[0].close()
+    assert server.ranges == ["bytes=1000-", None]
+    assert not os.path.exists(part_path)
+    assert not os.path.exists(part_path + ".json")
+
+
+def test_mismatched_content_range_download(server, tmp_path):
+    url = url_of(server, "ignores-range.pdf")
+    path = str(tmp_path / "paper.pdf")
+    leave_part(path, url, 1000)
+    assert pdfDownload().download(url, path) is not None
+    with open(path, "rb") as f:
+        assert f.read() == BODY
+
+
+def test_partial_file_of_another_url_is_not_resumed(server, tmp_path):
+    url = url_of(server, "paper.pdf")
+    path = str(tmp_path / "paper.pdf")
+    other_part = leave_part(path, url_of(server, "other.pdf"), 1000)
+    assert pdfDownload().download(url, path) is not None
+    assert server.ranges == [None]
+    # a complete download removes the progress of the other urls
+    assert not os.path.exists(other_part)
+
+
+def test_expire_parts(tmp_path):
+    path = str(tmp_path / "paper.pdf")
+    old_part = leave_part(path, "http://a/old.pdf", 100)
+    new_part = leave_part(path, "http://a/new.pdf", 100)
+    os.utime(old_part, (0, 0))
+    orphan = part_path_of(path, "http://a/orphan.pdf") + ".json"
+    with open(orphan, "w") as f:
+        f.write("{}")
+    expire_parts(path)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        os.path.basename(p) for p in (new_part, new_part + ".json"))
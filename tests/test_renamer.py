@@ -0,0 +1,73 @@
+import zlib
+
+import pytest
+
+from benchmarks.upstreams import make_pdf
+from md_paper.renamer import _doi_from_raw_streams, extract_doi_with_tier
+
+DOI = "10.1038/s41467-022-29269-6"
+
+
+def write_pdf(tmp_path, content, compress=False, info=None):
+    stream = zlib.compress(content) if compress else content
+    path = tmp_path / "paper.pdf"
+    path.write_bytes(make_pdf("", info=info, content=stream))
+    return str(path)
+
+
+@pytest.mark.parametrize("content", [
+    b"BT /F1 12 Tf 72 720 Td (doi:10.1038/s41467-022-29269-6)Tj ET",
+    b"BT /F1 12 Tf 72 720 Td [(doi: 10.1038/s41)-20(467-022-29269-6)] TJ ET",
+    b"BT /F1 12 Tf 72 720 Td [(doi: 10.1038/)5(s41467)(-022-29269-6)]TJ (Nature) Tj ET",
+])
+def test_raw_tier_reads_text_objects(tmp_path, content):
+    assert _doi_from_raw_streams(write_pdf(tmp_path, content)) == DOI
+    assert _doi_from_raw_streams(write_pdf(tmp_path, content, compress=True)) == DOI
+
+
+def test_raw_tier_split_literals_match_text_tier(tmp_path):
+    # a DOI split across the literals of a TJ array must not be cut at the split
+    path = write_pdf(tmp_path, b"BT /F1 12 Tf 72 720 Td [(doi: 10.1038/s41)-20(467-022-29269-6)] TJ ET")
+    assert extract_doi_with_tier(path) == (DOI, "raw")
+
+
+def test_raw_tier_wide_kerning_is_a_space(tmp_path):
+    path = write_pdf(tmp_path, b"BT /F1 12 Tf 72 720 Td [(see 10.5555/abc)-400(and more)] TJ ET")
+    assert _doi_from_raw_streams(path) == "10.5555/abc"
+
+
+def test_raw_tier_ignores_operators(tmp_path):
+    path = write_pdf(tmp_path, b"BT /F1 12 Tf 72 720 Td 10.1038/s41467-022-29269-6 ET")
+    assert _doi_from_raw_streams(path) is None
+
+
+def test_raw_tier_reads_uri_literals(tmp_path):
+    path = write_pdf(tmp_path, b"<< /A << /URI (https://doi.org/10.5555/x.1) >> >>")
+    assert _doi_from_raw_streams(path) == "10.5555/x.1"
+
+
+def test_info_tier_comes_first(tmp_path):
+    path = write_pdf(tmp_path, b"BT (doi: 10.5555/page.1) Tj ET", info="<< /doi (10.5555/info.1) >>")
+    assert extract_doi_with_tier(path) == ("10.5555/info.1", "info")
+
+
+def test_no_doi(tmp_path):
+    assert extract_doi_with_tier(write_pdf(tmp_path, b"BT (no identifier here) Tj ET")) == (None, None)
+
+
+def test_text_tier_reads_hex_strings(tmp_path):
+    # the raw tier reads literals only, pypdf's text extraction decodes the rest
+    text = "doi: 10.5555/hex.1".encode("ascii").hex().encode("ascii")
+    path = write_pdf(tmp_path, b"BT /F1 12 Tf 72 720 Td <" + text + b"> Tj ET")
+    assert extract_doi_with_tier(path) == ("10.5555/hex.1", "text")
+
+
+def test_doi_trailing_punctuation_is_dropped(tmp_path):
+    path = write_pdf(tmp_path, b"BT (see https://doi.org/10.5555/x.1\\).) Tj ET")
+    assert extract_doi_with_tier(path) == ("10.5555/x.1", "raw")
+
+
+def test_unreadable_pdf(tmp_path):
+    path = tmp_path / "broken.pdf"
+    path.write_bytes(b"not a pdf")
+    assert extract_doi_with_tier(str(path)) == (None, None)
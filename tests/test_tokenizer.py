@@ -0,0 +1,61 @@
+from md_paper.tokenizer import NOT_CORRECT_MARK, classify_id, code_blocks, rewrite, tokenize
+
+
+def test_tokenize_finds_references():
+    content = "# Papers\n- {10.1038/s41467-022-29269-6}\n- {{2208.05623}}\ntext - {ab}\n"
+    refs = tokenize(content)
+    assert [(ref.text, ref.paper_id, ref.id_type, ref.want_pdf) for ref in refs] == [
+        ("- {10.1038/s41467-022-29269-6}", "10.1038/s41467-022-29269-6", "doi", False),
+        ("- {{2208.05623}}", "2208.05623", "arxivId", True),
+    ]
+    for ref in refs:
+        assert content[ref.start:ref.end] == ref.text
+        assert ref.marks_end == ref.end
+
+
+def test_tokenize_skips_fenced_code():
+    content = ("- {2208.05623}\n"
+               "```markdown\n- {10.1101/2021.01.01.425001}\n```\n"
+               "~~~\n- {2101.00001}\n```\n- {2101.00002}\n~~~\n"
+               "- {10.1038/abc}\n")
+    assert [ref.paper_id for ref in tokenize(content)] == ["2208.05623", "10.1038/abc"]
+
+
+def test_unclosed_fence_runs_to_the_end():
+    content = "- {2208.05623}\n````\n- {2101.00001}\n```\n- {2101.00002}\n"
+    assert code_blocks(content) == [(content.index("````"), len(content))]
+    assert [ref.paper_id for ref in tokenize(content)] == ["2208.05623"]
+
+
+def test_backtick_info_string_is_not_a_fence():
+    content = "``` not `a` fence\n- {2208.05623}\n"
+    assert code_blocks(content) == []
+    assert len(tokenize(content)) == 1
+
+
+def test_tokenize_reads_marks():
+    content = "- {2208.05623}" + NOT_CORRECT_MARK * 2 + "\n"
+    ref, = tokenize(content)
+    assert ref.text == "- {2208.05623}"
+    assert content[ref.end:ref.marks_end] == NOT_CORRECT_MARK * 2
+
+
+def test_rewrite_replaces_and_marks():
+    content = "intro\n- {2208.05623}" + NOT_CORRECT_MARK + "\n- {10.1038/abc}" + NOT_CORRECT_MARK * 2 + "\nend\n"
+    refs = tokenize(content)
+    new_content = rewrite(content, refs, {"- {2208.05623}": "- rendered"})
+    # earlier marks are dropped, an unresolved reference gets exactly one
+    assert new_content == "intro\n- rendered\n- {10.1038/abc}" + NOT_CORRECT_MARK + "\nend\n"
+
+
+def test_rewrite_without_references_copies_the_note():
+    content = "```\n- {2208.05623}\n```\n"
+    assert rewrite(content, tokenize(content), {}) == content
+
+
+def test_classify_id():
+    assert classify_id("10.1038/abc") == "doi"
+    assert classify_id("10.1101/2021.01.01.425001") == "medbiorxivId"
+    assert classify_id("2208.05623") == "arxivId"
+    assert classify_id("hep-th/9901001") == "arxivId"
+    assert classify_id("not an id") == "unrecognized"